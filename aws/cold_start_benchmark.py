@@ -0,0 +1,157 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cold start profiling for the smartmedia Lambda functions.
+
+Each handler module is imported in a fresh interpreter, after timing the import
+of boto3 on its own so the SDK and the handler's own module level work are
+reported separately. Then every client it declares is built and a first (stubbed,
+so no AWS access is needed) API call is made through it. The cost of each step is
+reported separately.
+This script is not part of the Lambda function archives.
+
+Usage: python3 cold_start_benchmark.py [--repeat N] [module ...]
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+MODULES = [
+    'lambda_ai_trigger',
+    'lambda_rekognition_complete',
+    'lambda_resource_transcoder',
+    'lambda_transcoder_trigger',
+    'lambda_transcribe_complete',
+    ]
+
+# A cheap first call per service as (method, parameters, stubbed response).
+FIRST_CALLS = {
+    's3': ('head_object', {'Bucket': 'bucket', 'Key': 'key'}, {'Metadata': {}}),
+    'sqs': ('send_message_batch', {'QueueUrl': 'queue', 'Entries': [{'Id': '0', 'MessageBody': '{}'}]},
+            {'Successful': [], 'Failed': []}),
+    'rekognition': ('get_label_detection', {'JobId': 'job'}, {}),
+    'transcribe': ('get_transcription_job', {'TranscriptionJobName': 'job'}, {}),
+    'comprehend': ('batch_detect_sentiment', {'TextList': ['text'], 'LanguageCode': 'en'},
+                   {'ResultList': [], 'ErrorList': []}),
+    'elastictranscoder': ('read_pipeline', {'Id': 'pipeline'}, {}),
+    }
+
+
+def elapsed(start):
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def profile_module(module_name):
+    """
+    Profile a single handler module in this interpreter, which must be fresh.
+    """
+    result = {'module': module_name, 'clients': {}}
+
+    # boto3 first, before anything else imports botocore, so this is the whole SDK import.
+    start = time.perf_counter()
+    import boto3
+    result['boto3_import_ms'] = elapsed(start)
+
+    start = time.perf_counter()
+    module = __import__(module_name)
+    result['import_ms'] = elapsed(start)
+
+    from botocore.stub import Stubber
+
+    import lambda_common
+    for attribute, value in sorted(vars(module).items()):
+        if not isinstance(value, lambda_common.LazyClient):
+            continue
+
+        timings = dict()
+        start = time.perf_counter()
+        try:
+            client = value.get()
+        except Exception as e:
+            # e.g. a service that is missing from the installed botocore.
+            result['clients'][attribute] = {'error': str(e).split('.')[0]}
+            continue
+        timings['construct_ms'] = elapsed(start)
+
+        if value.kind == 'client' and value.name in FIRST_CALLS:
+            method, params, response = FIRST_CALLS[value.name]
+            with Stubber(client) as stubber:
+                stubber.add_response(method, response)
+                start = time.perf_counter()
+                getattr(client, method)(**params)
+                timings['first_call_ms'] = elapsed(start)
+
+        result['clients'][attribute] = timings
+
+    return result
+
+
+def run_isolated(module_name):
+    """
+    Profile a module in a new interpreter, so nothing is already imported or built.
+    """
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-2')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', module_name],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+        )
+
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile Lambda handler cold starts.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per module, the median is reported.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(profile_module(args.child)))
+        return
+
+    for module_name in args.modules:
+        runs = [run_isolated(module_name) for x in range(args.repeat)]
+        median = lambda values: sorted(values)[len(values) // 2]
+
+        print('{}: boto3 import {} ms, module import {} ms'.format(
+            module_name,
+            median([run['boto3_import_ms'] for run in runs]),
+            median([run['import_ms'] for run in runs])
+            ))
+        for attribute in sorted(runs[0]['clients']):
+            timings = [run['clients'][attribute] for run in runs]
+            if 'error' in timings[0]:
+                print('    {}: {}'.format(attribute, timings[0]['error']))
+                continue
+            line = '    {}: construct {} ms'.format(attribute, median([timing['construct_ms'] for timing in timings]))
+            if 'first_call_ms' in timings[0]:
+                line += ', first call {} ms'.format(median([timing['first_call_ms'] for timing in timings]))
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
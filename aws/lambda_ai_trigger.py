@@ -17,210 +17,384 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-import boto3
-import botocore
 import os
 import logging
-import io
 import json
-from botocore.exceptions import ClientError
 from datetime import datetime
-
-s3_client = boto3.client('s3')
-sqs_client = boto3.client('sqs')
-rekognition_client = boto3.client('rekognition')
-transcribe_client = boto3.client('transcribe')
+from concurrent.futures import ThreadPoolExecutor
+from lambda_common import ANALYSIS_PROCESSES, JobGroupTracker, LazyClient, StatusEmitter, call_with_retry, \
+    get_completion_tracker, get_dedup_index, get_error_code, get_expected_processes, get_idempotency_store, \
+    get_manifest, get_object_metadata, get_source_fingerprint, record_artifacts, record_finished_process, \
+    report_outcome, run_once, send_status_message
+
+s3_client = LazyClient('s3')
+sqs_client = LazyClient('sqs')
+rekognition_client = LazyClient('rekognition')
+transcribe_client = LazyClient('transcribe')
+status_emitter = StatusEmitter(sqs_client)
+completion_tracker = get_completion_tracker(s3_client)
+idempotency_store = get_idempotency_store(s3_client)
+job_group_tracker = JobGroupTracker(s3_client, os.environ.get('OutputBucket'))
 logger = logging.getLogger()
 
+# The result file Moodle fetches from the metadata folder for each process.
+RESULT_FILES = {
+    'StartLabelDetection': 'Labels.json',
+    'StartContentModeration': 'ModerationLabels.json',
+    'StartFaceDetection': 'Faces.json',
+    'StartPersonTracking': 'Persons.json',
+    'TranscribeComplete': 'transcription.json',
+    'SentimentComplete': 'sentiment.json',
+    'PhrasesComplete': 'phrases.json',
+    'EntitiesComplete': 'entities.json',
+    }
 
-def start_rekognition(input_key, job_id):
 
-    # Get environvent variables
-    output_bucket = os.environ.get('OutputBucket')  # Ouput S3 bucket
-    input_bucket = os.environ.get('InputBucket')  # Input S3 bucket
-    rekognition_Complete_Role_arn = os.environ.get('RekognitionCompleteRoleArn')
-    sns_rekognition_complete_arn = os.environ.get('SnsTopicRekognitionCompleteArn')
+def resolve_media(input_key, input_bucket, output_bucket, name_key=None):
+    """
+    Get the keys of the mp4 and mp3 renditions to use for AI processing.
 
-    rekognition_input = '{}/conversions/{}.mp4'.format(input_key, input_key)
-    transcribe_input = '{}/conversions/{}.mp3'.format(input_key, input_key)
+    The keys are derived from the preset metadata of the input object, using the
+    output naming of the transcoder trigger. If that metadata does not name an mp4
+    or mp3 preset, the conversions are listed instead.
+    Reused conversions keep the file names of the key they were made for, given as name_key.
+    There is guaranteed to be atleast one of each, as we force the download and audio presets.
+    """
+    name_key = name_key or input_key
+    metadata = get_object_metadata(s3_client, input_bucket, input_key)
+    presets = json.loads(metadata.get('presets', '{}'))
+    media = {'mp4': None, 'mp3': None}
+
+    for preset_id, container in presets.items():
+        if container in media and media[container] is None:
+            media[container] = '{0}/conversions/{1}_{2}.{3}'.format(input_key, name_key, preset_id, container)
+
+    if None in media.values():
+        # Fall back to listing every page of the conversions.
+        paginator = s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=output_bucket, Prefix='{}/conversions/'.format(input_key))
+        for page in pages:
+            for file_object in page.get('Contents', []):
+                filename = file_object.get('Key')
+                name, ext = os.path.splitext(filename)
+                if ext[1:] in media and media[ext[1:]] is None:
+                    media[ext[1:]] = filename
+
+    return media['mp4'], media['mp3']
+
+
+def start_job(name, start_method, **start_args):
+    """
+    Start an AI job, throttled starts are retried for this job only.
+    """
+    logger.info('Starting {}'.format(name))
+    response = call_with_retry(start_method, **start_args)
+    logger.info(response)
 
-    video_dict = {
-            'S3Object': {
-                'Bucket': output_bucket,
-                'Name': rekognition_input
-            }
-        }
-    notification_dict = {
-            'SNSTopicArn': sns_rekognition_complete_arn,
-            'RoleArn': rekognition_Complete_Role_arn
-        }
+    return response
 
-    services = get_enabled_services(s3_client, input_bucket, input_key)
 
-    if not(True in services.values()):
+def conversion_finished(sns_message_object):
+    """
+    Check if a completed transcode job finishes its conversion.
+    Conversions split over several jobs only finish when the last of their jobs completes.
+    """
+    user_metadata = sns_message_object.get('userMetadata', {})
+    if 'smartmediagroup' not in user_metadata:
+        return True
+
+    return job_group_tracker.part_finished(
+        user_metadata['smartmediagroup'],
+        sns_message_object['jobId'],
+        int(user_metadata['smartmediaparts'])
+        )
+
+
+def record_conversion(input_key, sns_message_object, finished):
+    """
+    Record the renditions and playlists of a completed transcode job in the manifest of the input object.
+    Once the whole conversion is finished the files it made are recorded too, so Moodle doesn't have to list them.
+    Failing to record is logged, the conversion itself is still there.
+    """
+    manifest = get_manifest(s3_client)
+    if manifest is None:
         return
 
-    # Now that we know we are running a service here, use the first encountered file that is .mp4.
-    # There is guaranteed to be atleast one, as we force the download preset.
-    # Do the same for mp3 using the audio preset.
-    objects = s3_client.list_objects_v2(
-        Bucket=output_bucket,
-        Prefix='{}/conversions/'.format(input_key)
-    )
-    videofilename = None
-    audiofilename = None
-    for file_object in objects.get('Contents', []):
-        # We are looking for the first file that has an .mp4 extension
-        filename = file_object.get('Key')
-        name, ext = os.path.splitext(filename)
-        if ext == '.mp4':
-            videofilename = filename
-        if ext == '.mp3':
-            audiofilename = filename
-
-    if videofilename is not None:
-        s3_client.copy_object(
-            Bucket=output_bucket,
-            Key=rekognition_input,
-            CopySource={
-                'Bucket': output_bucket,
-                'Key': videofilename
+    completed = int(datetime.timestamp(datetime.now()))
+    renditions = dict()
+    for output in sns_message_object.get('outputs', []):
+        renditions[output['key']] = {
+            'presetid': output['presetId'],
+            'jobid': sns_message_object['jobId'],
+            'duration': output.get('duration'),
+            'width': output.get('width'),
+            'height': output.get('height'),
+            'completed': completed
             }
-        )
-    if audiofilename is not None:
-        s3_client.copy_object(
-            Bucket=output_bucket,
-            Key=transcribe_input,
-            CopySource={
-                'Bucket': output_bucket,
-                'Key': audiofilename
+    playlists = dict()
+    for playlist in sns_message_object.get('playlists', []):
+        playlists[playlist['name']] = {
+            'format': playlist['format'],
+            'outputkeys': playlist['outputKeys'],
+            'completed': completed
             }
-        )
+    sections = {'renditions': renditions, 'playlists': playlists}
+
+    try:
+        if finished:
+            files = dict()
+            prefix = '{}/conversions/'.format(input_key)
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=os.environ.get('OutputBucket'), Prefix=prefix):
+                for file_object in page.get('Contents', []):
+                    files[file_object['Key'][len(prefix):]] = {
+                        'size': file_object['Size'],
+                        'etag': file_object['ETag'].strip('"'),
+                        'completed': int(datetime.timestamp(file_object['LastModified']))
+                        }
+            sections['conversions'] = files
+
+        # The file listing is complete, files of an earlier conversion that are gone mustn't stay listed.
+        manifest.update(input_key, sections, replace=('conversions',))
+    except Exception as e:
+        logger.error('Failed recording conversion {} in the manifest of {}: {}'.format(
+            sns_message_object['jobId'], input_key, e))
+
+
+def reuse_results(input_key, process, record, source_metadata):
+    """
+    Make sure the result files of a finished process are stored under input_key, so it can be replayed.
 
-    # Start Rekognition Label extraction.
-    if services['rekog_label'] and videofilename is not None:
-        logger.info('Starting Rekognition label detection')
-        label_response = rekognition_client.start_label_detection(
-            Video=video_dict,
-            ClientRequestToken=job_id,
-            MinConfidence=80,  # 50 is default.
-            NotificationChannel=notification_dict,
-            JobTag=job_id
-            )
-
-        logging.error(label_response)
-
-    # Start Rekognition content moderation operatations.
-    if services['rekog_moderation'] and videofilename is not None:
-        logger.info('Starting Rekognition moderation detection')
-        moderation_response = rekognition_client.start_content_moderation(
-            Video=video_dict,
-            MinConfidence=80,  # 50 is default.
-            ClientRequestToken=job_id,
-            NotificationChannel=notification_dict,
-            JobTag=job_id
-            )
-
-        logging.error(moderation_response)
-
-    # Start Rekognition face detection.
-    if services['rekog_face'] and videofilename is not None:
-        logger.info('Starting Rekognition face detection')
-        face_response = rekognition_client.start_face_detection(
-            Video=video_dict,
-            ClientRequestToken=job_id,
-            NotificationChannel=notification_dict,
-            FaceAttributes='DEFAULT',  # Other option is ALL.
-            JobTag=job_id
+    Results of the key itself are checked, results of another key are copied from it, along with
+    the other files it made for the process. The source can finish after its metadata folder was
+    copied with the conversions, so this is done when the process is replayed.
+    Returns False if the results can't be reused.
+    """
+    if record['status'] != 'SUCCEEDED':
+        return True  # Moodle doesn't fetch results of failed processes.
+
+    output_bucket = os.environ.get('OutputBucket')
+    result_key = '{}/metadata/{}'.format(input_key, RESULT_FILES[process])
+    try:
+        if record['objectkey'] == input_key:
+            s3_client.head_object(Bucket=output_bucket, Key=result_key)
+            return True
+
+        filenames = set([RESULT_FILES[process]])
+        filenames.update(filename for filename, entry in source_metadata.items() if entry['process'] == process)
+        for filename in sorted(filenames):
+            s3_client.copy_object(
+                Bucket=output_bucket,
+                Key='{}/metadata/{}'.format(input_key, filename),
+                CopySource={'Bucket': output_bucket, 'Key': '{}/metadata/{}'.format(record['objectkey'], filename)}
+                )
+    except Exception as e:
+        if get_error_code(e) not in ('404', 'NoSuchKey', 'NotFound'):
+            logger.error('Failed reusing {} result of {} for {}: {}'.format(process, record['objectkey'], input_key, e))
+        else:
+            logger.info('{} result of {} is gone, running it for {}'.format(process, record['objectkey'], input_key))
+        return False
+
+    return True
+
+
+def replay_finished_processes(input_key, source_key, jobs):
+    """
+    Report processes that already finished for the same media as finished again, instead of running them.
+
+    Only results stored under this key, or copied to it from source_key, can be reused.
+    Returns the jobs that still need to run.
+    """
+    input_bucket = os.environ.get('InputBucket')  # Input S3 bucket
+    dedup_index = get_dedup_index(s3_client)
+    if dedup_index is None:
+        return jobs
+
+    records = dedup_index.get(get_source_fingerprint(s3_client, input_bucket, input_key))
+    metadata = get_object_metadata(s3_client, input_bucket, input_key)
+    analyses = [process for process in get_expected_processes(metadata['processes']) if process in ANALYSIS_PROCESSES]
+    wanted = [job[0] for job in jobs] + analyses
+    manifest = get_manifest(s3_client)
+    source_metadata = dict()
+    if manifest is not None and source_key is not None:
+        source_metadata = (manifest.get(source_key) or {}).get('metadata', {})
+
+    # Results are only reused once they are stored under this key.
+    records = dict(
+        (process, record) for process, record in records.items()
+        if process in wanted and record['objectkey'] in (input_key, source_key)
+        and reuse_results(input_key, process, record, source_metadata)
         )
 
-        logger.error(face_response)
+    # The Comprehend analyses are run and reported as part of the transcription.
+    # The fingerprint doesn't cover the enabled processes, so this upload can enable analyses the
+    # earlier one didn't run. Those need the transcription to run again, which runs every enabled analysis.
+    if any(analysis not in records for analysis in analyses):
+        records.pop('TranscribeComplete', None)
+
+    remaining_jobs = list()
+    replayed = list()
+    for job in jobs:
+        process = job[0]
+        if process not in records:
+            remaining_jobs.append(job)
+            continue
+
+        replayed.append(process)
+        if process == 'TranscribeComplete':
+            replayed += [analysis for analysis in analyses if analysis in records]
+
+    # Results copied from another key are added to this key's manifest before Moodle is told about them.
+    if source_metadata and replayed:
+        record_artifacts(s3_client, input_key, dict(
+            (filename, entry) for filename, entry in source_metadata.items() if entry['process'] in replayed))
+
+    for replay_process in replayed:
+        logger.info('Reusing {} result of {} for {}'.format(
+            replay_process, records[replay_process]['objectkey'], input_key))
+        message = {
+            'objectkey': input_key,
+            'process': replay_process,
+            'reusedfrom': records[replay_process]['objectkey'],
+            'timestamp': int(datetime.timestamp(datetime.now()))
+            }
+        sqs_send_message(input_key, records[replay_process]['status'], message, replay_process)
 
-    # Start Rekognition Person tracking.
-    if services['rekog_label'] and videofilename is not None:
-        logger.info('Starting Rekognition person tracking')
-        person_tracking_response = rekognition_client.start_person_tracking(
-            Video=video_dict,
-            ClientRequestToken=job_id,
-            NotificationChannel=notification_dict,
-            JobTag=job_id
-        )
+    return remaining_jobs
 
-        logger.error(person_tracking_response)
-
-    # Start transcription job.
-    if services['transcribe'] and audiofilename is not None:
-        logger.info('Starting transcription.')
-        media_uri = 'https://s3-{}.amazonaws.com/{}/{}/conversions/{}.mp3'.format(
-            os.environ.get('AWS_REGION'),
-            output_bucket,
-            input_key,
-            input_key
-            )
-        transcription_response = transcribe_client.start_transcription_job(
-            TranscriptionJobName=job_id,
-            LanguageCode='en-AU',
-            MediaSampleRateHertz=44100,
-            MediaFormat='mp3',
-            Media={
-                'MediaFileUri': media_uri
-            },
-            Settings={}
-            )
 
-        logger.error(transcription_response)
+def start_rekognition(input_key, job_id, source_key=None):
+    """
+    Start every enabled Rekognition and Transcribe job concurrently.
 
+    When conversions were reused from source_key, results that also exist for it are reused too.
+    Returns a dict of process => None for started jobs, or the error for failed ones.
+    Failed jobs are reported to Moodle with an ERROR status for that process.
+    """
 
-def sqs_send_message(input_key, message_state, sns_message_object):
     # Get environvent variables
-    input_bucket = os.environ.get('InputBucket')  # Ouput S3 bucket
-    sqs_url = os.environ.get('SmartmediaSqsQueue')  # SQS queue URL.
+    output_bucket = os.environ.get('OutputBucket')  # Ouput S3 bucket
+    input_bucket = os.environ.get('InputBucket')  # Input S3 bucket
+    rekognition_Complete_Role_arn = os.environ.get('RekognitionCompleteRoleArn')
+    sns_rekognition_complete_arn = os.environ.get('SnsTopicRekognitionCompleteArn')
 
-    # Get input object metadata as we will need for SQS message sending.
-    input_object_headdata_object = s3_client.head_object(
-        Bucket=input_bucket,
-        Key=input_key
-        )
+    services = get_enabled_services(s3_client, input_bucket, input_key)
 
-    # Create JSON message to send to SQS queue.
+    if not(True in services.values()):
+        return {}
 
-    now = datetime.now()  # Current date and time.
+    # Point the AI services directly at the existing renditions.
+    videofilename, audiofilename = resolve_media(input_key, input_bucket, output_bucket, source_key)
 
-    message_object = {
-        'siteid' : input_object_headdata_object['Metadata']['siteid'],
-        'objectkey' : input_key,
-        'process': 'elastic_transcoder',
-        'status': message_state,
-        'message': sns_message_object,
-        'timestamp': int(datetime.timestamp(now))
+    video_dict = {
+            'S3Object': {
+                'Bucket': output_bucket,
+                'Name': videofilename
+            }
+        }
+    notification_dict = {
+            'SNSTopicArn': sns_rekognition_complete_arn,
+            'RoleArn': rekognition_Complete_Role_arn
         }
-    message_json = json.dumps(message_object)
+    media_uri = 'https://s3-{}.amazonaws.com/{}/{}'.format(
+        os.environ.get('AWS_REGION'),
+        output_bucket,
+        audiofilename
+        )
 
-    # Send message to SQS queue, we do this from Lambda not directly from sns,
-    # as we want to add some extra information to the message.
-    sqs_client.send_message(
-        QueueUrl=sqs_url,
-        MessageBody=message_json,
-        MessageAttributes={
-            'siteid': {
-                'StringValue': input_object_headdata_object['Metadata']['siteid'],
-                'DataType': 'String'
-            },
-            'inputkey': {
-                'StringValue': input_key,
-                'DataType': 'String'
+    # Jobs as (process, service, media file, start method, start arguments).
+    jobs = [
+        ('StartLabelDetection', 'rekog_label', videofilename,
+         rekognition_client.start_label_detection, {
+            'Video': video_dict,
+            'ClientRequestToken': job_id,
+            'MinConfidence': 80,  # 50 is default.
+            'NotificationChannel': notification_dict,
+            'JobTag': job_id
+            }),
+        ('StartContentModeration', 'rekog_moderation', videofilename,
+         rekognition_client.start_content_moderation, {
+            'Video': video_dict,
+            'MinConfidence': 80,  # 50 is default.
+            'ClientRequestToken': job_id,
+            'NotificationChannel': notification_dict,
+            'JobTag': job_id
+            }),
+        ('StartFaceDetection', 'rekog_face', videofilename,
+         rekognition_client.start_face_detection, {
+            'Video': video_dict,
+            'ClientRequestToken': job_id,
+            'NotificationChannel': notification_dict,
+            'FaceAttributes': 'DEFAULT',  # Other option is ALL.
+            'JobTag': job_id
+            }),
+        ('StartPersonTracking', 'rekog_person', videofilename,
+         rekognition_client.start_person_tracking, {
+            'Video': video_dict,
+            'ClientRequestToken': job_id,
+            'NotificationChannel': notification_dict,
+            'JobTag': job_id
+            }),
+        ('TranscribeComplete', 'transcribe', audiofilename,
+         transcribe_client.start_transcription_job, {
+            'TranscriptionJobName': job_id,
+            'LanguageCode': 'en-AU',
+            'MediaSampleRateHertz': 44100,
+            'MediaFormat': 'mp3',
+            'Media': {
+                'MediaFileUri': media_uri
             },
-        }
-    )
+            'Settings': {}
+            }),
+        ]
+    # Enabled processes without media to run on never finish, the completion tracker is told they were skipped.
+    for process, service, filename, start_method, start_args in jobs:
+        if services[service] and filename is None:
+            report_outcome(completion_tracker, status_emitter, input_key, process, 'SKIPPED')
+    jobs = [job for job in jobs if services[job[1]] and job[2] is not None]
+    jobs = replay_finished_processes(input_key, source_key, jobs)
+    if not jobs:
+        return {}
+
+    results = dict()
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [
+            (process, executor.submit(start_job, process, start_method, **start_args))
+            for process, service, filename, start_method, start_args in jobs
+            ]
+
+    for process, future in futures:
+        error = future.exception()
+        if error is not None:
+            logger.error('Failed starting {} for {}: {}'.format(process, input_key, error))
+            # The job id and time make each failure a distinct message, Moodle drops repeats of the same one.
+            sqs_send_message(input_key, 'ERROR', {
+                'objectkey': input_key,
+                'process': process,
+                'jobid': job_id,
+                'error': str(error),
+                'timestamp': int(datetime.timestamp(datetime.now()))
+                }, process)
+        results[process] = error
+
+    return results
+
+
+def sqs_send_message(input_key, message_state, sns_message_object, process='elastic_transcoder'):
+    # Tracked uploads get a single completion message instead.
+    if report_outcome(completion_tracker, status_emitter, input_key, process, message_state):
+        return
 
-def get_enabled_services(s3_client, bucket, input_key):
     # Get input object metadata as we will need for SQS message sending.
-    input_object_headdata_object = s3_client.head_object(
-        Bucket=bucket,
-        Key=input_key
-        )
+    metadata = get_object_metadata(s3_client, os.environ.get('InputBucket'), input_key)
+
+    # Send message to SQS queue, we do this from Lambda not directly from sns,
+    # as we want to add some extra information to the message.
+    send_status_message(status_emitter, metadata['siteid'], input_key, process, message_state, sns_message_object)
 
-    metadata = input_object_headdata_object['Metadata']
+def get_enabled_services(s3_client, bucket, input_key):
+    # Get input object metadata, this is cached so it is shared with SQS message sending.
+    metadata = get_object_metadata(s3_client, bucket, input_key)
     serviceraw = list(metadata['processes'])
 
     # Dict of rekognition position => service
@@ -239,6 +413,35 @@ def get_enabled_services(s3_client, bucket, input_key):
 
     return services
 
+def process_notification(sns_message_object):
+    """
+    Handle one transcoder job notification.
+    """
+    input_key = sns_message_object['input']['key']
+    job_id = sns_message_object['jobId']
+    message_state = sns_message_object['state']  # Get message state
+
+    # Moodle is only told a split conversion completed once all of its jobs have.
+    if message_state == 'COMPLETED':
+        finished = conversion_finished(sns_message_object)
+        record_conversion(input_key, sns_message_object, finished)
+        if not finished:
+            logger.info('Job {} of conversion {} completed, waiting for the others'.format(job_id, input_key))
+            return
+
+    sqs_send_message(input_key, message_state, sns_message_object)  # Send message to SQS queue.
+
+    # Only process Rekognition tasks if job status is complete
+    if message_state == 'COMPLETED':
+        # Reused conversions are already recorded against the key they were made for.
+        source_key = sns_message_object.get('reusedfrom', {}).get('objectkey')
+        if source_key is None:
+            record_finished_process(s3_client, os.environ.get('InputBucket'), input_key,
+                                    'elastic_transcoder', message_state, sns_message_object)
+        start_rekognition(input_key, job_id, source_key)
+
+
+@status_emitter.flush_on_exit
 def lambda_handler(event, context):
     """
     lambda_handler is the entry point that is invoked when the lambda function is called,
@@ -255,13 +458,9 @@ def lambda_handler(event, context):
     for record in event['Records']:
         sns_message_json = record['Sns']['Message']
         sns_message_object = json.loads(sns_message_json)
-        input_key = sns_message_object['input']['key']
-        output_key_prefix = sns_message_object['outputKeyPrefix']
-        job_id = sns_message_object['jobId']
-        message_state = sns_message_object['state']  # Get message state
-
-        sqs_send_message(input_key, message_state, sns_message_object)  # Send message to SQS queue.
 
-        # Only process Rekognition tasks if job status is complete
-        if message_state == 'COMPLETED':
-            start_rekognition(input_key, job_id)
+        # Each state of a job is notified, so the state is part of the job id.
+        # A redelivered notification would copy the renditions and start the AI jobs again.
+        job_id = '{}:{}'.format(sns_message_object['jobId'], sns_message_object['state'])
+        run_once(idempotency_store, sns_message_object['input']['key'], 'elastic_transcoder', job_id,
+                 process_notification, sns_message_object, status_emitter=status_emitter)
@@ -0,0 +1,1935 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Helpers shared by the smartmedia Lambda functions.
+This file is packaged into every Lambda function archive alongside the handler.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import functools
+import hashlib
+import json
+import os
+import logging
+import random
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard  # Not in the Lambda runtime, only available if packaged with the function.
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+SQS_BATCH_SIZE = 10  # Maximum number of entries per SendMessageBatch call.
+SQS_BATCH_BYTES = 262144  # Maximum total payload of a SendMessageBatch call.
+SQS_BATCH_RETRIES = 3
+
+# Error codes returned by AWS APIs when requests are being throttled.
+THROTTLE_EXCEPTIONS = ('ProvisionedThroughputExceededException',
+                       'ThrottlingException',
+                       'LimitExceededException',
+                       'TooManyRequestsException',
+                       'RequestLimitExceeded',
+                       'SlowDown')
+
+# Error codes of transient server side failures, for callers that do their own retrying.
+TRANSIENT_EXCEPTIONS = ('InternalServerError',
+                        'InternalFailure',
+                        'InternalError',
+                        'ServiceUnavailable',
+                        'ServiceUnavailableException',
+                        'RequestTimeout',
+                        'RequestTimeoutException')
+# Bases of the botocore exceptions for failed or dropped connections, matched by name so botocore isn't needed.
+CONNECTION_ERRORS = ('ConnectionError', 'HTTPClientError')
+
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # Smallest part size S3 accepts, except for the last part.
+
+# Metadata files can be stored compressed, one of off, gzip or zstd.
+# Moodle decodes them by their Content-Encoding.
+METADATA_COMPRESSION = os.environ.get('MetadataCompression', 'off')
+METADATA_COMPRESSION_LEVEL = os.environ.get('MetadataCompressionLevel', '')  # Empty for the encoding's default.
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+# Leading bytes of compressed files, so they can be read without knowing their Content-Encoding.
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+MANIFEST_VERSION = 1  # Version of the manifest.json layout.
+
+# Version of the status messages sent to Moodle, 1 has the full upstream payloads and 2 the compact ones.
+MESSAGE_SCHEMA_VERSION = int(os.environ.get('MessageSchemaVersion', 1))
+
+# Connection settings shared by every AWS client and HTTP pool.
+# The default pool of 10 connections is too small once calls are made from several threads.
+MAX_POOL_CONNECTIONS = int(os.environ.get('ClientMaxPoolConnections', 32))
+RETRY_MODE = os.environ.get('ClientRetryMode', 'adaptive')
+MAX_RETRIES = int(os.environ.get('ClientMaxRetries', 4))
+CONNECT_TIMEOUT = float(os.environ.get('ClientConnectTimeout', 5))
+READ_TIMEOUT = float(os.environ.get('ClientReadTimeout', 60))
+
+
+def get_client_config(retries=None):
+    """
+    Get the botocore config used for every client: pool size, timeouts, keep-alive and retries.
+    retries replaces the default retry settings, for callers that do their own retrying.
+    """
+    from botocore.config import Config
+
+    config_args = {
+        'max_pool_connections': MAX_POOL_CONNECTIONS,
+        'connect_timeout': CONNECT_TIMEOUT,
+        'read_timeout': READ_TIMEOUT,
+        'retries': retries or {'mode': RETRY_MODE, 'max_attempts': MAX_RETRIES},
+        'tcp_keepalive': True,
+        }
+    try:
+        return Config(**config_args)
+    except TypeError:
+        # Older botocore versions don't support TCP keep-alive.
+        del config_args['tcp_keepalive']
+        return Config(**config_args)
+
+
+class ClientRegistry:
+    """
+    Builds boto3 clients and resources on first use and keeps them for the life of the container.
+
+    boto3 itself is only imported when the first client is needed.
+    Every client is built with the same tuned config, and plain HTTP requests
+    share one urllib3 pool, so warm containers reuse open connections.
+    """
+
+    def __init__(self):
+        self._clients = dict()
+        self._http = None
+        self._lock = threading.Lock()
+
+    def get(self, name, kind='client', retries=None):
+        key = (kind, name) if retries is None else (kind, name, tuple(sorted(retries.items())))
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    import boto3
+                    client = getattr(boto3, kind)(name, config=get_client_config(retries))
+                    self._clients[key] = client
+
+        return client
+
+    def http(self):
+        """
+        Get the shared urllib3 pool manager for requests that don't go through boto3.
+        """
+        if self._http is None:
+            with self._lock:
+                if self._http is None:
+                    import urllib3
+                    from urllib3.connection import HTTPConnection
+                    self._http = urllib3.PoolManager(
+                        maxsize=MAX_POOL_CONNECTIONS,
+                        timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT),
+                        retries=urllib3.Retry(total=MAX_RETRIES, backoff_factor=0.5,
+                                              status_forcelist=(500, 502, 503, 504)),
+                        socket_options=HTTPConnection.default_socket_options + [
+                            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                            ]
+                        )
+
+        return self._http
+
+    def built(self):
+        """
+        Get the (kind, name) of every client built so far.
+        """
+        return [key[:2] for key in self._clients]
+
+
+client_registry = ClientRegistry()
+
+
+class LazyClient:
+    """
+    Stand in for a boto3 client or resource that is built on first use.
+    Clients with their own retries settings are kept apart from the shared one for the service.
+    """
+
+    def __init__(self, name, kind='client', retries=None):
+        self.name = name
+        self.kind = kind
+        self.retries = retries
+
+    def get(self):
+        return client_registry.get(self.name, self.kind, self.retries)
+
+    def __getattr__(self, attribute):
+        return getattr(self.get(), attribute)
+
+
+def get_error_code(error):
+    """
+    Get the error code of an AWS client error, or None for other exceptions.
+    """
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return None
+
+    return response.get('Error', {}).get('Code')
+
+
+def is_throttle_error(error, codes=THROTTLE_EXCEPTIONS):
+    """
+    Check if an exception is an AWS client error with one of the given error codes.
+    """
+    return get_error_code(error) in codes
+
+
+def is_transient_error(error):
+    """
+    Check if an exception is a transient failure worth retrying: a 5xx response, or a failed or dropped connection.
+    """
+    if get_error_code(error) in TRANSIENT_EXCEPTIONS:
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+        return True
+
+    return any(error_class.__name__ in CONNECTION_ERRORS for error_class in type(error).__mro__)
+
+
+def backoff_delay(retries, base_delay=0.5, max_delay=30):
+    """
+    Full jitter exponential backoff delay in seconds for the given retry number.
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** retries)))
+
+
+def call_with_retry(func, *args, max_retries=5, base_delay=0.5, codes=THROTTLE_EXCEPTIONS, **kwargs):
+    """
+    Call func, retrying with jittered exponential backoff while it is throttled.
+    Other errors, and throttling after max_retries retries, are raised.
+    """
+    retries = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_throttle_error(e, codes) or retries >= max_retries:
+                raise
+            delay = backoff_delay(retries, base_delay)
+            retries += 1
+            logger.warning('Throttled calling {}, retry {} in {:.2f}s'.format(
+                getattr(func, '__name__', func), retries, delay))
+            time.sleep(delay)
+
+
+class TokenBucket:
+    """
+    Client side rate limiter, shared by every thread in the container making the same kind of call.
+
+    Holds up to capacity tokens, refilled at rate tokens per second.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting until enough are available.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def drain(self):
+        """
+        Empty the bucket, so callers sharing it slow down after the service has throttled one of them.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+
+class ThrottleMetrics:
+    """
+    Counts calls, throttle events and time spent waiting for a kind of call.
+    """
+
+    def __init__(self):
+        self._counts = OrderedDict([
+            ('calls', 0), ('throttled', 0), ('transient', 0), ('failed', 0), ('wait_seconds', 0.0)
+            ])
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            for name in self._counts:
+                self._counts[name] = 0
+
+
+class ThrottledPaginator:
+    """
+    Pages through the results of an AWS get or list call that uses NextToken.
+
+    Each request takes a token from the (optionally shared) token bucket first.
+    Throttled requests, and transient server and connection failures, are retried
+    with jittered exponential backoff, up to max_retries times in a row, after which
+    the error is raised so a partial result set is never mistaken for a complete one.
+    """
+
+    def __init__(self, method, token_bucket=None, metrics=None, max_retries=5, base_delay=0.5,
+                 codes=THROTTLE_EXCEPTIONS):
+        self.method = method
+        self.token_bucket = token_bucket
+        self.metrics = metrics if metrics is not None else ThrottleMetrics()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.codes = codes
+
+    def _call(self, method_args):
+        retries = 0
+        while True:
+            if self.token_bucket is not None:
+                self.metrics.add('wait_seconds', self.token_bucket.acquire())
+            self.metrics.add('calls')
+            try:
+                return self.method(**method_args)
+            except Exception as e:
+                throttled = is_throttle_error(e, self.codes)
+                if not throttled and not is_transient_error(e):
+                    raise
+                self.metrics.add('throttled' if throttled else 'transient')
+                if throttled and self.token_bucket is not None:
+                    self.token_bucket.drain()
+                if retries >= self.max_retries:
+                    self.metrics.add('failed')
+                    raise
+                delay = backoff_delay(retries, self.base_delay)
+                retries += 1
+                logger.warning('{} calling {}, retry {} in {:.2f}s'.format('Throttled' if throttled else 'Failed',
+                               getattr(self.method, '__name__', self.method), retries, delay))
+                self.metrics.add('wait_seconds', delay)
+                time.sleep(delay)
+
+    def pages(self, **method_args):
+        """
+        Yield each page of results in turn.
+        """
+        while True:
+            results = self._call(method_args)
+            yield results
+
+            next_token = results.get('NextToken', '')
+            if next_token == '':
+                break
+            method_args['NextToken'] = next_token
+
+
+class TtlLruCache:
+    """
+    Bounded LRU cache with a time to live, safe to share between threads.
+
+    Lives at module level so it survives across warm invocations of the same container.
+    """
+
+    def __init__(self, max_size=256, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get the cached value for a key, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Store the value for a key, evicting the least recently used entry when full.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ObjectMetadataCache:
+    """
+    Cache of S3 object HEAD responses by bucket and key, see TtlLruCache.
+    """
+
+    def __init__(self, max_size=256, ttl=300):
+        self._cache = TtlLruCache(max_size, ttl)
+
+    def get(self, bucket, key):
+        return self._cache.get((bucket, key))
+
+    def put(self, bucket, key, value):
+        self._cache.put((bucket, key), value)
+
+    def invalidate(self, bucket, key):
+        self._cache.invalidate((bucket, key))
+
+    def clear(self):
+        self._cache.clear()
+
+
+metadata_cache = ObjectMetadataCache(
+    max_size=int(os.environ.get('MetadataCacheSize', 256)),
+    ttl=int(os.environ.get('MetadataCacheTtl', 300))
+    )
+
+
+def get_object_head(s3_client, bucket, key):
+    """
+    Get the HEAD response of an input object.
+    The S3 HEAD request is only made once per object while the result is cached.
+    """
+    head = metadata_cache.get(bucket, key)
+    if head is None:
+        head = s3_client.head_object(
+            Bucket=bucket,
+            Key=key
+            )
+        head.pop('ResponseMetadata', None)
+        metadata_cache.put(bucket, key, head)
+
+    return head
+
+
+def get_object_metadata(s3_client, bucket, key):
+    """
+    Get the user metadata (siteid, processes, presets) of an input object.
+    """
+    return get_object_head(s3_client, bucket, key)['Metadata']
+
+
+# Uploads up to these sizes go in the short lane, with its own pipelines and status queue,
+# so they aren't held up by long media. A threshold of 0 turns it off.
+SHORT_LANE_SECONDS = float(os.environ.get('ShortLaneSeconds', 0))  # Used if the upload has duration metadata.
+SHORT_LANE_BYTES = int(os.environ.get('ShortLaneBytes', 0))
+
+
+def classify_upload(head):
+    """
+    Get the lane for an upload from its HEAD response, by duration metadata if it has it or else by size.
+    Duration metadata that isn't a number is ignored.
+    """
+    duration = head['Metadata'].get('duration')
+    if duration is not None and SHORT_LANE_SECONDS:
+        try:
+            return 'short' if float(duration) <= SHORT_LANE_SECONDS else 'standard'
+        except (TypeError, ValueError):
+            logger.warning('Ignoring duration metadata {!r} that is not a number'.format(duration))
+    if SHORT_LANE_BYTES:
+        return 'short' if head['ContentLength'] <= SHORT_LANE_BYTES else 'standard'
+
+    return 'standard'
+
+
+def get_source_fingerprint(s3_client, bucket, key):
+    """
+    Get a fingerprint of an input object's content and its preset set.
+
+    Uploads with the same content and presets get the same fingerprint, whatever their key.
+    """
+    head = get_object_head(s3_client, bucket, key)
+    presets = json.loads(head['Metadata'].get('presets', '{}'))
+    fingerprint = json.dumps([head.get('ETag'), head.get('ContentLength'), sorted(presets.items())])
+
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+class DedupIndex:
+    """
+    Content addressed index of finished processing, so repeat uploads of the same
+    media can reuse earlier conversions and analysis instead of running them again.
+
+    Entries are keyed on a source fingerprint. Each finished process is recorded
+    separately as a dict of the key it was run for (objectkey), its status and message.
+    """
+
+    def get(self, fingerprint):
+        """
+        Get the records for a fingerprint as a dict of process => record.
+        """
+        raise NotImplementedError
+
+    def record(self, fingerprint, process, record):
+        raise NotImplementedError
+
+
+class LocalDedupIndex(DedupIndex):
+    """
+    In memory index, for development and testing. Only lasts as long as the container.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint):
+        with self._lock:
+            return dict(self._entries.get(fingerprint, {}))
+
+    def record(self, fingerprint, process, record):
+        with self._lock:
+            self._entries.setdefault(fingerprint, {})[process] = record
+
+
+class S3DedupIndex(DedupIndex):
+    """
+    Index stored in S3, one small object per fingerprint and process,
+    so handlers finishing at the same time never overwrite each other's records.
+    """
+
+    def __init__(self, s3_client, bucket, prefix='dedup/'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, fingerprint):
+        records = dict()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix='{}{}/'.format(self.prefix, fingerprint)):
+            for record_object in page.get('Contents', []):
+                process = record_object['Key'].rsplit('/', 1)[1][:-len('.json')]
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=record_object['Key'])
+                records[process] = json.loads(response['Body'].read())
+
+        return records
+
+    def record(self, fingerprint, process, record):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key='{}{}/{}.json'.format(self.prefix, fingerprint, process),
+            Body=json.dumps(record).encode('utf-8'),
+            ContentType='application/json'
+            )
+
+
+_local_dedup_index = LocalDedupIndex()
+
+
+def get_dedup_index(s3_client):
+    """
+    Get the dedup index set by the DedupIndex environment variable (off, s3 or local), or None when off.
+    """
+    backend = os.environ.get('DedupIndex', 'off')
+    if backend == 's3':
+        return S3DedupIndex(s3_client, os.environ.get('OutputBucket'))
+    elif backend == 'local':
+        return _local_dedup_index
+
+    return None
+
+
+def record_finished_process(s3_client, input_bucket, input_key, process, status, message):
+    """
+    Record a finished process in the dedup index, if there is one.
+    Failing to record only means later uploads won't be able to reuse the result.
+    """
+    dedup_index = get_dedup_index(s3_client)
+    if dedup_index is None:
+        return
+
+    try:
+        fingerprint = get_source_fingerprint(s3_client, input_bucket, input_key)
+        dedup_index.record(fingerprint, process, {'objectkey': input_key, 'status': status, 'message': message})
+    except Exception as e:
+        logger.error('Failed recording {} for {} in the dedup index: {}'.format(process, input_key, e))
+
+
+_conditional_writes = None
+
+
+def supports_conditional_writes(s3_client):
+    """
+    Check if the SDK can make conditional S3 writes (IfMatch and IfNoneMatch on PutObject).
+    They need botocore 1.35.68 or later, older versions reject the parameters.
+    """
+    global _conditional_writes
+    if _conditional_writes is None:
+        members = s3_client.meta.service_model.operation_model('PutObject').input_shape.members
+        _conditional_writes = 'IfMatch' in members and 'IfNoneMatch' in members
+        if not _conditional_writes:
+            import botocore
+            logger.warning('botocore {} does not support conditional S3 writes, concurrent updates can be lost. '
+                           'Use a runtime with botocore 1.35.68 or later.'.format(botocore.__version__))
+
+    return _conditional_writes
+
+
+class JobGroupTracker:
+    """
+    Tracks conversions that were split over several jobs, to tell when the last job finishes.
+
+    Each finished job is marked with its own S3 object. Once all are marked, the group is
+    claimed with a conditional write, so exactly one caller is told the group has finished,
+    even when jobs finish together or their notifications are delivered twice.
+    """
+
+    def __init__(self, s3_client, bucket, prefix='transcode-groups/'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def part_finished(self, group, part, parts):
+        """
+        Mark a job of a group as finished. Returns True if this finished the whole group.
+        """
+        parts_prefix = '{}{}/parts/'.format(self.prefix, group)
+        self.s3_client.put_object(Bucket=self.bucket, Key=parts_prefix + part, Body=b'')
+
+        response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=parts_prefix)
+        if response.get('KeyCount', 0) < parts:
+            return False
+
+        finished_key = '{}{}/finished'.format(self.prefix, group)
+        if not supports_conditional_writes(self.s3_client):
+            # Without conditional writes, jobs finishing at the same time can both finish the group.
+            try:
+                self.s3_client.head_object(Bucket=self.bucket, Key=finished_key)
+                return False
+            except Exception as e:
+                if get_error_code(e) not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+            self.s3_client.put_object(Bucket=self.bucket, Key=finished_key, Body=b'')
+            return True
+
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=finished_key,
+                Body=b'',
+                IfNoneMatch='*'
+                )
+        except Exception as e:
+            if get_error_code(e) in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False  # Someone else finished the group.
+            raise
+
+        return True
+
+
+class JsonStore:
+    """
+    Store of small JSON documents by key, with atomic read-modify-write updates.
+    """
+
+    def get(self, key):
+        """
+        Get a document, or None if there isn't one.
+        """
+        raise NotImplementedError
+
+    def update(self, key, func):
+        """
+        Replace a document with func(document), where document is None if there isn't one.
+        func returns (new document, result) and may be called again if another
+        writer got in first. Returns the result of the call that was stored.
+        If the new document is None nothing is written.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def stale(self, age):
+        """
+        Get the keys of documents that haven't been updated for age seconds.
+        """
+        raise NotImplementedError
+
+
+class LocalJsonStore(JsonStore):
+    """
+    In memory store, for development and testing. Only lasts as long as the container.
+    """
+
+    def __init__(self):
+        self._documents = dict()  # Key => (json, time updated).
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            return None if document is None else json.loads(document[0])
+
+    def update(self, key, func):
+        with self._lock:
+            document = self._documents.get(key)
+            document, result = func(None if document is None else json.loads(document[0]))
+            if document is not None:
+                self._documents[key] = (json.dumps(document), time.time())
+
+        return result
+
+    def delete(self, key):
+        with self._lock:
+            self._documents.pop(key, None)
+
+    def stale(self, age):
+        with self._lock:
+            return [key for key, document in self._documents.items() if document[1] < time.time() - age]
+
+
+class S3JsonStore(JsonStore):
+    """
+    Store kept in S3. Updates are conditional writes on the ETag of the document that
+    was read (or on there being none), and are retried when another writer got in first.
+    SDKs without conditional writes fall back to plain writes, see supports_conditional_writes().
+    """
+
+    CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+    MISSING_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+    def __init__(self, s3_client, bucket, prefix, max_retries=10):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_retries = max_retries
+
+    def _read(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if get_error_code(e) in self.MISSING_CODES:
+                return None, None
+            raise
+
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def get(self, key):
+        return self._read(key)[0]
+
+    def update(self, key, func):
+        retries = 0
+        while True:
+            document, etag = self._read(key)
+            document, result = func(document)
+            if document is None:
+                return result
+            if not supports_conditional_writes(self.s3_client):
+                condition = {}  # Last writer wins.
+            elif etag is None:
+                condition = {'IfNoneMatch': '*'}
+            else:
+                condition = {'IfMatch': etag}
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.prefix + key,
+                    Body=json.dumps(document).encode('utf-8'),
+                    ContentType='application/json',
+                    **condition
+                    )
+                return result
+            except Exception as e:
+                if get_error_code(e) not in self.CONFLICT_CODES or retries >= self.max_retries:
+                    raise
+                time.sleep(backoff_delay(retries, 0.05, 1))
+                retries += 1
+
+    def delete(self, key):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def stale(self, age):
+        keys = list()
+        cutoff = time.time() - age
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for document in page.get('Contents', []):
+                if document['LastModified'].timestamp() < cutoff:
+                    keys.append(document['Key'][len(self.prefix):])
+
+        return keys
+
+
+def get_json_store(s3_client, variable, prefix, local_store):
+    """
+    Get the JSON store set by an environment variable (off, s3 or local), or None when off.
+
+    The s3 store keeps its documents under prefix in the output bucket.
+    The local store is local_store, shared by the invocations of this container.
+    """
+    backend = os.environ.get(variable, 'off')
+    if backend == 's3':
+        return S3JsonStore(s3_client, os.environ.get('OutputBucket'), prefix)
+    elif backend == 'local':
+        return local_store
+    elif backend != 'off':
+        logger.error('Unknown {} backend {}, it is off'.format(variable, backend))
+
+    return None
+
+
+class LocalDeferralQueue:
+    """
+    In memory queue of deferred uploads, for development and testing.
+    """
+
+    def __init__(self):
+        self._items = deque()
+        self._lock = threading.Lock()
+
+    def push(self, site, item):
+        with self._lock:
+            self._items.append((site, item))
+
+    def receive(self):
+        """
+        Get the queued items as a list of (site, item, handle), oldest first.
+        Items stay queued until they are deleted.
+        """
+        with self._lock:
+            return [(site, item, (site, item)) for site, item in self._items]
+
+    def delete(self, handle):
+        with self._lock:
+            self._items.remove(handle)
+
+    def release(self, handle):
+        pass  # Items that aren't deleted are always received again.
+
+
+class SqsDeferralQueue:
+    """
+    Queue of deferred uploads kept in SQS. Received items stay hidden while they
+    are processed, until they are deleted or released.
+    """
+
+    def __init__(self, sqs_client, queue_url, max_receives=10, visibility_timeout=600):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.max_receives = max_receives
+        self.visibility_timeout = visibility_timeout
+
+    def push(self, site, item):
+        self.sqs_client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps({'siteid': site, 'item': item})
+            )
+
+    def receive(self):
+        items = list()
+        for x in range(self.max_receives):
+            response = self.sqs_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                VisibilityTimeout=self.visibility_timeout
+                )
+            messages = response.get('Messages', [])
+            if not messages:
+                break
+            for message in messages:
+                body = json.loads(message['Body'])
+                items.append((body['siteid'], body['item'], message['ReceiptHandle']))
+
+        return items
+
+    def delete(self, handle):
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=handle)
+
+    def release(self, handle):
+        """
+        Make a received item visible again, for the next drain.
+        """
+        self.sqs_client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=handle, VisibilityTimeout=0)
+
+
+class SiteAdmissionController:
+    """
+    Per site token bucket admission control, so one site can't take all of the capacity.
+
+    Each site can start rate jobs per second, with bursts of up to burst jobs.
+    Uploads that aren't admitted are deferred, and drain() admits them later, taking
+    each site in turn. While a site has deferred uploads its new uploads are deferred
+    behind them. That hold runs out after hold seconds unless drain() renews it,
+    so a lost deferral can't block a site for good.
+    """
+
+    def __init__(self, store, queue, rate, burst, hold=120):
+        self.store = store
+        self.queue = queue
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.hold = hold
+
+    def _state_key(self, site):
+        return '{}.json'.format(hashlib.md5(site.encode('utf-8')).hexdigest())
+
+    def admit(self, site, deferred=False):
+        """
+        Take a token for the site, returns True if the upload is admitted.
+        """
+        def take(state):
+            now = time.time()
+            if state is None:
+                state = {'tokens': self.burst, 'updated': now, 'hold': 0}
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+            state['updated'] = now
+
+            if (not deferred and state['hold'] > now) or state['tokens'] < 1:
+                return state, False
+            state['tokens'] -= 1
+            return state, True
+
+        return self.store.update(self._state_key(site), take)
+
+    def _hold(self, site):
+        def hold(state):
+            now = time.time()
+            if state is None:
+                state = {'tokens': self.burst, 'updated': now, 'hold': 0}
+            state['hold'] = now + self.hold
+            return state, None
+
+        self.store.update(self._state_key(site), hold)
+
+    def _clear_hold(self, site, since):
+        def clear(state):
+            # A hold renewed since the drain started is for an upload deferred meanwhile.
+            if state is not None and state['hold'] <= since + self.hold:
+                state['hold'] = 0
+            return state, None
+
+        self.store.update(self._state_key(site), clear)
+
+    def defer(self, site, item):
+        self._hold(site)
+        self.queue.push(site, item)
+
+    def drain(self):
+        """
+        Get the deferred items that can be admitted now as a list of (item, handle),
+        taking sites in turn. Call done() with the handle once an item is processed.
+        Sites left with no deferred items are no longer held.
+        """
+        started = time.time()
+        sites = OrderedDict()
+        for site, item, handle in self.queue.receive():
+            sites.setdefault(site, deque()).append((item, handle))
+
+        admitted = list()
+        while sites:
+            for site in list(sites):
+                if not self.admit(site, deferred=True):
+                    # Out of tokens, the rest of this site's items wait for the next drain.
+                    self._hold(site)
+                    for item, handle in sites.pop(site):
+                        self.queue.release(handle)
+                    continue
+                admitted.append(sites[site].popleft())
+                if not sites[site]:
+                    del sites[site]
+                    self._clear_hold(site, started)
+
+        return admitted
+
+    def done(self, handle):
+        self.queue.delete(handle)
+
+
+_local_admission_store = LocalJsonStore()
+_local_deferral_queue = LocalDeferralQueue()
+
+
+def get_admission_controller(s3_client, sqs_client):
+    """
+    Get the site admission controller set by the SiteAdmission environment variable
+    (off, s3 or local), or None when off. The s3 backend defers uploads to the DeferralQueue SQS queue.
+    """
+    store = get_json_store(s3_client, 'SiteAdmission', 'admission/', _local_admission_store)
+    if store is None:
+        return None
+
+    if store is _local_admission_store:
+        queue = _local_deferral_queue
+    else:
+        queue = SqsDeferralQueue(sqs_client, os.environ.get('DeferralQueue'))
+
+    return SiteAdmissionController(
+        store,
+        queue,
+        rate=float(os.environ.get('SiteAdmissionRate', 10)) / 60,  # Jobs per minute.
+        burst=float(os.environ.get('SiteAdmissionBurst', 20)),
+        hold=int(os.environ.get('SiteAdmissionHold', 120))
+        )
+
+
+# Processes in the order of the processes bitfield Moodle sets in the metadata of each upload.
+PROCESS_BITS = ('TranscribeComplete', 'StartLabelDetection', 'StartContentModeration', 'StartFaceDetection',
+                'StartPersonTracking', 'SentimentComplete', 'PhrasesComplete', 'EntitiesComplete')
+ANALYSIS_PROCESSES = ('SentimentComplete', 'PhrasesComplete', 'EntitiesComplete')
+FINAL_STATES = ('COMPLETED', 'SUCCEEDED', 'ERROR', 'FAILED', 'SKIPPED')
+
+
+def get_expected_processes(processes):
+    """
+    Get the processes that will report for an upload from its processes bitfield.
+    Transcoding always runs, the analyses only run on a transcription.
+    """
+    expected = ['elastic_transcoder'] + [process for process, bit in zip(PROCESS_BITS, processes) if bit == '1']
+    if 'TranscribeComplete' not in expected:
+        expected = [process for process in expected if process not in ANALYSIS_PROCESSES]
+
+    return expected
+
+
+class CompletionTracker:
+    """
+    Tracks the processes of each upload, so Moodle gets one completion message with the
+    outcome of every process instead of a message per process.
+
+    Outcomes for uploads that aren't tracked, or that arrive after the completion
+    was sent, are left to the caller to report on their own.
+    """
+
+    def __init__(self, store, timeout):
+        self.store = store
+        self.timeout = timeout
+
+    def _key(self, key):
+        return key + '.json'
+
+    def start(self, key, siteid, processes):
+        """
+        Start tracking an upload, replacing any earlier tracking of the same key.
+        """
+        document = {
+            'siteid': siteid,
+            'pending': get_expected_processes(processes),
+            'outcomes': {},
+            'started': int(time.time()),
+            'sent': False
+            }
+        self.store.update(self._key(key), lambda current: (document, None))
+
+    def finish(self, key, process, status):
+        """
+        Record the final status of a process.
+
+        Returns (tracked, completion). If tracked is False the caller reports the outcome itself.
+        completion is the message to send when this was the last pending process, it is only returned once.
+        A transcoding error ends every other process too, as they all need its output.
+        """
+        def apply(document):
+            if document is None or document['sent'] or process not in document['pending'] + list(document['outcomes']):
+                return None, (False, None)
+            if process in document['outcomes']:
+                return None, (True, None)  # Already recorded, e.g. a redelivered message.
+
+            document['outcomes'][process] = status
+            document['pending'].remove(process)
+            if process == 'elastic_transcoder' and status == 'ERROR':
+                document['outcomes'].update((pending, 'ERROR') for pending in document['pending'])
+                document['pending'] = []
+
+            return self._complete(key, document)
+
+        return self.store.update(self._key(key), apply)
+
+    def expire(self):
+        """
+        Complete uploads that haven't had an outcome within the timeout, their pending processes time out.
+        Tracking of uploads that completed before then is removed.
+        Returns the completion messages to send.
+        """
+        completions = list()
+        for store_key in self.store.stale(self.timeout):
+            key = store_key[:-len('.json')]
+
+            def apply(document):
+                if document is None or document['sent']:
+                    return None, (False, None)
+                return self._complete(key, document, timed_out=True)
+
+            tracked, completion = self.store.update(store_key, apply)
+            if completion is None:
+                self.store.delete(store_key)
+            else:
+                completions.append(completion)
+
+        return completions
+
+    def _complete(self, key, document, timed_out=False):
+        if document['pending'] and not timed_out:
+            return document, (True, None)
+
+        document['outcomes'].update((pending, 'TIMEOUT') for pending in document['pending'])
+        document['pending'] = []
+        document['sent'] = True
+        completion = {
+            'siteid': document['siteid'],
+            'objectkey': key,
+            'process': 'completion',
+            'status': 'COMPLETED',
+            # The key and start time keep the message unique, Moodle deduplicates on it.
+            'message': {'objectkey': key, 'started': document['started'], 'outcomes': document['outcomes']}
+            }
+
+        return document, (True, completion)
+
+
+_local_completion_store = LocalJsonStore()
+
+
+def get_completion_tracker(s3_client):
+    """
+    Get the completion tracker set by the CompletionTracking environment variable
+    (off, s3 or local), or None when off.
+    """
+    store = get_json_store(s3_client, 'CompletionTracking', 'completion/', _local_completion_store)
+    if store is None:
+        return None
+
+    return CompletionTracker(store, int(os.environ.get('CompletionTimeout', 21600)))
+
+
+def compact_message(process, payload):
+    """
+    Get the compact (schema version 2) form of a status message payload, with only the fields Moodle needs.
+
+    Ids and upstream timestamps are kept, they make each message unique for Moodle's deduplication.
+    Payloads that are already small, like errors, reused results and completions, are kept as they are.
+    """
+    if not isinstance(payload, dict):
+        return payload
+
+    if process == 'S3' and 's3' in payload:
+        s3_object = payload['s3']['object']
+        compact = {
+            'event': payload['eventName'],
+            'size': s3_object.get('size'),
+            'sequencer': s3_object.get('sequencer')
+            }
+    elif process == 'elastic_transcoder' and 'jobId' in payload:
+        outputs = payload.get('outputs', [])
+        error_codes = [output['errorCode'] for output in outputs if 'errorCode' in output]
+        if 'errorCode' in payload:
+            error_codes.append(payload['errorCode'])
+        compact = {
+            'jobid': payload['jobId'],
+            'state': payload['state'],
+            'outputkeys': [output['key'] for output in outputs],
+            'playlists': [playlist['name'] for playlist in payload.get('playlists', [])],
+            'errorcodes': sorted(set(error_codes)),
+            'reusedfrom': payload.get('reusedfrom', {}).get('objectkey')
+            }
+    elif 'JobId' in payload:
+        # Rekognition job notification.
+        compact = {
+            'jobid': payload['JobId'],
+            'status': payload.get('Status'),
+            'errorcode': payload.get('ErrorCode'),
+            'timestamp': payload.get('Timestamp')
+            }
+    else:
+        return payload
+
+    return dict((field, value) for field, value in compact.items() if value not in (None, []))
+
+
+status_s3_client = LazyClient('s3')
+
+
+def get_status_queue(key):
+    """
+    Get the SQS queue url for the status messages of an upload.
+
+    Short lane uploads use the ShortLaneSqsQueue queue when it is set, which Moodle reads first,
+    so their messages aren't held up behind the messages of long media. The upload's HEAD
+    response is normally cached already by the handler sending the message.
+    """
+    short_queue = os.environ.get('ShortLaneSqsQueue')
+    if short_queue:
+        try:
+            head = get_object_head(status_s3_client, os.environ.get('InputBucket'), key)
+            if classify_upload(head) == 'short':
+                return short_queue
+        except Exception as e:
+            logger.error('Failed to get the lane of {}, using the standard status queue: {}'.format(key, e))
+
+    return os.environ.get('SmartmediaSqsQueue')
+
+
+def send_status_message(status_emitter, siteid, key, process, status, payload):
+    """
+    Encode a status message for Moodle and send it to the SQS queue.
+
+    The schema version set by the MessageSchemaVersion environment variable is sent as the
+    schemaversion attribute. Version 1 has the full upstream payload in message, version 2
+    has its compact form. The other fields are the same in both, so either version can be
+    read by consumers that only use them.
+    """
+    message_object = {
+        'siteid': siteid,
+        'objectkey': key,
+        'process': process,
+        'status': status,
+        'message': payload if MESSAGE_SCHEMA_VERSION < 2 else compact_message(process, payload),
+        'timestamp': int(time.time())
+        }
+    separators = None if MESSAGE_SCHEMA_VERSION < 2 else (',', ':')
+
+    # Messages are buffered and sent in batches when the handler exits.
+    status_emitter.send(
+        QueueUrl=get_status_queue(key),
+        MessageBody=json.dumps(message_object, separators=separators),
+        MessageAttributes={
+            'siteid': {
+                'StringValue': siteid,
+                'DataType': 'String'
+            },
+            'inputkey': {
+                'StringValue': key,
+                'DataType': 'String'
+            },
+            'schemaversion': {
+                'StringValue': str(MESSAGE_SCHEMA_VERSION),
+                'DataType': 'Number'
+            },
+        }
+    )
+
+
+def send_completion(status_emitter, completion):
+    """
+    Send a completion message from the tracker to the Moodle SQS queue.
+    """
+    send_status_message(status_emitter, completion['siteid'], completion['objectkey'], completion['process'],
+                        completion['status'], completion['message'])
+
+
+def report_outcome(completion_tracker, status_emitter, key, process, status):
+    """
+    Report the status of a process to the completion tracker, if there is one.
+
+    Returns True if the tracker took care of it, or False if the caller should send its own status message.
+    Progress updates are dropped while tracking, Moodle only acts on final outcomes.
+    """
+    if completion_tracker is None:
+        return False
+    if status not in FINAL_STATES:
+        return True
+
+    tracked, completion = completion_tracker.finish(key, process, status)
+    if completion is not None:
+        send_completion(status_emitter, completion)
+
+    return tracked
+
+
+class IdempotencyStore:
+    """
+    Record of the events that have been handled, so duplicate deliveries can be skipped.
+
+    Events are keyed on (object key, process, job id). An event is claimed before it is handled
+    and marked done after. Other deliveries are skipped while the claim is held, for up to lease
+    seconds, after which the claim can be taken over so an event isn't lost when a handler dies.
+    Done events are remembered for ttl seconds.
+
+    Done events are also cached in memory, so duplicates delivered to a warm container
+    are skipped without a request to the store. Expired records are ignored, the S3 store
+    has a lifecycle rule to delete them.
+    """
+
+    def __init__(self, store, ttl, lease=900, cache_size=1024):
+        self.store = store
+        self.ttl = ttl
+        self.lease = lease
+        self._done = TtlLruCache(max_size=cache_size, ttl=ttl)
+
+    def _key(self, object_key, process, job_id):
+        return '{}/{}/{}.json'.format(object_key, process, job_id)
+
+    def claim(self, object_key, process, job_id):
+        """
+        Claim an event for handling. Returns False if it is a duplicate,
+        that has already been handled or is being handled now.
+        """
+        key = self._key(object_key, process, job_id)
+        if self._done.get(key) is not None:
+            return False
+
+        def take(record):
+            now = time.time()
+            if record is not None and record['expires'] > now:
+                return None, record['status']
+
+            return {'status': 'CLAIMED', 'expires': now + self.lease}, None
+
+        status = self.store.update(key, take)
+        if status == 'DONE':
+            self._done.put(key, True)
+
+        return status is None
+
+    def complete(self, object_key, process, job_id):
+        """
+        Mark a claimed event as handled.
+        """
+        key = self._key(object_key, process, job_id)
+        self.store.update(key, lambda record: ({'status': 'DONE', 'expires': time.time() + self.ttl}, None))
+        self._done.put(key, True)
+
+    def release(self, object_key, process, job_id):
+        """
+        Give up the claim on an event that failed, so its next delivery is handled.
+        """
+        self.store.delete(self._key(object_key, process, job_id))
+
+
+_local_idempotency_store = LocalJsonStore()
+
+
+def get_idempotency_store(s3_client):
+    """
+    Get the idempotency store set by the Idempotency environment variable (off, s3 or local), or None when off.
+    """
+    store = get_json_store(s3_client, 'Idempotency', 'idempotency/', _local_idempotency_store)
+    if store is None:
+        return None
+
+    return IdempotencyStore(
+        store,
+        ttl=int(os.environ.get('IdempotencyTtl', 86400)),
+        lease=int(os.environ.get('IdempotencyLease', 900)),
+        cache_size=int(os.environ.get('IdempotencyCacheSize', 1024))
+        )
+
+
+def run_once(idempotency_store, object_key, process, job_id, func, *args, status_emitter=None):
+    """
+    Call func(*args) to handle an event, unless it is a duplicate delivery.
+    Returns True if func was called.
+
+    With a status_emitter, the event is only marked as handled once the status messages
+    it queued are sent, and its claim is given up if they can't be, so the retry isn't skipped.
+
+    Without an idempotency store every delivery is handled. If the store can't be
+    reached the event is handled anyway, handling it twice is better than not at all.
+    """
+    if idempotency_store is None:
+        func(*args)
+        return True
+
+    try:
+        claimed = idempotency_store.claim(object_key, process, job_id)
+    except Exception as e:
+        logger.error('Failed claiming {} {} for {}: {}'.format(process, job_id, object_key, e))
+        func(*args)
+        return True
+
+    if not claimed:
+        logger.info('Skipping duplicate delivery of {} {} for {}'.format(process, job_id, object_key))
+        return False
+
+    def complete():
+        try:
+            idempotency_store.complete(object_key, process, job_id)
+        except Exception as e:
+            logger.error('Failed completing {} {} for {}: {}'.format(process, job_id, object_key, e))
+
+    def release():
+        try:
+            idempotency_store.release(object_key, process, job_id)
+        except Exception as e:
+            logger.error('Failed releasing {} {} for {}: {}'.format(process, job_id, object_key, e))
+
+    event = status_emitter.start_event() if status_emitter is not None else None
+    try:
+        func(*args)
+    except Exception:
+        release()
+        raise
+    finally:
+        if status_emitter is not None:
+            status_emitter.end_event()
+
+    if status_emitter is None:
+        complete()
+    else:
+        status_emitter.after_flush(complete, release, event)
+
+    return True
+
+
+class StatusEmitter:
+    """
+    Buffers SQS status messages for an invocation and sends them in batches.
+
+    Messages are queued with send() and sent with SendMessageBatch when flush()
+    is called, or when a handler decorated with flush_on_exit() returns.
+    Only the entries that failed inside a batch are retried. Messages that still
+    can't be sent make flush() raise, so the invocation fails and Lambda retries it.
+    Messages queued between start_event() and end_event() belong to that event,
+    so the outcome of each event handled by the invocation is known on its own.
+    """
+
+    def __init__(self, sqs_client):
+        self.sqs_client = sqs_client
+        self._buffer = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()  # The event being handled by each thread.
+
+    def send(self, QueueUrl, MessageBody, MessageAttributes=None):
+        """
+        Queue a message to be sent on the next flush.
+        Takes the same arguments as the SQS client send_message() call.
+        """
+        with self._lock:
+            self._buffer.append({
+                'QueueUrl': QueueUrl,
+                'MessageBody': MessageBody,
+                'MessageAttributes': MessageAttributes or {},
+                'Event': getattr(self._local, 'event', None),
+                })
+
+    def start_event(self):
+        """
+        Start an event in this thread, the messages it queues until end_event() belong to it.
+        Returns the event, for after_flush().
+        """
+        self._local.event = object()
+        return self._local.event
+
+    def end_event(self):
+        self._local.event = None
+
+    def after_flush(self, sent, unsent, event=None):
+        """
+        Call sent() once the next flush has sent every message of the event, or unsent() if it couldn't.
+        Without an event, every message of the flush must have been sent.
+        """
+        with self._lock:
+            self._callbacks.append((sent, unsent, event))
+
+    def flush(self):
+        """
+        Send all buffered messages, grouped by queue, 10 per batch.
+        Every batch is tried, then a RuntimeError is raised if any messages weren't sent.
+        """
+        with self._lock:
+            messages = self._buffer
+            callbacks = self._callbacks
+            self._buffer = []
+            self._callbacks = []
+
+        queues = OrderedDict()
+        for message in messages:
+            queues.setdefault(message['QueueUrl'], []).append(message)
+
+        undelivered = []
+        for queue_url, queue_messages in queues.items():
+            for batch in self._get_batches(queue_messages):
+                try:
+                    undelivered.extend(self._send_batch(queue_url, batch))
+                except Exception as e:
+                    logger.error('Failed sending {} status messages: {}'.format(len(batch), e))
+                    undelivered.extend(batch)
+
+        for sent, unsent, event in callbacks:
+            if any(event is None or message['Event'] is event for message in undelivered):
+                unsent()
+            else:
+                sent()
+
+        if undelivered:
+            raise RuntimeError('Failed sending {} of {} status messages'.format(len(undelivered), len(messages)))
+
+    def _get_message_bytes(self, message):
+        """
+        Get the size of a message as SQS counts it, the body and each attribute's name, type and value.
+        """
+        message_bytes = len(message['MessageBody'].encode('utf-8'))
+        for name, attribute in message['MessageAttributes'].items():
+            value = attribute.get('StringValue', attribute.get('BinaryValue', b''))
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            message_bytes += len(name.encode('utf-8')) + len(attribute['DataType'].encode('utf-8')) + len(value)
+
+        return message_bytes
+
+    def _get_batches(self, messages):
+        """
+        Split messages into batches within the SQS entry count and payload size limits.
+        """
+        batch = []
+        batch_bytes = 0
+        for message in messages:
+            message_bytes = self._get_message_bytes(message)
+            if batch and (len(batch) == SQS_BATCH_SIZE or batch_bytes + message_bytes > SQS_BATCH_BYTES):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(message)
+            batch_bytes += message_bytes
+
+        if batch:
+            yield batch
+
+    def _send_batch(self, queue_url, batch):
+        """
+        Send a batch of messages, returns the messages that couldn't be sent.
+        """
+        entries = dict()
+        for index, message in enumerate(batch):
+            entries[str(index)] = {
+                'Id': str(index),
+                'MessageBody': message['MessageBody'],
+                'MessageAttributes': message['MessageAttributes'],
+                }
+
+        retries = 0
+        undelivered = []
+        while entries:
+            response = self.sqs_client.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=list(entries.values())
+                )
+
+            failed = response.get('Failed', [])
+            if not failed:
+                return undelivered
+
+            # Sender faults will fail again, so only retry the others.
+            retry_entries = dict()
+            for failure in failed:
+                if failure.get('SenderFault'):
+                    logger.error('Failed sending status message: {}'.format(failure))
+                    undelivered.append(batch[int(failure['Id'])])
+                else:
+                    retry_entries[failure['Id']] = entries[failure['Id']]
+
+            entries = retry_entries
+            if not entries:
+                return undelivered
+            if retries >= SQS_BATCH_RETRIES:
+                logger.error('Giving up sending {} status messages after {} retries'.format(len(entries), retries))
+                return undelivered + [batch[int(entry_id)] for entry_id in entries]
+
+            retries += 1
+            time.sleep(0.1 * (2 ** retries))
+
+        return undelivered
+
+    def flush_on_exit(self, handler):
+        """
+        Decorator that flushes buffered messages when a Lambda handler exits.
+        """
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            try:
+                return handler(event, context)
+            finally:
+                self.flush()
+
+        return wrapper
+
+
+class S3MultipartWriter:
+    """
+    File like writer that streams data to an S3 object using a multipart upload.
+
+    At most one part is held in memory. Objects smaller than a single part
+    are written with a plain put_object call instead.
+    Used as a context manager, the upload is completed on success and aborted on error.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=8 * 1024 * 1024, background=False, **put_args):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.put_args = put_args
+        self.upload_id = None
+        self.parts = list()
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._part_count = 0
+        # With background uploads one part is sent while the caller produces the next.
+        self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self._pending = None
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        self._sha256.update(data)
+        while len(self._buffer) >= self.part_size:
+            # Slicing the view copies the part once, a slice of the buffer would be copied again.
+            with memoryview(self._buffer) as view:
+                part = bytes(view[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._upload_part(part)
+
+    @property
+    def checksum(self):
+        """
+        SHA-256 of everything written so far.
+        """
+        return self._sha256.hexdigest()
+
+    def _upload_part(self, part):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                **self.put_args
+                )
+            self.upload_id = response['UploadId']
+
+        self._part_count += 1
+        if self._executor is None:
+            self._send_part(self._part_count, part)
+        else:
+            self._wait_pending()
+            self._pending = self._executor.submit(self._send_part, self._part_count, part)
+
+    def _send_part(self, part_number, part):
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=part
+            )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def _wait_pending(self):
+        """
+        Wait for the part in flight, raising any error from its upload.
+        """
+        if self._pending is not None:
+            pending = self._pending
+            self._pending = None
+            pending.result()
+
+    def close(self):
+        """
+        Write any remaining data and complete the upload.
+        """
+        if self.upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self._buffer),
+                **self.put_args
+                )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self._wait_pending()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])}
+                )
+        self._buffer = bytearray()
+        self._shutdown()
+
+    def abort(self):
+        """
+        Abort the upload, so no partial object or orphaned parts are left behind.
+        """
+        try:
+            self._wait_pending()
+        except Exception as e:
+            logger.error('Failed uploading part of {}: {}'.format(self.key, e))
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id
+                )
+        self._buffer = bytearray()
+        self._shutdown()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class CompressingWriter:
+    """
+    File like writer that compresses everything written to it into another writer, usually an S3MultipartWriter.
+    Compression is streamed, so only the compressor's own state is held in memory.
+    Used as a context manager, the underlying writer is closed on success and aborted on error.
+    """
+
+    def __init__(self, writer, encoding='gzip', level=None):
+        self.writer = writer
+        self.encoding = encoding
+        level = COMPRESSION_LEVELS[encoding] if level is None else level
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            # With a gzip header.
+            self._compressor = zlib.compressobj(min(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.size = 0  # Uncompressed.
+        self._sha256 = hashlib.sha256()
+
+    @property
+    def checksum(self):
+        """
+        SHA-256 of everything written so far, before compression.
+        """
+        return self._sha256.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        self._sha256.update(data)
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+
+    def close(self):
+        self.writer.write(self._compressor.flush())
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def decompress_lines(chunks):
+    """
+    Split a metadata file into lines, decompressing it on the way if it was written compressed.
+
+    Chunks can be any iterable of bytes or str, such as a file or a streamed S3 body.
+    The compression is detected from the first bytes, so the Content-Encoding isn't needed.
+    Lines are yielded as str, without the line break.
+    """
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk.encode('UTF-8') if isinstance(chunk, str) else chunk
+        if len(head) >= len(ZSTD_MAGIC):
+            break
+
+    if head.startswith(GZIP_MAGIC):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif head.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError('zstandard is not available to decompress a zstd metadata file')
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = None
+
+    buffered = b''
+    chunk = head
+    while chunk is not None:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('UTF-8')
+        buffered += decompressor.decompress(chunk) if decompressor is not None else chunk
+        lines = buffered.split(b'\n')
+        buffered = lines.pop()
+        for line in lines:
+            yield line.decode('UTF-8')
+        chunk = next(chunks, None)
+
+    if decompressor is not None:
+        buffered += decompressor.flush()
+    for line in buffered.split(b'\n') if buffered else []:
+        yield line.decode('UTF-8')
+
+
+def get_metadata_writer(s3_client, bucket, key, content_type='application/json', background=False):
+    """
+    Get a writer for a metadata file, compressed as set by the MetadataCompression environment variable.
+
+    The key and content type are the same whether it is compressed or not, only the Content-Encoding differs.
+    zstd needs the zstandard module, without it gzip is used instead.
+    """
+    encoding = METADATA_COMPRESSION
+    if encoding == 'zstd' and zstandard is None:
+        logger.warning('zstandard is not available, compressing {} with gzip'.format(key))
+        encoding = 'gzip'
+
+    if encoding not in COMPRESSION_LEVELS:
+        return S3MultipartWriter(s3_client, bucket, key, background=background, ContentType=content_type)
+
+    writer = S3MultipartWriter(s3_client, bucket, key, background=background,
+                               ContentType=content_type, ContentEncoding=encoding)
+    level = int(METADATA_COMPRESSION_LEVEL) if METADATA_COMPRESSION_LEVEL else None
+
+    return CompressingWriter(writer, encoding, level)
+
+
+class ProcessManifest:
+    """
+    The manifest.json of an input object in the output bucket.
+
+    It lists everything made for the object in sections: renditions and playlists from
+    the transcode jobs, the files in conversions/ and the files in metadata/. Moodle can
+    learn the full state of a conversion from it with a single GET.
+    Updates are atomic read-modify-writes of the store.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def _key(self, object_key):
+        return '{}/manifest.json'.format(object_key)
+
+    def get(self, object_key):
+        """
+        Get the manifest of an object, or None if nothing was recorded for it yet.
+        """
+        return self.store.get(self._key(object_key))
+
+    def update(self, object_key, sections, replace=()):
+        """
+        Add or replace entries in sections of the manifest, given as section => {name: entry}.
+        Sections named in replace are replaced as a whole, for sections that are a full listing.
+        """
+        def apply(document):
+            document = document or {'version': MANIFEST_VERSION, 'objectkey': object_key}
+            for section, entries in sections.items():
+                if section in replace:
+                    document[section] = dict(entries)
+                else:
+                    document.setdefault(section, {}).update(entries)
+            document['updated'] = int(time.time())
+            return document, None
+
+        self.store.update(self._key(object_key), apply)
+
+
+_local_manifest_store = LocalJsonStore()
+
+
+def get_manifest(s3_client):
+    """
+    Get the manifest set by the Manifest environment variable (off, s3 or local), or None when off.
+    """
+    store = get_json_store(s3_client, 'Manifest', '', _local_manifest_store)
+    if store is None:
+        return None
+
+    return ProcessManifest(store)
+
+
+def describe_artifact(writer, process, format_name, format_version=1):
+    """
+    Get the manifest entry of a metadata file from the writer it was written with.
+    Size and checksum are of the content, before any compression.
+    """
+    entry = {
+        'process': process,
+        'size': writer.size,
+        'sha256': writer.checksum,
+        'format': format_name,
+        'formatversion': format_version,
+        'completed': int(time.time()),
+        }
+    if isinstance(writer, CompressingWriter):
+        entry['contentencoding'] = writer.encoding
+        entry['storedsize'] = writer.writer.size
+
+    return entry
+
+
+def record_artifacts(s3_client, object_key, artifacts):
+    """
+    Record metadata files in the manifest of an object, if manifests are on.
+    artifacts is a dict of file name => entry from describe_artifact.
+    Failing to record is logged, the files themselves are still there.
+    """
+    manifest = get_manifest(s3_client)
+    if manifest is None or not artifacts:
+        return
+
+    try:
+        manifest.update(object_key, {'metadata': artifacts})
+    except Exception as e:
+        logger.error('Failed recording {} in the manifest of {}: {}'.format(', '.join(artifacts), object_key, e))
@@ -17,129 +17,432 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-import boto3
-import botocore
 import os
 import logging
-import io
 import json
-import time
-from botocore.exceptions import ClientError
-from datetime import datetime
+import re
+from collections import OrderedDict
+from lambda_common import LazyClient, StatusEmitter, ThrottledPaginator, ThrottleMetrics, TokenBucket, \
+    decompress_lines, describe_artifact, get_completion_tracker, get_idempotency_store, get_metadata_writer, \
+    get_object_metadata, record_artifacts, record_finished_process, report_outcome, run_once, send_status_message
 
 logger = logging.getLogger()
 
-# Get clients and resources.
-s3_client = boto3.client('s3')
-sqs_client = boto3.client('sqs')
-s3_resource = boto3.resource('s3')
-rekognition_client = boto3.client('rekognition')
+# Get clients, these are built on first use.
+s3_client = LazyClient('s3')
+sqs_client = LazyClient('sqs')
+# The paginator does its own backoff, so botocore doesn't retry, or throttling would be hidden from it.
+# It retries transient server and connection failures as well, which botocore would otherwise have retried.
+rekognition_client = LazyClient('rekognition', retries={'mode': 'standard', 'max_attempts': 1})
+status_emitter = StatusEmitter(sqs_client)
+completion_tracker = get_completion_tracker(s3_client)
+idempotency_store = get_idempotency_store(s3_client)
 
 # Some exceptions are expected and when we get them we just want to retry.
 RETRY_EXCEPTIONS = ('ProvisionedThroughputExceededException',
                     'ThrottlingException')
 MAX_RETRIES = 8
 
-
-def get_detection_results(job_id, method, sort, result_key):
+# Rekognition Get* calls made by this container are limited to this rate,
+# throttling is counted so it shows up in the logs.
+get_results_bucket = TokenBucket(float(os.environ.get('RekognitionGetRate', 5)))
+throttle_metrics = ThrottleMetrics()
+
+# Label results that can be compacted into intervals, result key => label field.
+COMPACTABLE_RESULTS = {
+    'Labels': 'Label',
+    'ModerationLabels': 'ModerationLabel',
+    }
+
+# Tracking results that can be stored in the compact track encoding, result key => detection field.
+TRACK_RESULTS = {
+    'Faces': 'Face',
+    'Persons': 'Person',
+    }
+TRACK_FORMAT_VERSION = 1
+FACE_POSE_FIELDS = ('Roll', 'Yaw', 'Pitch')
+BOX_FIELDS = ('Left', 'Top', 'Width', 'Height')
+TRACK_BLOCK_PREFIX = re.compile(r'^\{"track": (-?\d+), "start": (-?\d+), "end": (-?\d+)')
+
+
+def get_detection_results(job_id, method, sort):
     """
     Get the results returned by a Rekognition start detection calls.
+    Results are yielded a page at a time, so the full result set is never held in memory.
     """
+    method_args = {
+        'JobId': job_id,
+        'MaxResults': 1000,  # Get 1000 results at a time, max is 1000.
+        }
+    if sort != '':
+        method_args['SortBy'] = sort
 
-    next_token = ''
-    video_metadata = {}
-    labels = list()  # List to hold returned labels.
-    retries = 1
+    paginator = ThrottledPaginator(getattr(rekognition_client, method), get_results_bucket, throttle_metrics,
+                                   max_retries=MAX_RETRIES, codes=RETRY_EXCEPTIONS)
 
-    getter_method = getattr(rekognition_client, method)
+    return paginator.pages(**method_args)
 
-    while True:
-        method_args = {
-            'JobId': job_id,
-            'MaxResults': 1000,  # Get 1000 results at a time, max is 1000.
-            'NextToken': next_token,
-            }
-        if sort != '':
-            method_args['SortBy'] = sort
 
-        # Get results from Rekognition.
-        try:
-            results = getter_method(**method_args)
+def write_detection_results(pages, result_key, writer):
+    """
+    Write Rekognition result pages to a writer as they arrive.
 
-            labels += results[result_key]  # Append the labels to the list.
-            video_metadata = results['VideoMetadata']
+    The output is the same json document as building the whole result in memory:
+    {"metadata": <video metadata>, "labels": [<results>]}
+    """
+    started = False  # Has the document header been written.
+    separator = ''  # Separator to write before the next result.
+    for page in pages:
+        if not started:
+            writer.write('{{"metadata": {}, "labels": ['.format(json.dumps(page['VideoMetadata'])).encode('UTF-8'))
+            started = True
+        if page[result_key]:
+            items = ', '.join(json.dumps(item) for item in page[result_key])
+            writer.write((separator + items).encode('UTF-8'))
+            separator = ', '
+
+    if not started:
+        writer.write(b'{"metadata": {}, "labels": [')
+    writer.write(b']}')
+
+
+class LabelIntervalCompactor:
+    """
+    Merges consecutive detections of the same label into intervals.
 
-            # Check if we have more results to get.
-            if 'NextToken' in results:
-                next_token = results['NextToken']
-            else:
-                next_token = ''
-
-        except ClientError as err:
-            if err.response['Error']['Code'] not in RETRY_EXCEPTIONS:
-                raise
-            logging.error('Rate limiting hit!, retries={}'.format(retries))
-            if retires < MAX_RETRIES:
-                sleep(2 ** retries)
-                retries += 1  # TODO max limit.
-                continue  # Try again
+    Detections of a label no more than gap milliseconds apart are merged into
+    one [start, end, max_confidence, count] interval.
+    Pages must be added in timestamp order.
+    """
+
+    def __init__(self, result_key, gap=1000):
+        self.result_key = result_key
+        self.label_field = COMPACTABLE_RESULTS[result_key]
+        self.gap = gap
+        self.metadata = {}
+        self.intervals = dict()  # Label name => list of intervals.
+
+    def add_page(self, page):
+        self.metadata = page['VideoMetadata']
+        for item in page[self.result_key]:
+            label = item[self.label_field]
+            timestamp = item['Timestamp']
+            confidence = label['Confidence']
+            intervals = self.intervals.setdefault(label['Name'], list())
+
+            if intervals and timestamp - intervals[-1][1] <= self.gap:
+                interval = intervals[-1]
+                interval[1] = timestamp
+                interval[2] = max(interval[2], confidence)
+                interval[3] += 1
             else:
-                break
+                intervals.append([timestamp, timestamp, confidence, 1])
 
-        if next_token == '':  # Only continue to try and get more results if there is a valid next token.
-            break
+    def get_result(self):
+        return {
+            'metadata': self.metadata,
+            'gap': self.gap,
+            'labels': self.intervals
+            }
 
-    result_data = {
-        'metadata': video_metadata,
-        'labels': labels
-        }
 
-    return result_data
+def compact_pages(pages, compactor):
+    """
+    Pass result pages through, adding each one to the compactor on the way.
+    """
+    for page in pages:
+        compactor.add_page(page)
+        yield page
+
+
+class TrackEncoder:
+    """
+    Writes face and person tracking results in a compact columnar encoding.
+
+    The output is JSON Lines. The first line is a header with the video metadata,
+    the following lines are blocks of up to block_size detections of one track
+    (the person index, faces are a single track) holding:
+    - start and end: the first and last timestamp in the block;
+    - t: timestamps delta encoded from the block start;
+    - box: bounding box columns quantized to integers on a grid x grid raster;
+    - confidence: confidence in hundredths;
+    - pose and landmarks (faces only): pose in tenths of a degree and
+      quantized landmark coordinates.
+    Missing values are null. Other face attributes are not kept.
+    """
+
+    def __init__(self, result_key, writer, grid=10000, block_size=256):
+        self.result_key = result_key
+        self.detection_field = TRACK_RESULTS[result_key]
+        self.writer = writer
+        self.grid = grid
+        self.block_size = block_size
+        self.started = False
+        self._blocks = dict()  # Track id => list of detections not yet written.
+        self._last_track = None
+
+    def add_page(self, page):
+        if not self.started:
+            self._write_header(page['VideoMetadata'])
+        for item in page[self.result_key]:
+            detection = item[self.detection_field]
+            track = detection.get('Index', 0)
+            # Persons are sorted by index, so once a new track starts the previous one is complete.
+            if track != self._last_track and self._last_track in self._blocks:
+                self._write_block(self._last_track, self._blocks.pop(self._last_track))
+            self._last_track = track
+            block = self._blocks.setdefault(track, list())
+            block.append((item['Timestamp'], detection))
+            if len(block) == self.block_size:
+                self._write_block(track, self._blocks.pop(track))
+
+    def close(self):
+        if not self.started:
+            self._write_header({})
+        for track in sorted(self._blocks):
+            self._write_block(track, self._blocks[track])
+        self._blocks = dict()
+
+    def _write_header(self, metadata):
+        header = {
+            'format': 'smartmedia-tracks',
+            'version': TRACK_FORMAT_VERSION,
+            'type': self.result_key,
+            'grid': self.grid,
+            'metadata': metadata,
+            }
+        self.writer.write((json.dumps(header) + '\n').encode('UTF-8'))
+        self.started = True
+
+    def _quantize(self, value, scale):
+        return None if value is None else int(round(value * scale))
+
+    def _write_block(self, track, detections):
+        timestamps = [timestamp for timestamp, detection in detections]
+        # Track, start and end come first so readers can skip blocks without parsing them.
+        block = OrderedDict([
+            ('track', track),
+            ('start', timestamps[0]),
+            ('end', timestamps[-1]),
+            ('t', [timestamp - previous for timestamp, previous in zip(timestamps, [timestamps[0]] + timestamps)]),
+            ])
+
+        boxes = [detection.get('BoundingBox', {}) for timestamp, detection in detections]
+        block['box'] = {
+            field.lower(): [self._quantize(box.get(field), self.grid) for box in boxes] for field in BOX_FIELDS
+            }
+        block['confidence'] = [self._quantize(detection.get('Confidence'), 100) for timestamp, detection in detections]
+
+        if self.detection_field == 'Face':
+            poses = [detection.get('Pose', {}) for timestamp, detection in detections]
+            block['pose'] = {
+                field.lower(): [self._quantize(pose.get(field), 10) for pose in poses] for field in FACE_POSE_FIELDS
+                }
+
+            landmarks = [
+                {landmark['Type']: landmark for landmark in detection.get('Landmarks', [])}
+                for timestamp, detection in detections
+                ]
+            types = sorted(set(landmark_type for frame in landmarks for landmark_type in frame))
+            block['landmarks'] = {
+                landmark_type: {
+                    axis.lower(): [
+                        self._quantize(frame.get(landmark_type, {}).get(axis), self.grid) for frame in landmarks
+                        ]
+                    for axis in ('X', 'Y')
+                    }
+                for landmark_type in types
+                }
+
+        self.writer.write((json.dumps(block) + '\n').encode('UTF-8'))
+
+
+def read_tracks(lines, start=None, end=None):
+    """
+    Decode detections from the compact track encoding, optionally limited to a time range in milliseconds.
+
+    Lines can be any iterable of the file's lines or chunks, such as a file or a streamed S3 body,
+    compressed or not as decompress_lines() detects the compression.
+    Blocks outside the time range are skipped without being parsed.
+    Yields (track, timestamp, detection) with values restored to their original units.
+    """
+    lines = decompress_lines(lines)
+    header = json.loads(next(lines))
+    grid = header['grid']
+
+    def restore(value, scale):
+        return None if value is None else value / scale
+
+    for line in lines:
+        prefix = TRACK_BLOCK_PREFIX.match(line)
+        if prefix is None:
+            continue
+        block_start, block_end = int(prefix.group(2)), int(prefix.group(3))
+        if (start is not None and block_end < start) or (end is not None and block_start > end):
+            continue
+
+        block = json.loads(line)
+        timestamp = block['start']
+        for index, delta in enumerate(block['t']):
+            timestamp += delta
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+
+            detection = {
+                'BoundingBox': {field: restore(block['box'][field.lower()][index], grid) for field in BOX_FIELDS},
+                'Confidence': restore(block['confidence'][index], 100),
+                }
+            if 'pose' in block:
+                detection['Pose'] = {
+                    field: restore(block['pose'][field.lower()][index], 10) for field in FACE_POSE_FIELDS
+                    }
+            if 'landmarks' in block:
+                detection['Landmarks'] = [
+                    {'Type': landmark_type, 'X': restore(axes['x'][index], grid), 'Y': restore(axes['y'][index], grid)}
+                    for landmark_type, axes in block['landmarks'].items()
+                    if axes['x'][index] is not None
+                    ]
+
+            yield block['track'], timestamp, detection
+
+
+def load_tracks(output_bucket, object_key, result_key, start=None, end=None):
+    """
+    Stream the detections of a tracks file in the output S3 bucket, see read_tracks().
+    """
+    tracks_key = '{}/metadata/{}.tracks.jsonl'.format(object_key, result_key)
+    response = s3_client.get_object(Bucket=output_bucket, Key=tracks_key)
+
+    return read_tracks(response['Body'].iter_chunks(), start, end)
 
 
 def sqs_send_message(input_key, message_status, sns_message_object, rekognition_type):
-    # Get environvent variables
-    input_bucket = os.environ.get('InputBucket')  # Ouput S3 bucket
-    sqs_url = os.environ.get('SmartmediaSqsQueue')  # SQS queue URL.
+    # Tracked uploads get a single completion message instead.
+    if report_outcome(completion_tracker, status_emitter, input_key, rekognition_type, message_status):
+        return
 
     # Get input object metadata as we will need for SQS message sending.
-    input_object_headdata_object = s3_client.head_object(
-        Bucket=input_bucket,
-        Key=input_key
-        )
-
-    # Create JSON message to send to SQS queue.
-
-    now = datetime.now()  # Current date and time.
-
-    message_object = {
-        'siteid' : input_object_headdata_object['Metadata']['siteid'],
-        'objectkey' : input_key,
-        'process': rekognition_type,
-        'status': message_status,
-        'message': sns_message_object,
-        'timestamp': int(datetime.timestamp(now))
-        }
-    message_json = json.dumps(message_object)
+    metadata = get_object_metadata(s3_client, os.environ.get('InputBucket'), input_key)
 
     # Send message to SQS queue, we do this from Lambda not directly from sns,
     # as we want to add some extra information to the message.
-    sqs_client.send_message(
-        QueueUrl=sqs_url,
-        MessageBody=message_json,
-        MessageAttributes={
-            'siteid': {
-                'StringValue': input_object_headdata_object['Metadata']['siteid'],
-                'DataType': 'String'
-            },
-            'inputkey': {
-                'StringValue': input_key,
-                'DataType': 'String'
-            },
-        }
-    )
+    send_status_message(status_emitter, metadata['siteid'], input_key, rekognition_type, message_status,
+                        sns_message_object)
+
 
+def store_detection_results(job_id, method, sort, result_key, output_bucket, object_key, process):
+    """
+    Stream Rekognition results to the output S3 bucket as json files.
 
+    Label results can also be compacted into intervals, and face and person results
+    stored in the compact track encoding, as set by the LabelCompaction and TrackEncoding
+    environment variables. Intervals are written alongside or instead of the raw results.
+    Tracks are always written alongside them, as Moodle only reads the raw results.
+    Returns the manifest entries of the files written, by file name.
+    """
+    if result_key in COMPACTABLE_RESULTS:
+        mode = os.environ.get('LabelCompaction', 'off')
+    elif result_key in TRACK_RESULTS:
+        mode = 'alongside' if os.environ.get('TrackEncoding', 'off') != 'off' else 'off'
+    else:
+        mode = 'off'
+
+    pages = get_detection_results(job_id, method, sort)  # Get detected data.
+    compactor = None
+    track_writer = None
+    artifacts = dict()
+
+    if mode != 'off' and result_key in COMPACTABLE_RESULTS:
+        compactor = LabelIntervalCompactor(result_key, int(os.environ.get('LabelCompactionGap', 1000)))
+        pages = compact_pages(pages, compactor)
+    elif mode != 'off':
+        tracks_key = '{}/metadata/{}.tracks.jsonl'.format(object_key, result_key)
+        track_writer = get_metadata_writer(s3_client, output_bucket, tracks_key, 'application/x-ndjson',
+                                           background=True)
+        compactor = TrackEncoder(result_key, track_writer, int(os.environ.get('TrackEncodingGrid', 10000)))
+        pages = compact_pages(pages, compactor)
+
+    try:
+        if mode == 'instead':
+            for page in pages:
+                pass  # Pages are only needed by the compactor.
+            compacted_key = '{}/metadata/{}.json'.format(object_key, result_key)
+        else:
+            # Each page is uploaded while the next one is being fetched.
+            output_key = '{}/metadata/{}.json'.format(object_key, result_key)
+            with get_metadata_writer(s3_client, output_bucket, output_key, background=True) as writer:
+                write_detection_results(pages, result_key, writer)
+            artifacts['{}.json'.format(result_key)] = describe_artifact(writer, process, 'rekognition-results')
+            compacted_key = '{}/metadata/{}.intervals.json'.format(object_key, result_key)
+    except Exception:
+        if track_writer is not None:
+            track_writer.abort()
+        raise
+
+    if track_writer is not None:
+        compactor.close()
+        track_writer.close()
+        artifacts['{}.tracks.jsonl'.format(result_key)] = describe_artifact(
+            track_writer, process, 'tracks', TRACK_FORMAT_VERSION)
+    elif compactor is not None:
+        with get_metadata_writer(s3_client, output_bucket, compacted_key) as writer:
+            writer.write(json.dumps(compactor.get_result()).encode('UTF-8'))
+        artifacts[compacted_key.rsplit('/', 1)[1]] = describe_artifact(writer, process, 'label-intervals')
+
+    return artifacts
+
+
+def process_notification(sns_message_object):
+    """
+    Handle one Rekognition job notification.
+    """
+    job_id = sns_message_object['JobId']
+    rekognition_type = sns_message_object['API']
+    message_status = sns_message_object['Status']  # Get message status
+
+    output_bucket = sns_message_object['Video']['S3Bucket']
+    object_name = sns_message_object['Video']['S3ObjectName']
+    object_key = object_name.split('/', 1)[0]
+    result_key = ''
+
+    # Only process Rekognition tasks if job status is successful.
+    if message_status == 'SUCCEEDED':
+
+        if rekognition_type == 'StartLabelDetection':
+            logger.info('Getting label detection results')
+            method = 'get_label_detection'
+            sort = 'TIMESTAMP'
+            result_key = 'Labels'
+
+        elif rekognition_type == 'StartContentModeration':
+            logger.info('Getting label moderation results')
+            method = 'get_content_moderation'
+            sort = 'TIMESTAMP'
+            result_key = 'ModerationLabels'
+
+        elif rekognition_type == 'StartFaceDetection':
+            logger.info('Getting face detection results')
+            method = 'get_face_detection'
+            sort = ''
+            result_key = 'Faces'
+
+        elif rekognition_type == 'StartPersonTracking':
+            logger.info('Getting person tracking results')
+            method = 'get_person_tracking'
+            sort = 'INDEX'
+            result_key = 'Persons'
+
+        if result_key != '':
+            artifacts = store_detection_results(
+                job_id, method, sort, result_key, output_bucket, object_key, rekognition_type)
+            record_artifacts(s3_client, object_key, artifacts)
+            record_finished_process(s3_client, os.environ.get('InputBucket'), object_key,
+                                    rekognition_type, message_status, sns_message_object)
+
+    sqs_send_message(object_key, message_status, sns_message_object, rekognition_type)  # Send message to SQS queue.
+
+
+@status_emitter.flush_on_exit
 def lambda_handler(event, context):
     """
     lambda_handler is the entry point that is invoked when the lambda function is called,
@@ -152,56 +455,20 @@ def lambda_handler(event, context):
     #  Set logging
     logging_level = os.environ.get('LoggingLevel', logging.ERROR)
     logger.setLevel(int(logging_level))
+    throttle_metrics.reset()
 
     for record in event['Records']:
         sns_message_json = record['Sns']['Message']
         sns_message_object = json.loads(sns_message_json)
-        job_id = sns_message_object['JobId']
-        rekognition_type = sns_message_object['API']
-        message_status = sns_message_object['Status']  # Get message status
-
-        labels = list()  # List to hold returned labels.
-        output_bucket = sns_message_object['Video']['S3Bucket']
-        object_name = sns_message_object['Video']['S3ObjectName']
-        object_key = object_name.split('/', 1)[0]
-        result_key = ''
-
-        # Only process Rekognition tasks if job status is successful.
-        if message_status == 'SUCCEEDED':
-
-            if rekognition_type == 'StartLabelDetection':
-                logger.info('Getting label detection results')
-                method = 'get_label_detection'
-                sort = 'TIMESTAMP'
-                result_key = 'Labels'
-                label_results = get_detection_results(job_id, method, sort, result_key)  # Get detected label data.
-
-            elif rekognition_type == 'StartContentModeration':
-                logger.info('Getting label moderation results')
-                method = 'get_content_moderation'
-                sort = 'TIMESTAMP'
-                result_key = 'ModerationLabels'
-                label_results = get_detection_results(job_id, method, sort, result_key)  # Get detected moderation data.
-
-            elif rekognition_type == 'StartFaceDetection':
-                logger.info('Getting face detection results')
-                method = 'get_face_detection'
-                sort = ''
-                result_key = 'Faces'
-                label_results = get_detection_results(job_id, method, sort, result_key)  # Get detected face data.
-
-            elif rekognition_type == 'StartPersonTracking':
-                logger.info('Getting person tracking results')
-                method = 'get_person_tracking'
-                sort = 'INDEX'
-                result_key = 'Persons'
-                label_results = get_detection_results(job_id, method, sort, result_key)  # Get detected person data.
-
-            if result_key != '':
-                # Put detected labels in output S3 bucket as json file.
-                s3_object = s3_resource.Object(output_bucket, '{}/metadata/{}.json'.format(object_key, result_key))
-                s3_object.put(
-                    Body=(bytes(json.dumps(label_results).encode('UTF-8')))
-                )
-
-        sqs_send_message(object_key, message_status, sns_message_object, rekognition_type)  # Send message to SQS queue.
+        object_key = sns_message_object['Video']['S3ObjectName'].split('/', 1)[0]
+
+        # A redelivered notification would get and store all the results again.
+        run_once(idempotency_store, object_key, sns_message_object['API'], sns_message_object['JobId'],
+                 process_notification, sns_message_object, status_emitter=status_emitter)
+
+    # Report how much this invocation was throttled fetching results.
+    metrics = throttle_metrics.snapshot()
+    if metrics['throttled']:
+        logger.warning('Rekognition get results throttling: {}'.format(metrics))
+    else:
+        logger.info('Rekognition get results: {}'.format(metrics))
@@ -17,53 +17,116 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-import boto3
-import botocore
 import json
 import os
 import logging
-import urllib3
-from botocore.exceptions import ClientError
+import time
+from lambda_common import LazyClient, backoff_delay, client_registry, get_error_code
 
-et_client = boto3.client('elastictranscoder')
+et_client = LazyClient('elastictranscoder')
+lambda_client = LazyClient('lambda')
 logger = logging.getLogger()
 
+TRIGGER_UPDATE_ATTEMPTS = 10  # Tries at updating the trigger function, other updates of it can get in first.
+
+
+def create_pipeline(event, name):
+    '''
+    Create one Elastictranscoder pipeline, returns its ID.
+    '''
+    request = et_client.create_pipeline(
+        Name=name,
+        InputBucket=event['ResourceProperties']['InputBucket'],
+        OutputBucket=event['ResourceProperties']['OutputBucket'],
+        Role=event['ResourceProperties']['Role'],
+        Notifications={
+            'Progressing': event['ResourceProperties']['Notifications']['Progressing'],
+            'Completed': event['ResourceProperties']['Notifications']['Completed'],
+            'Warning': event['ResourceProperties']['Notifications']['Warning'],
+            'Error': event['ResourceProperties']['Notifications']['Error'],
+        }
+    )
+
+    logger.info('Created Pipeline with ID: {}'.format(request['Pipeline']['Id']))
+
+    return request['Pipeline']['Id']
+
+
+def set_trigger_pipelines(event, pipeline_ids):
+    '''
+    Point the function set by the TriggerFunction property at a pipeline pool,
+    by setting its TriggerVariable environment variable to the pool's IDs.
+
+    The pool is created after the function, so its IDs can't be in the function's environment
+    in the stack template. Setting them here keeps the function on the pool when an update replaces it.
+    '''
+    properties = event['ResourceProperties']
+    function_name = properties.get('TriggerFunction')
+    if not function_name:
+        return
+
+    for attempt in range(TRIGGER_UPDATE_ATTEMPTS):
+        configuration = lambda_client.get_function_configuration(FunctionName=function_name)
+        variables = configuration.get('Environment', {}).get('Variables', {})
+        variables[properties['TriggerVariable']] = ','.join(pipeline_ids)
+        try:
+            # The revision makes this fail instead of overwriting a concurrent update.
+            lambda_client.update_function_configuration(
+                FunctionName=function_name,
+                Environment={'Variables': variables},
+                RevisionId=configuration['RevisionId']
+            )
+        except Exception as e:
+            if get_error_code(e) not in ('PreconditionFailedException', 'ResourceConflictException'):
+                raise
+            logger.info('Function {} is being updated, trying again: {}'.format(function_name, e))
+            time.sleep(backoff_delay(attempt, 1, 10))
+            continue
+
+        logger.info('Set {} of {} to {}'.format(properties['TriggerVariable'], function_name, ','.join(pipeline_ids)))
+        return
+
+    raise RuntimeError('Failed setting {} of {}'.format(properties['TriggerVariable'], function_name))
+
 
 def create(event):
     '''
-    Create the Elastictranscoder pipline.
+    Create the Elastictranscoder pipline pool.
+    The pool size is set by the PipelineCount property, the first pipeline keeps the plain name.
+    The trigger function is then pointed at the pool, see set_trigger_pipelines().
     '''
     logger.info('Creating Pipeline for request: {}'.format(event['RequestId']))
+    name = event['ResourceProperties']['Name']
+    pipeline_count = int(event['ResourceProperties'].get('PipelineCount', 1))
+    pipeline_ids = []
     try:
-        request = et_client.create_pipeline(
-            Name=event['ResourceProperties']['Name'],
-            InputBucket=event['ResourceProperties']['InputBucket'],
-            OutputBucket=event['ResourceProperties']['OutputBucket'],
-            Role=event['ResourceProperties']['Role'],
-            Notifications={
-                'Progressing': event['ResourceProperties']['Notifications']['Progressing'],
-                'Completed': event['ResourceProperties']['Notifications']['Completed'],
-                'Warning': event['ResourceProperties']['Notifications']['Warning'],
-                'Error': event['ResourceProperties']['Notifications']['Error'],
-            }
-        )
-
-        logger.info('Created Pipeline with ID: {}'.format(request['Pipeline']['Id']))
+        for x in range(pipeline_count):
+            pipeline_ids.append(create_pipeline(event, name if x == 0 else '{}-{}'.format(name, x)))
+        set_trigger_pipelines(event, pipeline_ids)
 
         status = 'SUCCESS'
         response = {
             'action': 'create',
-            'physicalresourceid': request['Pipeline']['Id'],
-            'pipelineid' : request['Pipeline']['Id']
+            'physicalresourceid': ','.join(pipeline_ids),
+            'pipelineid' : pipeline_ids[0],
+            'pipelineids' : ','.join(pipeline_ids)
         }
     except Exception as e:
         logger.error(e)
 
+        # Don't leave part of a pool behind.
+        for pipeline_id in pipeline_ids:
+            try:
+                et_client.delete_pipeline(Id=pipeline_id)
+            except Exception as e:
+                logger.error(e)
+
         status = 'FAILED'
         response = {
             'action': 'create',
             'physicalresourceid': status,
-            'pipelineid' : status
+            'pipelineid' : status,
+            'pipelineids' : status
         }
 
     return [status, response]
@@ -71,33 +134,51 @@ def create(event):
 
 def delete(event):
     '''
-    Delete the Elastictranscoder pipline.
+    Delete the Elastictranscoder pipline pool.
     '''
     logger.info('Deleting Pipeline for request: {}'.format(event['RequestId']))
 
-    try:
-        response = et_client.delete_pipeline(
-            Id=event['PhysicalResourceId']
-        )
+    status = 'SUCCESS'
+    for pipeline_id in event['PhysicalResourceId'].split(','):
+        try:
+            response = et_client.delete_pipeline(
+                Id=pipeline_id
+            )
 
-        logger.info('Deleted Pipeline with ID: {}'.format(event['PhysicalResourceId']))
-
-        status = 'SUCCESS'
-    except Exception as e:
-        logger.error(e)
-        status = 'FAILED'
+            logger.info('Deleted Pipeline with ID: {}'.format(pipeline_id))
+        except Exception as e:
+            logger.error(e)
+            status = 'FAILED'
 
     response = {
         'action': 'delete',
         'physicalresourceid': event['PhysicalResourceId'],
-        'pipelineid' : event['PhysicalResourceId']
+        'pipelineid' : event['PhysicalResourceId'].split(',')[0],
+        'pipelineids' : event['PhysicalResourceId']
         }
 
     return [status, response]
 
 
 def update(event):
-    pass
+    '''
+    Update the Elastictranscoder pipline pool, e.g. to change the number of pipelines.
+
+    A new pool is created and the trigger function is pointed at it. Once the physical resource ID
+    changes cloudformation sends a delete for the old ID, so the old pool is deleted then,
+    pipelines can't be kept from it. If the new pool can't be created the old pool is kept,
+    the trigger function still uses it, and the update fails.
+    '''
+    logger.info('Updating Pipeline for request: {}'.format(event['RequestId']))
+
+    status, response = create(event)
+    response['action'] = 'update'
+    if status != 'SUCCESS':
+        response['physicalresourceid'] = event['PhysicalResourceId']
+        response['pipelineid'] = event['PhysicalResourceId'].split(',')[0]
+        response['pipelineids'] = event['PhysicalResourceId']
+
+    return [status, response]
 
 
 def send_response(event, status, actiondata):
@@ -114,7 +195,8 @@ def send_response(event, status, actiondata):
        'RequestId' : event['RequestId'],
        'LogicalResourceId' : event['LogicalResourceId'],
        'Data' : {
-          'PipelineId' : actiondata['pipelineid']
+          'PipelineId' : actiondata['pipelineid'],
+          'PipelineIds' : actiondata['pipelineids']
        }
     }
 
@@ -125,7 +207,7 @@ def send_response(event, status, actiondata):
     }
 
     try:
-        http = urllib3.PoolManager()
+        http = client_registry.http()
         response = http.request('PUT',
                                 event['ResponseURL'],
                                 body=jsonrequest,
@@ -154,12 +236,26 @@ def lambda_handler(event, context):
     action = event['RequestType']
     logger.info("Received a {} Request".format(action))
 
-    if action == 'Create':
-        status, actiondata = create(event)
-    elif action == 'Update':
-        status, actiondata = update(event)
-    elif action == 'Delete':
-        status, actiondata = delete(event)
+    # Cloudformation waits for a response until it times out, so one is always sent.
+    try:
+        if action == 'Create':
+            status, actiondata = create(event)
+        elif action == 'Update':
+            status, actiondata = update(event)
+        elif action == 'Delete':
+            status, actiondata = delete(event)
+        else:
+            raise ValueError('Unknown request type: {}'.format(action))
+    except Exception as e:
+        logger.error(e)
+        physical_resource_id = event.get('PhysicalResourceId', 'FAILED')
+        status = 'FAILED'
+        actiondata = {
+            'action': action.lower(),
+            'physicalresourceid': physical_resource_id,
+            'pipelineid': physical_resource_id.split(',')[0],
+            'pipelineids': physical_resource_id
+        }
 
     # Send response back to CloudFormation
     send_response(event, status, actiondata)
@@ -17,60 +17,201 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-import boto3
-import botocore
 import os
 import logging
-import io
+import hashlib
+import itertools
 import json
-from botocore.exceptions import ClientError
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-
-s3_client = boto3.client('s3')
-sqs_client = boto3.client('sqs')
-et_client = boto3.client('elastictranscoder')
+from lambda_common import LazyClient, StatusEmitter, call_with_retry, classify_upload, get_admission_controller, \
+    get_completion_tracker, get_dedup_index, get_idempotency_store, get_object_head, get_object_metadata, \
+    get_source_fingerprint, metadata_cache, run_once, send_completion, send_status_message
+
+s3_client = LazyClient('s3')
+sqs_client = LazyClient('sqs')
+et_client = LazyClient('elastictranscoder')
+sns_client = LazyClient('sns')
+lambda_client = LazyClient('lambda')
+status_emitter = StatusEmitter(sqs_client)
+admission_controller = get_admission_controller(s3_client, sqs_client)
+completion_tracker = get_completion_tracker(s3_client)
+idempotency_store = get_idempotency_store(s3_client)
 logger = logging.getLogger()
 
+# Most outputs in one Elastic Transcoder job, 30 is the service limit.
+# Larger preset sets are split over several jobs that run concurrently.
+MAX_JOB_OUTPUTS = int(os.environ.get('TranscodeJobOutputs', 30))
 
-def sqs_send_message(key, bucket, record, metadata):
-    # Get environment variables
-    sqs_url = os.environ.get('SmartmediaSqsQueue')  # SQS queue URL.
+# Workers per lane for the records of one invocation, so a batch or a deferral drain of long media
+# doesn't hold up the short uploads next to it. Across invocations, each lane is bounded by its own
+# pipelines (ShortLanePipelineIds), which Elastic Transcoder runs jobs on independently.
+LANE_CONCURRENCY = {
+    'short': int(os.environ.get('ShortLaneConcurrency', os.environ.get('RecordConcurrency', 8))),
+    'standard': int(os.environ.get('StandardLaneConcurrency', os.environ.get('RecordConcurrency', 8))),
+    }
+
+# Skip renditions that would upscale the source or exceed its bitrate, when the upload says what they are.
+PRESET_PRUNING = os.environ.get('PresetPruning', 'on') == 'on'
+preset_video_settings = dict()  # Preset id => Video settings, shared by invocations of this container.
+pool_pipelines = dict()  # Pool name => Pipeline ids, shared by invocations of this container.
+
+
+class RoundRobinPolicy:
+    """
+    Use each pipeline in turn. The turn is kept per container.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self, pipelines, metadata):
+        with self._lock:
+            return pipelines[next(self._counter) % len(pipelines)]
+
+
+class SiteHashPolicy:
+    """
+    Always use the same pipeline for a site, so one site's uploads can't hold up every pipeline.
+    """
+
+    def choose(self, pipelines, metadata):
+        site_hash = int(hashlib.md5(metadata['siteid'].encode('utf-8')).hexdigest(), 16)
+        return pipelines[site_hash % len(pipelines)]
+
+
+class LeastOutstandingPolicy:
+    """
+    Use the pipeline with the fewest submitted and progressing jobs.
+
+    Job counts are fetched from Elastic Transcoder at most every refresh seconds,
+    and jobs submitted by this container in between are added to them.
+    Only the jobs of the pool's own pipelines are listed, newest first, stopping at
+    the first page without outstanding jobs, as the jobs before it have finished.
+    """
+
+    def __init__(self, refresh=10):
+        self.refresh = refresh
+        self._counts = dict()
+        self._updated = 0
+        self._lock = threading.Lock()
+
+    def _get_counts(self, pipelines):
+        counts = dict((pipeline, 0) for pipeline in pipelines)
+        paginator = et_client.get_paginator('list_jobs_by_pipeline')
+        for pipeline in pipelines:
+            for page in paginator.paginate(PipelineId=pipeline, Ascending='false'):
+                outstanding = sum(1 for job in page.get('Jobs', []) if job['Status'] in ('Submitted', 'Progressing'))
+                counts[pipeline] += outstanding
+                if not outstanding:
+                    break
+
+        return counts
+
+    def choose(self, pipelines, metadata):
+        if len(pipelines) == 1:
+            return pipelines[0]
+
+        with self._lock:
+            if time.monotonic() - self._updated > self.refresh or set(self._counts) != set(pipelines):
+                self._counts = self._get_counts(pipelines)
+                self._updated = time.monotonic()
+
+            pipeline = min(pipelines, key=lambda pipeline: self._counts[pipeline])
+            self._counts[pipeline] += 1
+
+        return pipeline
 
-    # Create JSON message to send to SQS queue.
 
-    now = datetime.now()  # Current date and time.
+PIPELINE_POLICIES = {
+    'round_robin': RoundRobinPolicy,
+    'site_hash': SiteHashPolicy,
+    'least_outstanding': LeastOutstandingPolicy,
+    }
 
-    message_object = {
-        'siteid' : metadata['siteid'],
-        'objectkey' : key,
-        'process': 'S3',
-        'status': record['eventName'],
-        'message': record,
-        'timestamp': int(datetime.timestamp(now))
-        }
-    message_json = json.dumps(message_object)
+pipeline_policy = PIPELINE_POLICIES[os.environ.get('PipelinePolicy', 'round_robin')]()
+
+
+def find_pipelines(name):
+    """
+    Get the IDs of the pipelines in the pool named name, the pool's pipelines are name, name-1, name-2 and so on.
+    Pools only change with the stack, which restarts the function, so they are only looked up once per container.
+    """
+    if name not in pool_pipelines:
+        pipelines = list()
+        paginator = et_client.get_paginator('list_pipelines')
+        for page in paginator.paginate():
+            for pipeline in page.get('Pipelines', []):
+                suffix = pipeline['Name'][len(name) + 1:]
+                if pipeline['Name'] == name or (pipeline['Name'].startswith(name + '-') and suffix.isdigit()):
+                    pipelines.append(pipeline['Id'])
+        pool_pipelines[name] = pipelines
+
+    return pool_pipelines[name]
+
+
+def get_pipelines(lane='standard'):
+    """
+    Get the IDs of the pipelines jobs in a lane can be submitted to.
 
-    # Send message to SQS queue, we do this from Lambda not directly from sns,
+    The short lane uses the ShortLanePipelineIds pipelines, and the standard lane the rest of the pool.
+    When there are no short lane pipelines, both lanes share the whole pool.
+
+    The pipeline resources set the IDs when they create a pool. If a stack update has reset the
+    function's environment since, the pools are found by their names instead.
+    """
+    pipeline_ids = os.environ.get('PipelineIds', '')
+    if pipeline_ids:
+        pipelines = pipeline_ids.split(',')
+    elif os.environ.get('PipelineId'):
+        pipelines = [os.environ.get('PipelineId')]
+    else:
+        pipelines = find_pipelines(os.environ.get('PipelineName'))
+
+    short_pipeline_ids = os.environ.get('ShortLanePipelineIds', '')
+    if short_pipeline_ids:
+        short_pipelines = [pipeline for pipeline in short_pipeline_ids.split(',') if pipeline]
+    elif os.environ.get('ShortLanePipelineName'):
+        short_pipelines = find_pipelines(os.environ.get('ShortLanePipelineName'))
+    else:
+        short_pipelines = []
+    if lane == 'short' and short_pipelines:
+        return short_pipelines
+
+    return [pipeline for pipeline in pipelines if pipeline not in short_pipelines] or pipelines
+
+
+def classify_record(record):
+    """
+    Get the lane for the upload in an S3 event record.
+    """
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+
+    # A new upload may carry new metadata, so never trust a cached copy here.
+    # The fresh copy is cached for processing the record.
+    metadata_cache.invalidate(bucket, key)
+
+    return classify_upload(get_object_head(s3_client, bucket, key))
+
+
+def sqs_send_message(key, bucket, record, metadata):
+    # Send message to SQS queue, we do this from Lambda not directly from S3,
     # as we want to add some extra information to the message.
-    sqs_client.send_message(
-        QueueUrl=sqs_url,
-        MessageBody=message_json,
-        MessageAttributes={
-            'siteid': {
-                'StringValue': metadata['siteid'],
-                'DataType': 'String'
-            },
-            'inputkey': {
-                'StringValue': key,
-                'DataType': 'String'
-            },
-        }
-    )
+    send_status_message(status_emitter, metadata['siteid'], key, 'S3', record['eventName'], record)
 
 
 def submit_transcode_jobs(s3key, pipeline_id, presets):
     """
     Submits jobs to Elastic Transcoder.
+
+    If the outputs are split over several jobs, they are submitted concurrently and tagged
+    with a shared group id, so the AI trigger can treat them as one conversion.
     """
 
     logger.info('Triggering transcode job...')
@@ -115,17 +256,156 @@ def submit_transcode_jobs(s3key, pipeline_id, presets):
 
         outputs.append(output)
 
-    response = et_client.create_job(
-        PipelineId=pipeline_id,
-         OutputKeyPrefix=s3key + '/conversions/',
-         Input={
-            'Key': s3key,
-        },
-        Outputs=outputs,
-        Playlists=list(playlists.values()) # Convert dictionary to list.
-    )
+    jobs = plan_transcode_jobs(outputs, list(playlists.values()), MAX_JOB_OUTPUTS)  # Convert dictionary to list.
+    if not jobs:
+        logger.info('No presets to transcode {} with, skipping'.format(s3key))
+        return
+
+    job_args = list()
+    group_id = uuid.uuid4().hex
+    for job_outputs, job_playlists in jobs:
+        args = {
+            'PipelineId': pipeline_id,
+            'OutputKeyPrefix': s3key + '/conversions/',
+            'Input': {
+                'Key': s3key,
+            },
+            'Outputs': job_outputs,
+            'Playlists': job_playlists,
+            }
+        if len(jobs) > 1:
+            args['UserMetadata'] = {'smartmediagroup': group_id, 'smartmediaparts': str(len(jobs))}
+        job_args.append(args)
+
+    with ThreadPoolExecutor(max_workers=len(job_args)) as executor:
+        responses = list(executor.map(lambda args: call_with_retry(et_client.create_job, **args), job_args))
+
+    for response in responses:
+        logger.info(response)
+
+
+def plan_transcode_jobs(outputs, playlists, max_outputs):
+    """
+    Split the outputs of a conversion over as few jobs as possible with at most max_outputs each.
+
+    A playlist and all of its outputs always stay in the same job, so a playlist with more than
+    max_outputs outputs raises a ValueError. Returns a list of (outputs, playlists) per job,
+    outputs keep their original order. There are no jobs if there are no outputs.
+    """
+    # Units are the outputs that have to be in the same job, with their playlists.
+    units = list()
+    playlist_keys = set()
+    for playlist in playlists:
+        playlist_outputs = [output for output in outputs if output['Key'] in playlist['OutputKeys']]
+        if len(playlist_outputs) > max_outputs:
+            raise ValueError('Playlist {} has {} outputs, more than the {} a transcode job can have'.format(
+                playlist['Name'], len(playlist_outputs), max_outputs))
+        if playlist_outputs:
+            units.append((playlist_outputs, [playlist]))
+        playlist_keys.update(playlist['OutputKeys'])
+    units.extend(([output], []) for output in outputs if output['Key'] not in playlist_keys)
+
+    # First fit, biggest units first.
+    jobs = list()
+    for unit_outputs, unit_playlists in sorted(units, key=lambda unit: len(unit[0]), reverse=True):
+        for job_outputs, job_playlists in jobs:
+            if len(job_outputs) + len(unit_outputs) <= max_outputs:
+                job_outputs.extend(unit_outputs)
+                job_playlists.extend(unit_playlists)
+                break
+        else:
+            jobs.append((list(unit_outputs), list(unit_playlists)))
+
+    order = dict((output['Key'], index) for index, output in enumerate(outputs))
+    for job_outputs, job_playlists in jobs:
+        job_outputs.sort(key=lambda output: order[output['Key']])
+
+    return jobs
+
+
+def read_video_settings(preset_ids):
+    """
+    Get the video settings of elastic transcoder presets, as preset id => Video (None for audio only presets).
+    Presets don't change, so they are only read once per container.
+    """
+    missing = [preset_id for preset_id in preset_ids if preset_id not in preset_video_settings]
+    if missing:
+        def read(preset_id):
+            return call_with_retry(et_client.read_preset, Id=preset_id)['Preset'].get('Video')
+
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            preset_video_settings.update(zip(missing, executor.map(read, missing)))
+
+    return dict((preset_id, preset_video_settings[preset_id]) for preset_id in preset_ids)
+
+
+def get_source_properties(metadata):
+    """
+    Get the short side in pixels and the bitrate in kbit/s of the source video from its upload metadata.
+    Either is None if it isn't known. Moodle attaches these from its own ffprobe of the file.
+    """
+    def number(name):
+        try:
+            return float(metadata[name]) or None
+        except (KeyError, ValueError):
+            return None
+
+    width, height, bitrate = number('width'), number('height'), number('bitrate')
+    short_side = min(width, height) if width and height else None
+
+    return short_side, bitrate / 1000 if bitrate else None
+
+
+def plan_presets(presets, metadata):
+    """
+    Drop video renditions that would be bigger than the source, either upscaled or at a higher bitrate.
+
+    The download (mp4) and audio (mp3) presets are always kept, as are audio only presets.
+    An adaptive playlist that would lose all its video keeps its smallest rendition.
+    Sizes are compared by their short side, so portrait video isn't mistaken for small video.
+    """
+    short_side, bitrate = get_source_properties(metadata)
+    if short_side is None and bitrate is None:
+        return presets
+
+    candidates = [preset_id for preset_id, container in presets.items() if container not in ('mp4', 'mp3')]
+    video_settings = read_video_settings(candidates)
+
+    def preset_value(video, name):
+        try:
+            return float(video.get(name))
+        except (TypeError, ValueError):
+            return None  # e.g. auto
+
+    dropped = set()
+    smallest = dict()
+    for preset_id in candidates:
+        video = video_settings[preset_id]
+        if not video:
+            continue
+        width, height = preset_value(video, 'MaxWidth'), preset_value(video, 'MaxHeight')
+        preset_short_side = min(width, height) if width and height else None
+        preset_bitrate = preset_value(video, 'BitRate')
+
+        container = presets[preset_id]
+        size = (preset_short_side or 0, preset_bitrate or 0)
+        if container not in smallest or size < smallest[container][0]:
+            smallest[container] = (size, preset_id)
+
+        if short_side and preset_short_side and preset_short_side > short_side:
+            dropped.add(preset_id)
+        elif bitrate and preset_bitrate and preset_bitrate > bitrate:
+            dropped.add(preset_id)
+
+    for container, (size, keep_id) in smallest.items():
+        renditions = [
+            preset_id for preset_id in candidates if presets[preset_id] == container and video_settings[preset_id]
+            ]
+        if all(preset_id in dropped for preset_id in renditions):
+            dropped.discard(keep_id)
+
+    return dict((preset_id, container) for preset_id, container in presets.items() if preset_id not in dropped)
 
-    logger.info(response)
 
 def get_presets(key, bucket, metadata):
     """
@@ -133,51 +413,284 @@ def get_presets(key, bucket, metadata):
     """
     raw_preset_data = metadata['presets']
     decoded_presets = json.loads(raw_preset_data)
+    if PRESET_PRUNING:
+        planned_presets = plan_presets(decoded_presets, metadata)
+        if len(planned_presets) < len(decoded_presets):
+            logger.info('Skipping presets bigger than {}: {}'.format(
+                key, ', '.join(preset_id for preset_id in decoded_presets if preset_id not in planned_presets)))
+        decoded_presets = planned_presets
     logger.info(decoded_presets)
     return decoded_presets
 
-def lambda_handler(event, context):
+
+def copy_outputs(output_bucket, source_key, key):
     """
-    lambda_handler is the entry point that is invoked when the lambda function is called,
-    more information can be found in the docs:
-    https://docs.aws.amazon.com/lambda/latest/dg/python-programming-model-handler-types.html
+    Server side copy the conversions and metadata of one input key to another.
+    File names are kept, so playlists still point at their segments.
+    Returns the number of objects copied.
+    """
+    copies = list()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for folder in ('conversions', 'metadata'):
+        source_prefix = '{}/{}/'.format(source_key, folder)
+        for page in paginator.paginate(Bucket=output_bucket, Prefix=source_prefix):
+            for file_object in page.get('Contents', []):
+                filename = file_object['Key'][len(source_prefix):]
+                copies.append((file_object['Key'], '{}/{}/{}'.format(key, folder, filename)))
+
+    def copy(copy_keys):
+        s3_client.copy_object(
+            Bucket=output_bucket,
+            Key=copy_keys[1],
+            CopySource={'Bucket': output_bucket, 'Key': copy_keys[0]}
+            )
 
-    Trigger the file conversion when the source file is uploaded to the input s3 bucket.
+    if copies:
+        with ThreadPoolExecutor(max_workers=min(len(copies), 8)) as executor:
+            list(executor.map(copy, copies))
+
+    return len(copies)
+
+
+def reuse_conversions(key, bucket):
     """
+    Reuse the conversions of an earlier upload with the same content and presets, if there is one.
 
-    #  Set logging
-    logging_level = os.environ.get('LoggingLevel', logging.ERROR)
-    logger.setLevel(int(logging_level))
+    The earlier transcoder completion is published again for this key, so the AI trigger
+    carries on as if the transcode had just finished. Returns True if conversions were reused.
+    """
+    dedup_index = get_dedup_index(s3_client)
+    if dedup_index is None:
+        return False
+
+    records = dedup_index.get(get_source_fingerprint(s3_client, bucket, key))
+    transcode_record = records.get('elastic_transcoder')
+    if transcode_record is None:
+        return False
+
+    output_bucket = os.environ.get('OutputBucket')
+    source_key = transcode_record['objectkey']
+    if source_key != key:
+        copied = copy_outputs(output_bucket, source_key, key)
+    else:
+        response = s3_client.list_objects_v2(Bucket=output_bucket, Prefix='{}/conversions/'.format(key), MaxKeys=1)
+        copied = response.get('KeyCount', 0)
+
+    if not copied:
+        logger.info('Conversions of {} are gone, transcoding {}'.format(source_key, key))
+        return False
+
+    # The message is marked as reused, so Moodle doesn't see it as a duplicate of the original.
+    # It also gets a new job id, as that names the AI jobs started from it.
+    timestamp = int(datetime.timestamp(datetime.now()))
+    message = dict(transcode_record['message'])
+    message['jobId'] = '{}-{}'.format(message['jobId'], timestamp)
+    message['input'] = dict(message['input'], key=key)
+    message['outputKeyPrefix'] = '{}/conversions/'.format(key)
+    message['reusedfrom'] = {'objectkey': source_key, 'timestamp': timestamp}
+    message.pop('userMetadata', None)  # This is the whole conversion, not one job of a split one.
+    sns_client.publish(
+        TopicArn=os.environ.get('SnsTopicConversionArn'),
+        Message=json.dumps(message)
+        )
+
+    logger.info('Reusing conversions of {} for {}'.format(source_key, key))
+    return True
+
+
+def process_record(record, pipelines, deferred=False):
+    """
+    Send the upload status message and submit the transcode jobs for one uploaded file.
+    Deferred uploads were already reported and admitted, so they go straight to transcoding.
+    """
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
 
-    logger.info(event)
+    # Get input object metadata as we will need for SQS message sending.
+    metadata = get_object_metadata(s3_client, bucket, key)
 
-    #  Get Pipeline ID from environment variable
-    pipeline_id = os.environ.get('PipelineId')
+    if not deferred:
+        logger.info('File uploaded: {}'.format(key))
+
+        # Tracked uploads only get a completion message, once all their processes are done.
+        if completion_tracker is not None:
+            completion_tracker.start(key, metadata['siteid'], metadata['processes'])
+        else:
+            # Send message to SQS queue.
+            sqs_send_message(key, bucket, record, metadata)
+
+    presets = get_presets(key, bucket, metadata)
+
+    # Uploads of media that has already been converted with the same presets reuse those conversions.
+    if reuse_conversions(key, bucket):
+        return
+
+    # Uploads from sites that have used up their share wait in the deferral queue.
+    if not deferred and admission_controller is not None and not admission_controller.admit(metadata['siteid']):
+        logger.info('Deferring {} for site {}'.format(key, metadata['siteid']))
+        admission_controller.defer(metadata['siteid'], record)
+        return
+
+    pipeline_id = pipeline_policy.choose(pipelines, metadata)
     logger.info('Executing Pipeline: {}'.format(pipeline_id))
+    submit_transcode_jobs(key, pipeline_id, presets)
 
-    #  Now get and process the file from the input bucket.
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
 
-        #  Filter out permissions check file.
-        #  This is initiated by Moodle to check bucket access is correct
-        if key == 'permissions_check_file':
-            continue
+def process_record_once(record, pipelines, deferred=False):
+    """
+    Process one uploaded file, unless the record is a duplicate delivery of an S3 event.
+    Deferred uploads were claimed when their event was first delivered.
+    """
+    if deferred or idempotency_store is None:
+        process_record(record, pipelines, deferred)
+        return
 
-        # Get input object metadata as we will need for SQS message sending.
-        input_object_headdata_object = s3_client.head_object(
-            Bucket=bucket,
-            Key=key
-            )
+    # The sequencer tells apart uploads of the same key, redeliveries of an event share it.
+    s3_object = record['s3']['object']
+    run_once(idempotency_store, s3_object['key'], 'S3', s3_object['sequencer'], process_record, record, pipelines,
+             status_emitter=status_emitter)
 
-        metadata = input_object_headdata_object['Metadata']
 
-        logger.info('File uploaded: {}'.format(key))
+def process_records(records, deferred=False):
+    """
+    Process S3 event records concurrently, in lanes.
+    A failed record doesn't stop the others. Returns the records that failed.
+    """
+    failed = list()
+
+    def get_results(futures):
+        results = list()
+        for record, future in futures:
+            error = future.exception()
+            if error is not None:
+                logger.error('Failed processing {}: {}'.format(record['s3']['object']['key'], error))
+                failed.append(record)
+            else:
+                results.append((record, future.result()))
+        return results
+
+    max_workers = min(len(records), int(os.environ.get('RecordConcurrency', 8)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(record, executor.submit(classify_record, record)) for record in records]
+
+    lanes = OrderedDict()
+    for record, lane in get_results(futures):
+        lanes.setdefault(lane, []).append(record)
+
+    # Each lane has its own workers, so short uploads don't wait behind long ones.
+    futures = list()
+    executors = list()
+    for lane, lane_records in lanes.items():
+        logger.info('Processing {} records in the {} lane'.format(len(lane_records), lane))
+        pipelines = get_pipelines(lane)
+        executor = ThreadPoolExecutor(max_workers=min(len(lane_records), LANE_CONCURRENCY[lane]))
+        executors.append(executor)
+        futures.extend(
+            (record, executor.submit(process_record_once, record, pipelines, deferred)) for record in lane_records)
+
+    for executor in executors:
+        executor.shutdown()
+    get_results(futures)
+
+    return failed
+
+
+def drain_deferred():
+    """
+    Process the deferred uploads that their sites have capacity for again.
+    Returns the records processed and the records that failed, which are tried again on a later drain.
+    """
+    if admission_controller is None:
+        return [], []
+
+    admitted = admission_controller.drain()
+    if not admitted:
+        return [], []
+
+    logger.info('Processing {} deferred uploads'.format(len(admitted)))
+    failed = process_records([record for record, handle in admitted], deferred=True)
+    for record, handle in admitted:
+        if not any(record is failed_record for failed_record in failed):
+            admission_controller.done(handle)
+
+    return [record for record, handle in admitted], failed
+
+
+def retry_records(records):
+    """
+    Invoke this function again asynchronously with just the given S3 event records.
+    Lambda's retries of that invocation then only repeat these records, not the ones that succeeded with them.
+    """
+    lambda_client.invoke(
+        FunctionName=os.environ.get('AWS_LAMBDA_FUNCTION_NAME'),
+        InvocationType='Event',
+        Payload=json.dumps({'Records': records}).encode('UTF-8')
+        )
+
+
+def expire_completions():
+    """
+    Send the completion messages of tracked uploads that timed out waiting for their processes.
+    """
+    if completion_tracker is None:
+        return
 
-        # Send message to SQS queue.
-        sqs_send_message(key, bucket, record, metadata)
+    try:
+        completions = completion_tracker.expire()
+    except Exception as e:
+        logger.error('Failed expiring tracked uploads: {}'.format(e))
+        return
 
-        presets = get_presets(key, bucket, metadata)
+    for completion in completions:
+        logger.info('Processes of {} timed out: {}'.format(completion['objectkey'], completion['message']['outcomes']))
+        send_completion(status_emitter, completion)
+
+
+@status_emitter.flush_on_exit
+def lambda_handler(event, context):
+    """
+    lambda_handler is the entry point that is invoked when the lambda function is called,
+    more information can be found in the docs:
+    https://docs.aws.amazon.com/lambda/latest/dg/python-programming-model-handler-types.html
+
+    Trigger the file conversion when the source file is uploaded to the input s3 bucket.
+    Scheduled invocations, without records, drain the deferred uploads and time out tracked uploads.
+    """
+
+    #  Set logging
+    logging_level = os.environ.get('LoggingLevel', logging.ERROR)
+    logger.setLevel(int(logging_level))
+
+    logger.info(event)
 
-        submit_transcode_jobs(key, pipeline_id, presets)
+    if 'Records' not in event:
+        records, failed = drain_deferred()
+        expire_completions()
+        # Failed deferred uploads stay in the deferral queue for the next drain.
+        if failed:
+            keys = [record['s3']['object']['key'] for record in failed]
+            logger.error('Failed processing {} of {} deferred uploads: {}'.format(
+                len(failed), len(records), ', '.join(keys)))
+        return
+
+    #  Now get and process the files from the input bucket.
+    #  Bulk uploads can arrive together, so records are processed concurrently.
+    #  Filter out permissions check file.
+    #  This is initiated by Moodle to check bucket access is correct
+    records = [record for record in event['Records'] if record['s3']['object']['key'] != 'permissions_check_file']
+    if not records:
+        return
+
+    failed = process_records(records)
+    if not failed:
+        return
+
+    keys = [record['s3']['object']['key'] for record in failed]
+    if len(failed) == len(records):
+        # Nothing succeeded, so Lambda retrying the invocation only repeats the failed records.
+        raise RuntimeError('Failed processing {} of {} records: {}'.format(len(failed), len(records), ', '.join(keys)))
+
+    # The records that succeeded mustn't be processed again, so the failed ones are retried on their own.
+    logger.error('Failed processing {} of {} records, retrying them: {}'.format(
+        len(failed), len(records), ', '.join(keys)))
+    retry_records(failed)
@@ -17,34 +17,176 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-import boto3
-import botocore
+import codecs
 import os
 import logging
-import io
 import json
+import re
 import time
-import urllib3
-from botocore.exceptions import ClientError
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from lambda_common import LazyClient, client_registry, StatusEmitter, describe_artifact, get_completion_tracker, \
+    get_idempotency_store, get_metadata_writer, get_object_metadata, record_artifacts, record_finished_process, \
+    report_outcome, run_once, send_status_message
 
 logger = logging.getLogger()
 
-# Get clients and resources.
-s3_client = boto3.client('s3')
-s3_resource = boto3.resource('s3')
-sqs_client = boto3.client('sqs')
-transcribe_client = boto3.client('transcribe')
-comprehend_client = boto3.client('comprehend')
+# Get clients, these are built on first use.
+s3_client = LazyClient('s3')
+sqs_client = LazyClient('sqs')
+transcribe_client = LazyClient('transcribe')
+comprehend_client = LazyClient('comprehend')
+status_emitter = StatusEmitter(sqs_client)
+completion_tracker = get_completion_tracker(s3_client)
+idempotency_store = get_idempotency_store(s3_client)
+
+# Comprehend analyses as (service, Comprehend batch method, metadata file name, SQS process name).
+COMPREHEND_ANALYSES = [
+    ('sentiment', 'batch_detect_sentiment', 'sentiment', 'SentimentComplete'),
+    ('phrases', 'batch_detect_key_phrases', 'phrases', 'PhrasesComplete'),
+    ('entities', 'batch_detect_entities', 'entities', 'EntitiesComplete'),
+    ]
+
+COMPREHEND_BATCH_SIZE = 25  # Maximum documents per Comprehend batch call.
+COMPREHEND_DOCUMENT_BYTES = int(os.environ.get('ComprehendDocumentBytes', 5000))  # Per document size limit.
+
+TRANSCRIPT_CHUNK_BYTES = 64 * 1024  # Size of chunks read from the transcript download.
+TRANSCRIPT_TEXT_PATH = ('results', 'transcripts', 0, 'transcript')  # Location of the text in the transcript.
+
+JSON_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    }
+JSON_STRING_SPECIAL = re.compile(r'["\\]')
+
+class JsonValueExtractor:
+    """
+    Incremental JSON parser that extracts a single string value from a document.
 
-def get_enabled_services(s3_client, bucket, input_key):
-    # Get input object metadata as we will need for SQS message sending.
-    input_object_headdata_object = s3_client.head_object(
-        Bucket=bucket,
-        Key=input_key
-        )
+    The document is fed in chunks of text and only the value at the given path
+    is kept, so memory use does not grow with the rest of the document.
+    Parsing stops as soon as the value has been found.
+    """
 
-    metadata = input_object_headdata_object['Metadata']
+    def __init__(self, path):
+        self.path = list(path)
+        self.value = None
+        self.done = False
+        self._stack = list()  # Frames of [container type, current key or index, expected token].
+        self._in_string = False
+        self._in_scalar = False
+        self._is_key = False
+        self._capture = False
+        self._escape = None
+        self._chars = list()
+
+    def feed(self, text):
+        """
+        Parse the next chunk of the document.
+        """
+        position = 0
+        length = len(text)
+        while position < length and not self.done:
+            if self._in_string:
+                position = self._feed_string(text, position)
+                continue
+
+            char = text[position]
+            if self._in_scalar:
+                if char in ',]}' or char.isspace():
+                    self._in_scalar = False
+                    self._value_done()
+                    continue
+            elif char == '{':
+                self._stack.append(['object', None, 'key'])
+            elif char == '[':
+                self._stack.append(['array', 0, 'value'])
+            elif char == '"':
+                self._in_string = True
+                self._is_key = bool(self._stack) and self._stack[-1][0] == 'object' and self._stack[-1][2] == 'key'
+                self._capture = not self._is_key and self._current_path() == self.path
+                self._chars = list()
+            elif char == ':':
+                self._stack[-1][2] = 'value'
+            elif char == ',':
+                frame = self._stack[-1]
+                if frame[0] == 'object':
+                    frame[2] = 'key'
+                else:
+                    frame[1] += 1
+                    frame[2] = 'value'
+            elif char in ']}':
+                self._stack.pop()
+                self._value_done()
+            elif not char.isspace():
+                self._in_scalar = True
+            position += 1
+
+    def _feed_string(self, text, position):
+        """
+        Consume string characters, returning the position after the consumed text.
+        """
+        keep = self._is_key or self._capture
+        if self._escape is None:
+            # Skip quickly to the next quote or backslash.
+            match = JSON_STRING_SPECIAL.search(text, position)
+            end = match.start() if match else len(text)
+            if keep:
+                self._chars.append(text[position:end])
+            if end == len(text):
+                return end
+            if text[end] == '"':
+                self._string_done()
+            else:
+                self._escape = ''
+            return end + 1
+
+        char = text[position]
+        if self._escape == '':
+            if char == 'u':
+                self._escape = 'u'
+            else:
+                if keep:
+                    self._chars.append(JSON_ESCAPES.get(char, char))
+                self._escape = None
+        else:
+            self._escape += char
+            if len(self._escape) == 5:
+                if keep:
+                    self._chars.append(chr(int(self._escape[1:], 16)))
+                self._escape = None
+
+        return position + 1
+
+    def _string_done(self):
+        self._in_string = False
+        if self._is_key:
+            self._stack[-1][1] = ''.join(self._chars)
+            self._stack[-1][2] = 'colon'
+        elif self._capture:
+            # Recombine any escaped surrogate pairs.
+            self.value = ''.join(self._chars).encode('utf-16', 'surrogatepass').decode('utf-16')
+            self.done = True
+        else:
+            self._value_done()
+        self._chars = list()
+
+    def _value_done(self):
+        if self._stack:
+            self._stack[-1][2] = 'comma'
+
+    def _current_path(self):
+        return [frame[1] for frame in self._stack]
+
+
+def get_enabled_services(s3_client, bucket, input_key):
+    # Get input object metadata, this is cached so it is shared with SQS message sending.
+    metadata = get_object_metadata(s3_client, bucket, input_key)
     serviceraw = list(metadata['processes'])
 
     # Dict of metadata position => service
@@ -62,45 +204,245 @@ def get_enabled_services(s3_client, bucket, input_key):
     return services
 
 def sqs_send_message(input_key, message_state, process):
-    # Get environvent variables
-    input_bucket = os.environ.get('InputBucket')  # Ouput S3 bucket
-    sqs_url = os.environ.get('SmartmediaSqsQueue')  # SQS queue URL.
+    # Tracked uploads get a single completion message instead.
+    if report_outcome(completion_tracker, status_emitter, input_key, process, message_state):
+        return
 
     # Get input object metadata as we will need for SQS message sending.
-    input_object_headdata_object = s3_client.head_object(
-        Bucket=input_bucket,
-        Key=input_key
-        )
+    metadata = get_object_metadata(s3_client, os.environ.get('InputBucket'), input_key)
 
-    now = datetime.now()  # Current date and time.
+    # There is no meaningful info for the message, the process name and objectkey deduplicate it.
+    send_status_message(status_emitter, metadata['siteid'], input_key, process, message_state,
+                        '{}: {}'.format(input_key, process))
 
-    message_object = {
-        'siteid' : input_object_headdata_object['Metadata']['siteid'],
-        'objectkey' : input_key,
-        'process': process,
-        'status': message_state,
-        'message': '{}: {}'.format(input_key, process), # Use the process name and objectkey to deduplicate. If we get here, we have no meaningful info for the message.
-        'timestamp': int(datetime.timestamp(now))
-        }
-    message_json = json.dumps(message_object)
-
-    # Send message to SQS queue, we do this from Lambda not directly from sns,
-    # as we want to add some extra information to the message.
-    sqs_client.send_message(
-        QueueUrl=sqs_url,
-        MessageBody=message_json,
-        MessageAttributes={
-            'siteid': {
-                'StringValue': input_object_headdata_object['Metadata']['siteid'],
-                'DataType': 'String'
-            },
-            'inputkey': {
-                'StringValue': input_key,
-                'DataType': 'String'
-            },
+
+def split_text(text, start, end, max_bytes):
+    """
+    Split a span of text that is too big for a single document, at whitespace where possible.
+    """
+    if len(text[start:end].encode('utf-8')) <= max_bytes:
+        return [(start, end)]
+
+    pieces = list()
+    piece_start = start
+    piece_bytes = 0
+    last_space = -1
+    for index in range(start, end):
+        char_bytes = len(text[index].encode('utf-8'))
+        while piece_bytes + char_bytes > max_bytes:
+            # Cut after the last whitespace in this piece, or mid word if there is none.
+            cut = last_space + 1 if last_space >= piece_start else index
+            pieces.append((piece_start, cut))
+            piece_start = cut
+            piece_bytes = len(text[cut:index].encode('utf-8'))
+            last_space = text.rfind(' ', cut, index)
+        piece_bytes += char_bytes
+        if text[index] == ' ':
+            last_space = index
+    pieces.append((piece_start, end))
+
+    return pieces
+
+
+def segment_transcript(text, max_bytes=COMPREHEND_DOCUMENT_BYTES):
+    """
+    Split a transcript on sentence boundaries into documents that fit the Comprehend size limit.
+
+    Returns a list of (offset, document) where offset is the character offset
+    of the document in the full transcript.
+    """
+    # Sentence spans, each ending after the punctuation and following whitespace.
+    boundaries = [match.end() for match in re.finditer(r'[.!?]+\s+', text)]
+    if not boundaries or boundaries[-1] != len(text):
+        boundaries.append(len(text))
+
+    spans = list()
+    start = 0
+    for end in boundaries:
+        spans += split_text(text, start, end, max_bytes)
+        start = end
+
+    # Pack consecutive sentences into documents.
+    segments = list()
+    segment_start = 0
+    segment_bytes = 0
+    for start, end in spans:
+        span_bytes = len(text[start:end].encode('utf-8'))
+        if segment_bytes > 0 and segment_bytes + span_bytes > max_bytes:
+            segments.append((segment_start, text[segment_start:start]))
+            segment_start = start
+            segment_bytes = 0
+        segment_bytes += span_bytes
+    if segment_bytes > 0:
+        segments.append((segment_start, text[segment_start:]))
+
+    return segments
+
+
+def batch_detect(method, segments):
+    """
+    Send documents to a Comprehend batch API, 25 per call, with the calls made in parallel.
+    Returns the per document results in document order.
+    """
+    getter_method = getattr(comprehend_client, method)
+    documents = [document for offset, document in segments]
+    batches = [documents[x:x + COMPREHEND_BATCH_SIZE] for x in range(0, len(documents), COMPREHEND_BATCH_SIZE)]
+
+    max_workers = min(len(batches), int(os.environ.get('ComprehendBatchConcurrency', 4)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = list(executor.map(
+            lambda batch: getter_method(TextList=batch, LanguageCode='en'),
+            batches
+            ))
+
+    results = [None] * len(documents)
+    for batch_number, response in enumerate(responses):
+        if response.get('ErrorList'):
+            raise RuntimeError('Comprehend {} failed: {}'.format(method, response['ErrorList']))
+        for result in response['ResultList']:
+            results[(batch_number * COMPREHEND_BATCH_SIZE) + result['Index']] = result
+
+    return results
+
+
+def merge_sentiment(segments, results):
+    """
+    Merge per document sentiment into one result, weighting each document by its length.
+    """
+    total = sum(len(document) for offset, document in segments)
+    scores = {'Positive': 0.0, 'Negative': 0.0, 'Neutral': 0.0, 'Mixed': 0.0}
+    for (offset, document), result in zip(segments, results):
+        for name in scores:
+            scores[name] += result['SentimentScore'][name] * len(document) / total
+
+    return {
+        'Sentiment': max(scores, key=scores.get).upper(),
+        'SentimentScore': scores
         }
-    )
 
+
+def merge_offsets(segments, results, result_key):
+    """
+    Merge per document key phrases or entities, mapping offsets back to the full transcript.
+    """
+    merged = list()
+    for (offset, document), result in zip(segments, results):
+        for item in result[result_key]:
+            item = dict(item)
+            item['BeginOffset'] += offset
+            item['EndOffset'] += offset
+            merged.append(item)
+
+    return {result_key: merged}
+
+
+def run_analysis(analysis, input_key, output_bucket, segments):
+    """
+    Run a single Comprehend analysis on the transcript documents and store the merged result in S3.
+    """
+    service, method, filename, process = analysis
+
+    results = batch_detect(method, segments)
+    if service == 'sentiment':
+        analysis_response = merge_sentiment(segments, results)
+    elif service == 'phrases':
+        analysis_response = merge_offsets(segments, results, 'KeyPhrases')
+    else:
+        analysis_response = merge_offsets(segments, results, 'Entities')
+
+    with get_metadata_writer(s3_client, output_bucket, '{}/metadata/{}.json'.format(input_key, filename)) as writer:
+        writer.write(json.dumps(analysis_response).encode('UTF-8'))
+    artifact = describe_artifact(writer, process, 'comprehend-' + service)
+    record_artifacts(s3_client, input_key, {'{}.json'.format(filename): artifact})
+
+    # Send SQS message for completed analysis.
+    sqs_send_message(input_key, 'SUCCEEDED', process)  # Send message to SQS queue.
+    record_finished_process(s3_client, os.environ.get('InputBucket'), input_key, process, 'SUCCEEDED', process)
+
+
+def run_analyses(analyses, input_key, output_bucket, transcription_text):
+    """
+    Run Comprehend analyses concurrently on a bounded thread pool.
+    A failed analysis is reported as an error and does not affect the others.
+
+    Returns a list of (service, exception or None) in the same order as the analyses.
+    """
+    if not analyses:
+        return []
+
+    # Long transcripts are split into documents within the Comprehend size limit.
+    segments = segment_transcript(transcription_text)
+
+    max_workers = min(len(analyses), int(os.environ.get('AnalysisConcurrency', 3)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_analysis, analysis, input_key, output_bucket, segments)
+            for analysis in analyses
+            ]
+
+    results = list()
+    for analysis, future in zip(analyses, futures):
+        error = future.exception()
+        if error is not None:
+            logger.error('Comprehend {} analysis failed for {}: {}'.format(analysis[0], input_key, error))
+            sqs_send_message(input_key, 'ERROR', analysis[3])  # Send message to SQS queue.
+        results.append((analysis[0], error))
+
+    return results
+
+
+def process_transcript(input_key, transcription_url):
+    """
+    Store the transcript of a finished transcription job and run the enabled analyses of it.
+    """
+    output_key = '{}/metadata/transcription.json'.format(input_key)
+    output_bucket = os.environ.get('OutputBucket')
+    input_bucket = os.environ.get('InputBucket')
+
+    # Given an Internet-accessible URL, stream the data into S3,
+    # without needing to persist it to disk or hold it all in memory.
+    # The transcript text is extracted from the stream as it passes through.
+    http = client_registry.http()
+    response = http.request('GET', transcription_url, preload_content=False)
+    if response.status != 200:
+        # e.g. an expired transcript URL, the error body mustn't be stored as the transcript.
+        response.release_conn()
+        raise RuntimeError('Failed getting transcript for {}: HTTP {}'.format(input_key, response.status))
+    extractor = JsonValueExtractor(TRANSCRIPT_TEXT_PATH)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with get_metadata_writer(s3_client, output_bucket, output_key) as writer:
+            for chunk in response.stream(TRANSCRIPT_CHUNK_BYTES):
+                writer.write(chunk)
+                if not extractor.done:
+                    extractor.feed(decoder.decode(chunk))
+    finally:
+        response.release_conn()
+    artifact = describe_artifact(writer, 'TranscribeComplete', 'transcribe')
+    record_artifacts(s3_client, input_key, {'transcription.json': artifact})
+
+    transcription_text = extractor.value or ''
+
+    # Send SQS message for completed transcription.
+    sqs_send_message(input_key, 'SUCCEEDED', 'TranscribeComplete')  # Send message to SQS queue.
+    record_finished_process(s3_client, input_bucket, input_key, 'TranscribeComplete', 'SUCCEEDED', 'TranscribeComplete')
+
+    perform_analysis = len(transcription_text) > 0
+    services = get_enabled_services(s3_client, input_bucket, input_key)
+
+    # Send the transcription for sentiment, key phrase and entity analysis.
+    # The analyses are independent, so run them concurrently.
+    if perform_analysis:
+        analyses = [analysis for analysis in COMPREHEND_ANALYSES if services[analysis[0]]]
+        run_analyses(analyses, input_key, output_bucket, transcription_text)
+    else:
+        # There is nothing to analyse, so the completion tracker is told the analyses were skipped.
+        for analysis in COMPREHEND_ANALYSES:
+            if services[analysis[0]]:
+                report_outcome(completion_tracker, status_emitter, input_key, analysis[3], 'SKIPPED')
+
+
+@status_emitter.flush_on_exit
 def lambda_handler(event, context):
     """
     lambda_handler is the entry point that is invoked when the lambda function is called,
@@ -129,66 +471,7 @@ def lambda_handler(event, context):
 
     output_vars = input_url.split('/')
     input_key = output_vars[4]
-    output_key = '{}/metadata/transcription.json'.format(input_key)
-    output_bucket = os.environ.get('OutputBucket')
-    input_bucket = os.environ.get('InputBucket')
 
-    # Given an Internet-accessible URL, download the data and upload it to S3,
-    # without needing to persist the image to disk locally.
-    http = urllib3.PoolManager()
-    response = http.request('GET', transcription_url)
-    transcription_object = json.loads(response.data.decode('utf-8'))
-    transcription_text = transcription_object['results']['transcripts'][0]['transcript']
-
-    # Do the actual upload to s3
-    s3_resource.Bucket(output_bucket).put_object(Key=output_key, Body=response.data.decode('utf-8'))
-
-    # Send SQS message for completed transcription.
-    sqs_send_message(input_key, 'SUCCEEDED', 'TranscribeComplete')  # Send message to SQS queue.
-
-    perform_analysis = len(transcription_text) > 0
-    services = get_enabled_services(s3_client, input_bucket, input_key)
-
-    # Send the transcription for sentiment analysis.
-    # Detect sentiment
-    if perform_analysis:
-        if services['sentiment']:
-            sentiment_response = comprehend_client.detect_sentiment(
-                Text=transcription_text,
-                LanguageCode='en'
-            )
-
-            s3_object = s3_resource.Object(output_bucket, '{}/metadata/sentiment.json'.format(input_key))
-            s3_object.put(
-                Body=(bytes(json.dumps(sentiment_response).encode('UTF-8')))
-            )
-             # Send SQS message for completed sentiment.
-            sqs_send_message(input_key, 'SUCCEEDED', 'SentimentComplete')  # Send message to SQS queue.
-
-        # Detect key phrases
-        if services['phrases'] :
-            keyphrases_response = comprehend_client.detect_key_phrases(
-                Text=transcription_text,
-                LanguageCode='en'
-            )
-
-            s3_object = s3_resource.Object(output_bucket, '{}/metadata/phrases.json'.format(input_key))
-            s3_object.put(
-                Body=(bytes(json.dumps(keyphrases_response).encode('UTF-8')))
-            )
-            # Send SQS message for completed phrases.
-            sqs_send_message(input_key, 'SUCCEEDED', 'PhrasesComplete')  # Send message to SQS queue.
-
-        # Detect entities
-        if services['entities']:
-            entities_response = comprehend_client.detect_entities(
-                Text=transcription_text,
-                LanguageCode='en'
-            )
-
-            s3_object = s3_resource.Object(output_bucket, '{}/metadata/entities.json'.format(input_key))
-            s3_object.put(
-                Body=(bytes(json.dumps(entities_response).encode('UTF-8')))
-            )
-            # Send SQS message for completed phrases.
-            sqs_send_message(input_key, 'SUCCEEDED', 'EntitiesComplete')  # Send message to SQS queue.
+    # A redelivered event would download the transcript and run every analysis again.
+    run_once(idempotency_store, input_key, 'TranscribeComplete', job_name, process_transcript, input_key,
+             transcription_url, status_emitter=status_emitter)
@@ -0,0 +1,200 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for skipping duplicate event deliveries, using the local store.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import unittest
+from unittest import mock
+
+from lambda_common import IdempotencyStore, LocalJsonStore, S3JsonStore, StatusEmitter, run_once
+
+
+class FakeSqsClient:
+    """
+    Records sent batches, failing every entry while fail is set, and entries with a body in fail_bodies.
+    """
+
+    def __init__(self):
+        self.fail = False
+        self.fail_bodies = set()
+        self.sent = []
+        self.batches = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append(len(Entries))
+        failed = [entry for entry in Entries if self.fail or entry['MessageBody'] in self.fail_bodies]
+        self.sent.extend(entry for entry in Entries if entry not in failed)
+        return {
+            'Successful': [dict(Id=entry['Id']) for entry in Entries if entry not in failed],
+            'Failed': [dict(Id=entry['Id'], SenderFault=True) for entry in failed],
+            }
+
+
+class ClientError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class S3JsonStoreTest(unittest.TestCase):
+
+    def test_missing_document(self):
+        # S3 reports a missing key as 404 or NotFound as well as NoSuchKey, depending on the request.
+        for code in ('NoSuchKey', '404', 'NotFound'):
+            s3_client = mock.Mock()
+            s3_client.get_object.side_effect = ClientError(code)
+            self.assertIsNone(S3JsonStore(s3_client, 'bucket', 'idempotency/').get('key.json'))
+
+        s3_client.get_object.side_effect = ClientError('AccessDenied')
+        with self.assertRaises(ClientError):
+            S3JsonStore(s3_client, 'bucket', 'idempotency/').get('key.json')
+
+
+class IdempotencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.store = IdempotencyStore(LocalJsonStore(), ttl=3600, lease=60)
+        self.calls = []
+
+    def handle(self, value):
+        self.calls.append(value)
+
+    def test_duplicate_is_skipped(self):
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job1', self.handle, 1))
+        self.assertFalse(run_once(self.store, 'key', 'S3', 'job1', self.handle, 2))
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job2', self.handle, 3))
+        self.assertTrue(run_once(self.store, 'key', 'TranscribeComplete', 'job1', self.handle, 4))
+        self.assertEqual([1, 3, 4], self.calls)
+
+    def test_duplicate_in_another_container_is_skipped(self):
+        run_once(self.store, 'key', 'S3', 'job1', self.handle, 1)
+
+        # A cold container only has the shared store to go on.
+        other = IdempotencyStore(self.store.store, ttl=3600, lease=60)
+        self.assertFalse(run_once(other, 'key', 'S3', 'job1', self.handle, 2))
+        self.assertEqual([1], self.calls)
+
+    def test_done_is_forgotten_after_ttl(self):
+        run_once(self.store, 'key', 'S3', 'job1', self.handle, 1)
+
+        self.now += 3601
+        other = IdempotencyStore(self.store.store, ttl=3600, lease=60)
+        self.assertTrue(run_once(other, 'key', 'S3', 'job1', self.handle, 2))
+        self.assertEqual([1, 2], self.calls)
+
+    def test_failure_mid_run_releases_the_claim(self):
+        def fail(value):
+            self.calls.append(value)
+            raise ValueError('Failed part way')
+
+        with self.assertRaises(ValueError):
+            run_once(self.store, 'key', 'S3', 'job1', fail, 1)
+
+        # The retry is handled, not skipped as a duplicate.
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job1', self.handle, 2))
+        self.assertEqual([1, 2], self.calls)
+
+    def test_claim_is_held_until_the_lease_runs_out(self):
+        self.assertTrue(self.store.claim('key', 'S3', 'job1'))
+
+        # Another delivery while the first is still being handled.
+        self.assertFalse(run_once(self.store, 'key', 'S3', 'job1', self.handle, 1))
+
+        # The handler died, so the claim is taken over.
+        self.now += 61
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job1', self.handle, 2))
+        self.assertEqual([2], self.calls)
+
+    def test_done_once_status_messages_are_sent(self):
+        sqs_client = FakeSqsClient()
+        emitter = StatusEmitter(sqs_client)
+
+        def handle(value):
+            emitter.send(QueueUrl='queue', MessageBody=str(value))
+
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job1', handle, 1, status_emitter=emitter))
+        # Not done until the flush, the claim holds off duplicates meanwhile.
+        self.assertFalse(self.store.claim('key', 'S3', 'job1'))
+        emitter.flush()
+
+        self.assertEqual(['1'], [entry['MessageBody'] for entry in sqs_client.sent])
+        self.assertFalse(run_once(self.store, 'key', 'S3', 'job1', handle, 2, status_emitter=emitter))
+
+    def test_unsent_status_messages_release_the_claim(self):
+        sqs_client = FakeSqsClient()
+        emitter = StatusEmitter(sqs_client)
+
+        def handle(value):
+            emitter.send(QueueUrl='queue', MessageBody=str(value))
+
+        sqs_client.fail = True
+        run_once(self.store, 'key', 'S3', 'job1', handle, 1, status_emitter=emitter)
+        with self.assertRaises(RuntimeError):
+            emitter.flush()
+
+        # The retry of the invocation sends the message again.
+        sqs_client.fail = False
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job1', handle, 2, status_emitter=emitter))
+        emitter.flush()
+        self.assertEqual(['2'], [entry['MessageBody'] for entry in sqs_client.sent])
+
+    def test_only_events_with_unsent_messages_release_their_claims(self):
+        sqs_client = FakeSqsClient()
+        emitter = StatusEmitter(sqs_client)
+
+        def handle(value):
+            emitter.send(QueueUrl='queue', MessageBody=str(value))
+
+        sqs_client.fail_bodies = {'1'}
+        run_once(self.store, 'key', 'S3', 'job1', handle, 1, status_emitter=emitter)
+        run_once(self.store, 'key', 'S3', 'job2', handle, 2, status_emitter=emitter)
+        with self.assertRaises(RuntimeError):
+            emitter.flush()
+
+        # Only the event whose message wasn't sent is handled again.
+        self.assertTrue(run_once(self.store, 'key', 'S3', 'job1', self.handle, 3))
+        self.assertFalse(run_once(self.store, 'key', 'S3', 'job2', self.handle, 4))
+        self.assertEqual([3], self.calls)
+
+    def test_batches_count_message_attributes(self):
+        sqs_client = FakeSqsClient()
+        emitter = StatusEmitter(sqs_client)
+
+        # Each body is well within the limit, but not with its attribute.
+        attributes = {'payload': {'DataType': 'String', 'StringValue': 'x' * 100000}}
+        for value in range(3):
+            emitter.send(QueueUrl='queue', MessageBody=str(value), MessageAttributes=attributes)
+        emitter.flush()
+
+        self.assertEqual([2, 1], sqs_client.batches)
+
+    def test_without_a_store_every_delivery_is_handled(self):
+        self.assertTrue(run_once(None, 'key', 'S3', 'job1', self.handle, 1))
+        self.assertTrue(run_once(None, 'key', 'S3', 'job1', self.handle, 2))
+        self.assertEqual([1, 2], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
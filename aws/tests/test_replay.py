@@ -0,0 +1,119 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for reusing the results of processes that already finished for the same media.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import os
+import unittest
+from unittest import mock
+
+import lambda_ai_trigger
+from lambda_common import LocalDedupIndex
+
+
+class ClientError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    """
+    An output bucket of keys, copies fail for keys that aren't there.
+    """
+
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.keys:
+            raise ClientError('404')
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource):
+        if CopySource['Key'] not in self.keys:
+            raise ClientError('NoSuchKey')
+        self.keys.add(Key)
+
+
+def make_jobs(*processes):
+    return [(process, None, 'media', None, None) for process in processes]
+
+
+class ReplayFinishedProcessesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3_client = FakeS3Client()
+        self.dedup_index = LocalDedupIndex()
+        self.sent = []
+        # Label detection and transcription enabled, without analyses.
+        metadata = {'processes': '11000000'}
+
+        for patcher in (
+                mock.patch.object(lambda_ai_trigger, 's3_client', self.s3_client),
+                mock.patch.object(lambda_ai_trigger, 'get_dedup_index', lambda s3_client: self.dedup_index),
+                mock.patch.object(lambda_ai_trigger, 'get_source_fingerprint', lambda *args: 'fingerprint'),
+                mock.patch.object(lambda_ai_trigger, 'get_object_metadata', lambda *args: metadata),
+                mock.patch.object(lambda_ai_trigger, 'get_manifest', lambda s3_client: None),
+                mock.patch.object(lambda_ai_trigger, 'sqs_send_message',
+                                  lambda input_key, status, message, process: self.sent.append((process, status))),
+                mock.patch.dict(os.environ, {'OutputBucket': 'output', 'InputBucket': 'input'})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def record(self, process, object_key, status='SUCCEEDED'):
+        self.dedup_index.record('fingerprint', process, {'objectkey': object_key, 'status': status, 'message': {}})
+
+    def test_source_finished_after_its_metadata_was_copied(self):
+        # The conversions and metadata of source were copied to key before its label detection finished.
+        self.s3_client.keys.add('source/metadata/Labels.json')
+        self.record('StartLabelDetection', 'source')
+
+        remaining = lambda_ai_trigger.replay_finished_processes(
+            'key', 'source', make_jobs('StartLabelDetection', 'TranscribeComplete'))
+
+        self.assertEqual(['TranscribeComplete'], [job[0] for job in remaining])
+        self.assertEqual([('StartLabelDetection', 'SUCCEEDED')], self.sent)
+        self.assertIn('key/metadata/Labels.json', self.s3_client.keys)
+
+    def test_missing_results_are_run_again(self):
+        self.record('StartLabelDetection', 'source')
+        self.record('TranscribeComplete', 'key')
+
+        remaining = lambda_ai_trigger.replay_finished_processes(
+            'key', 'source', make_jobs('StartLabelDetection', 'TranscribeComplete'))
+
+        self.assertEqual(['StartLabelDetection', 'TranscribeComplete'], [job[0] for job in remaining])
+        self.assertEqual([], self.sent)
+
+    def test_results_of_the_same_key_are_checked(self):
+        self.s3_client.keys.add('key/metadata/transcription.json')
+        self.record('TranscribeComplete', 'key')
+        self.record('StartLabelDetection', 'key', 'FAILED')
+
+        remaining = lambda_ai_trigger.replay_finished_processes(
+            'key', None, make_jobs('StartLabelDetection', 'TranscribeComplete'))
+
+        self.assertEqual([], remaining)
+        self.assertEqual([('StartLabelDetection', 'FAILED'), ('TranscribeComplete', 'SUCCEEDED')], self.sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
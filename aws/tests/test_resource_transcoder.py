@@ -0,0 +1,144 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for the Elastic Transcoder pipeline pool custom resource.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import unittest
+from unittest import mock
+
+import lambda_resource_transcoder
+
+
+class ClientError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeEtClient:
+
+    def __init__(self):
+        self.pipelines = dict()
+        self.created = 0
+
+    def create_pipeline(self, Name, **kwargs):
+        self.created += 1
+        pipeline_id = 'pipeline{}'.format(self.created)
+        self.pipelines[pipeline_id] = Name
+        return {'Pipeline': {'Id': pipeline_id}}
+
+    def delete_pipeline(self, Id):
+        del self.pipelines[Id]
+
+
+class FakeLambdaClient:
+    """
+    A function's configuration, with another update getting in before the first try.
+    """
+
+    def __init__(self, conflicts=1):
+        self.variables = {'SmartmediaSqsQueue': 'queue'}
+        self.revision = 1
+        self.conflicts = conflicts
+
+    def get_function_configuration(self, FunctionName):
+        return {'Environment': {'Variables': dict(self.variables)}, 'RevisionId': str(self.revision)}
+
+    def update_function_configuration(self, FunctionName, Environment, RevisionId):
+        if self.conflicts:
+            self.conflicts -= 1
+            self.revision += 1
+            raise ClientError('PreconditionFailedException')
+        if RevisionId != str(self.revision):
+            raise ClientError('PreconditionFailedException')
+        self.variables = Environment['Variables']
+        self.revision += 1
+
+
+def make_event(request_type, pipeline_count, physical_resource_id=None):
+    event = {
+        'RequestType': request_type,
+        'RequestId': 'request',
+        'ResourceProperties': {
+            'Name': 'stack-Pipeline',
+            'PipelineCount': str(pipeline_count),
+            'Role': 'role',
+            'InputBucket': 'input',
+            'OutputBucket': 'output',
+            'Notifications': {'Progressing': 'topic', 'Completed': 'topic', 'Warning': 'topic', 'Error': 'topic'},
+            'TriggerFunction': 'stack_transcoder_trigger',
+            'TriggerVariable': 'PipelineIds',
+            },
+        }
+    if physical_resource_id is not None:
+        event['PhysicalResourceId'] = physical_resource_id
+
+    return event
+
+
+class ResourceTranscoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.et_client = FakeEtClient()
+        self.lambda_client = FakeLambdaClient()
+        for name, value in (('et_client', self.et_client), ('lambda_client', self.lambda_client)):
+            patcher = mock.patch.object(lambda_resource_transcoder, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_create_sets_trigger_pipelines(self):
+        status, response = lambda_resource_transcoder.create(make_event('Create', 2))
+
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual('pipeline1,pipeline2', response['physicalresourceid'])
+        self.assertEqual({'SmartmediaSqsQueue': 'queue', 'PipelineIds': 'pipeline1,pipeline2'},
+                         self.lambda_client.variables)
+
+    def test_update_moves_trigger_to_new_pool(self):
+        lambda_resource_transcoder.create(make_event('Create', 1))
+        status, response = lambda_resource_transcoder.update(make_event('Update', 3, 'pipeline1'))
+
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual('update', response['action'])
+        self.assertEqual('pipeline2,pipeline3,pipeline4', response['physicalresourceid'])
+        self.assertEqual('pipeline2,pipeline3,pipeline4', self.lambda_client.variables['PipelineIds'])
+
+        # Cloudformation then deletes the old pool, which the trigger no longer uses.
+        status, response = lambda_resource_transcoder.delete(make_event('Delete', 1, 'pipeline1'))
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual(['pipeline2', 'pipeline3', 'pipeline4'], sorted(self.et_client.pipelines))
+
+    def test_failed_update_keeps_old_pool(self):
+        lambda_resource_transcoder.create(make_event('Create', 1))
+        self.lambda_client.conflicts = lambda_resource_transcoder.TRIGGER_UPDATE_ATTEMPTS
+
+        status, response = lambda_resource_transcoder.update(make_event('Update', 2, 'pipeline1'))
+
+        self.assertEqual('FAILED', status)
+        self.assertEqual('pipeline1', response['physicalresourceid'])
+        self.assertEqual('pipeline1', self.lambda_client.variables['PipelineIds'])
+        self.assertEqual(['pipeline1'], sorted(self.et_client.pipelines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for per site admission control, using the local store and deferral queue.
+
+Run from the aws directory with: python3 -m unittest discover tests
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import unittest
+from unittest import mock
+
+from lambda_common import LocalDeferralQueue, LocalJsonStore, SiteAdmissionController
+
+
+class SiteAdmissionControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.queue = LocalDeferralQueue()
+        self.controller = SiteAdmissionController(LocalJsonStore(), self.queue, rate=1, burst=2, hold=60)
+
+    def test_admit_burst_then_rate(self):
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertFalse(self.controller.admit('site1'))
+
+        # A token comes back every second, up to the burst.
+        self.now += 1
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertFalse(self.controller.admit('site1'))
+        self.now += 100
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertFalse(self.controller.admit('site1'))
+
+    def test_sites_are_independent(self):
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertTrue(self.controller.admit('site1'))
+        self.assertFalse(self.controller.admit('site1'))
+        self.assertTrue(self.controller.admit('site2'))
+
+    def test_defer_holds_new_uploads(self):
+        self.controller.defer('site1', 'upload1')
+
+        # New uploads wait behind the deferred one, even with tokens left.
+        self.assertFalse(self.controller.admit('site1'))
+        self.assertTrue(self.controller.admit('site1', deferred=True))
+
+        # The hold runs out if nothing renews it.
+        self.now += 61
+        self.assertTrue(self.controller.admit('site1'))
+
+    def test_drain_takes_sites_in_turn(self):
+        for item in ('a1', 'a2'):
+            self.controller.defer('site1', item)
+        self.controller.defer('site2', 'b1')
+
+        admitted = self.controller.drain()
+        self.assertEqual(['a1', 'b1', 'a2'], [item for item, handle in admitted])
+
+        for item, handle in admitted:
+            self.controller.done(handle)
+        self.assertEqual([], self.queue.receive())
+
+    def test_drain_leaves_items_without_tokens(self):
+        for item in ('a1', 'a2', 'a3'):
+            self.controller.defer('site1', item)
+
+        admitted = self.controller.drain()
+        self.assertEqual(['a1', 'a2'], [item for item, handle in admitted])
+        for item, handle in admitted:
+            self.controller.done(handle)
+
+        # The rest stay queued and the site is still held.
+        self.assertEqual(['a3'], [item for site, item, handle in self.queue.receive()])
+        self.now += 1
+        self.assertFalse(self.controller.admit('site1'))
+
+        self.assertEqual(['a3'], [item for item, handle in self.controller.drain()])
+
+    def test_drained_site_is_admitted(self):
+        self.controller.defer('site1', 'a1')
+        self.assertFalse(self.controller.admit('site1'))
+
+        admitted = self.controller.drain()
+        self.assertEqual(['a1'], [item for item, handle in admitted])
+        for item, handle in admitted:
+            self.controller.done(handle)
+
+        # Nothing is deferred any more, so new uploads don't wait for the hold to run out.
+        self.assertTrue(self.controller.admit('site1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
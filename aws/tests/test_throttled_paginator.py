@@ -0,0 +1,102 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for retrying throttled and transiently failing calls while paging through results.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import unittest
+from unittest import mock
+
+from lambda_common import ThrottledPaginator, ThrottleMetrics
+
+
+class ClientError(Exception):
+
+    def __init__(self, code, status=400):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+
+class HTTPClientError(Exception):
+    pass
+
+
+class ConnectionClosedError(HTTPClientError):
+    """
+    Named like the botocore exception, which derives from HTTPClientError.
+    """
+
+
+class FakeMethod:
+    """
+    Returns pages of results, raising the given errors first.
+    """
+
+    def __init__(self, errors, pages=2):
+        self.errors = list(errors)
+        self.pages = pages
+        self.calls = 0
+
+    def __call__(self, NextToken=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        page = int(NextToken or 0)
+        return {'Page': page, 'NextToken': str(page + 1) if page + 1 < self.pages else ''}
+
+
+class ThrottledPaginatorTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_throttled_and_transient_failures_are_retried(self):
+        errors = [
+            ClientError('ThrottlingException'),
+            ClientError('InternalServerError', 500),
+            ClientError('SomethingElse', 503),
+            ConnectionClosedError('closed'),
+            ]
+        method = FakeMethod(errors)
+        metrics = ThrottleMetrics()
+        pages = list(ThrottledPaginator(method, metrics=metrics, max_retries=4).pages())
+
+        self.assertEqual([0, 1], [page['Page'] for page in pages])
+        self.assertEqual(1, metrics.snapshot()['throttled'])
+        self.assertEqual(3, metrics.snapshot()['transient'])
+
+    def test_other_errors_are_raised(self):
+        method = FakeMethod([ClientError('AccessDeniedException'), ValueError('bad')])
+        with self.assertRaises(ClientError):
+            list(ThrottledPaginator(method).pages())
+        with self.assertRaises(ValueError):
+            list(ThrottledPaginator(method).pages())
+
+    def test_gives_up_after_max_retries(self):
+        method = FakeMethod([ClientError('ServiceUnavailable', 503)] * 3)
+        metrics = ThrottleMetrics()
+        with self.assertRaises(ClientError):
+            list(ThrottledPaginator(method, metrics=metrics, max_retries=2).pages())
+        self.assertEqual(3, method.calls)
+        self.assertEqual(1, metrics.snapshot()['failed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for the compact track encoding of face and person results, read back compressed or not.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import io
+import json
+import os
+import unittest
+import zlib
+from unittest import mock
+
+import lambda_common
+import lambda_rekognition_complete
+from lambda_common import CompressingWriter
+from lambda_rekognition_complete import TrackEncoder, read_tracks, store_detection_results
+
+
+class BytesWriter:
+    """
+    Collects everything written to it, like an S3MultipartWriter.
+    """
+
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+        self.size = 0
+        self.checksum = ''
+
+    def write(self, data):
+        self.data += data
+        self.size += len(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def make_face(timestamp, index):
+    return {
+        'Timestamp': timestamp,
+        'Face': {
+            'BoundingBox': {'Left': 0.125, 'Top': 0.25, 'Width': 0.5, 'Height': 0.0625 * index},
+            'Confidence': 99.5,
+            'Pose': {'Roll': 1.5, 'Yaw': -20.0, 'Pitch': 3.0},
+            'Landmarks': [{'Type': 'eyeLeft', 'X': 0.25, 'Y': 0.5}],
+            },
+        }
+
+
+def make_pages(count=600, page_size=250):
+    faces = [make_face(timestamp * 40, timestamp % 3) for timestamp in range(count)]
+    return [
+        {'VideoMetadata': {'DurationMillis': count * 40}, 'Faces': faces[first:first + page_size]}
+        for first in range(0, count, page_size)
+        ]
+
+
+def encode(pages, writer):
+    encoder = TrackEncoder('Faces', writer, block_size=256)
+    for page in pages:
+        encoder.add_page(page)
+    encoder.close()
+    writer.close()
+
+
+def chunked(data, size=1000):
+    return [data[first:first + size] for first in range(0, len(data), size)]
+
+
+class TrackEncodingTest(unittest.TestCase):
+
+    def assert_round_trip(self, data, pages, start=None, end=None):
+        faces = [face for page in pages for face in page['Faces']]
+        expected = [
+            face for face in faces
+            if (start is None or face['Timestamp'] >= start) and (end is None or face['Timestamp'] <= end)
+            ]
+        detections = list(read_tracks(chunked(data), start, end))
+
+        timestamps = [timestamp for track, timestamp, detection in detections]
+        self.assertEqual([face['Timestamp'] for face in expected], timestamps)
+        for face, (track, timestamp, detection) in zip(expected, detections):
+            self.assertEqual(face['Face'], detection)
+
+    def test_plain_round_trip(self):
+        pages = make_pages()
+        writer = BytesWriter()
+        encode(pages, writer)
+
+        self.assert_round_trip(writer.data, pages)
+        self.assert_round_trip(writer.data, pages, 4000, 12000)
+        # Lines of a file opened in text mode work as well.
+        self.assertEqual(600, len(list(read_tracks(io.StringIO(writer.data.decode('UTF-8'))))))
+
+    def test_gzip_round_trip(self):
+        pages = make_pages()
+        writer = BytesWriter()
+        encode(pages, CompressingWriter(writer, 'gzip'))
+
+        self.assertTrue(writer.data.startswith(lambda_common.GZIP_MAGIC))
+        self.assert_round_trip(writer.data, pages)
+        self.assert_round_trip(writer.data, pages, 10000, None)
+
+    @unittest.skipIf(lambda_common.zstandard is None, 'zstandard is not installed')
+    def test_zstd_round_trip(self):
+        pages = make_pages()
+        writer = BytesWriter()
+        encode(pages, CompressingWriter(writer, 'zstd'))
+
+        self.assertTrue(writer.data.startswith(lambda_common.ZSTD_MAGIC))
+        self.assert_round_trip(writer.data, pages, None, 8000)
+
+    def test_empty_results(self):
+        writer = BytesWriter()
+        encode([], CompressingWriter(writer, 'gzip'))
+        self.assertEqual([], list(read_tracks(chunked(writer.data, 3))))
+
+
+class StoreDetectionResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.writers = dict()
+
+        def get_metadata_writer(s3_client, bucket, key, content_type='application/json', background=False):
+            self.writers[key] = BytesWriter()
+            return CompressingWriter(self.writers[key], 'gzip')
+
+        for patcher in (
+                mock.patch.object(lambda_rekognition_complete, 'get_metadata_writer', get_metadata_writer),
+                mock.patch.object(lambda_rekognition_complete, 'get_detection_results',
+                                  lambda job_id, method, sort: iter(make_pages())),
+                mock.patch.object(lambda_rekognition_complete, 'describe_artifact', lambda writer, *args: {})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_raw_results_are_kept_with_tracks(self):
+        for mode in ('alongside', 'instead'):
+            with mock.patch.dict(os.environ, {'TrackEncoding': mode}):
+                artifacts = store_detection_results('job', 'get_face_detection', '', 'Faces', 'bucket', 'hash', 'faces')
+
+            self.assertEqual(['Faces.json', 'Faces.tracks.jsonl'], sorted(artifacts))
+            raw = json.loads(zlib.decompress(self.writers['hash/metadata/Faces.json'].data, 16 + zlib.MAX_WBITS))
+            self.assertEqual(600, len(raw['labels']))
+
+            tracks = self.writers['hash/metadata/Faces.tracks.jsonl'].data
+            self.assertEqual(600, len(list(read_tracks(chunked(tracks)))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for choosing pipelines and splitting the outputs of a conversion over Elastic Transcoder jobs.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import json
+import os
+import unittest
+from unittest import mock
+
+import lambda_common
+import lambda_transcoder_trigger
+from lambda_common import classify_upload
+from lambda_transcoder_trigger import get_pipelines, plan_transcode_jobs
+
+
+def make_outputs(*keys):
+    return [{'Key': key, 'PresetId': key} for key in keys]
+
+
+def make_playlist(name, *keys):
+    return {'Name': name, 'Format': 'HLSv4', 'OutputKeys': list(keys)}
+
+
+def job_keys(jobs):
+    return [[output['Key'] for output in job_outputs] for job_outputs, job_playlists in jobs]
+
+
+class PlanTranscodeJobsTest(unittest.TestCase):
+
+    def test_no_outputs(self):
+        self.assertEqual([], plan_transcode_jobs([], [], 30))
+
+    def test_fits_in_one_job(self):
+        outputs = make_outputs('a', 'b', 'c')
+        playlist = make_playlist('hls', 'b', 'c')
+        jobs = plan_transcode_jobs(outputs, [playlist], 30)
+
+        self.assertEqual([['a', 'b', 'c']], job_keys(jobs))
+        self.assertEqual([playlist], jobs[0][1])
+
+    def test_split_over_jobs(self):
+        outputs = make_outputs(*['o{}'.format(number) for number in range(7)])
+        jobs = plan_transcode_jobs(outputs, [], 3)
+
+        self.assertEqual(3, len(jobs))
+        self.assertTrue(all(len(job_outputs) <= 3 for job_outputs, job_playlists in jobs))
+        self.assertEqual(sorted(output['Key'] for output in outputs), sorted(sum(job_keys(jobs), [])))
+
+    def test_playlist_stays_in_one_job(self):
+        outputs = make_outputs('a', 'h1', 'b', 'h2', 'h3', 'd1', 'd2')
+        hls = make_playlist('hls', 'h1', 'h2', 'h3')
+        dash = make_playlist('dash', 'd1', 'd2')
+        jobs = plan_transcode_jobs(outputs, [hls, dash], 4)
+
+        self.assertEqual(2, len(jobs))
+        for job_outputs, job_playlists in jobs:
+            self.assertLessEqual(len(job_outputs), 4)
+            keys = [output['Key'] for output in job_outputs]
+            for playlist in job_playlists:
+                self.assertTrue(set(playlist['OutputKeys']) <= set(keys))
+
+        # Each playlist is in exactly one job, and outputs keep their original order.
+        self.assertEqual(['dash', 'hls'], sorted(playlist['Name'] for job in jobs for playlist in job[1]))
+        order = [output['Key'] for output in outputs]
+        for keys in job_keys(jobs):
+            self.assertEqual(sorted(keys, key=order.index), keys)
+
+    def test_empty_playlist_is_dropped(self):
+        jobs = plan_transcode_jobs(make_outputs('a'), [make_playlist('hls')], 30)
+        self.assertEqual([(make_outputs('a'), [])], jobs)
+
+    def test_playlist_over_the_limit(self):
+        outputs = make_outputs('h1', 'h2', 'h3')
+        with self.assertRaises(ValueError):
+            plan_transcode_jobs(outputs, [make_playlist('hls', 'h1', 'h2', 'h3')], 2)
+
+
+class FakePaginator:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages)
+
+
+class GetPipelinesTest(unittest.TestCase):
+
+    def setUp(self):
+        pipelines = [
+            {'Id': 'p1', 'Name': 'stack-Pipeline'},
+            {'Id': 'p2', 'Name': 'stack-Pipeline-1'},
+            {'Id': 'other', 'Name': 'stack-Pipeline-old'},
+            {'Id': 's1', 'Name': 'stack-ShortLanePipeline'},
+            ]
+        et_client = mock.Mock()
+        pages = [{'Pipelines': pipelines[:2]}, {'Pipelines': pipelines[2:]}]
+        et_client.get_paginator.return_value = FakePaginator(pages)
+        environment = {'PipelineName': 'stack-Pipeline', 'ShortLanePipelineName': 'stack-ShortLanePipeline'}
+
+        for patcher in (
+                mock.patch.object(lambda_transcoder_trigger, 'et_client', et_client),
+                mock.patch.object(lambda_transcoder_trigger, 'pool_pipelines', dict()),
+                mock.patch.dict(os.environ, environment)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ('PipelineIds', 'PipelineId', 'ShortLanePipelineIds'):
+            os.environ.pop(name, None)
+
+    def test_ids_from_environment(self):
+        os.environ['PipelineIds'] = 'a,b,c'
+        os.environ['ShortLanePipelineIds'] = 'c'
+
+        self.assertEqual(['a', 'b'], get_pipelines('standard'))
+        self.assertEqual(['c'], get_pipelines('short'))
+
+    def test_pools_found_by_name(self):
+        # The environment of the function was reset by a stack update.
+        self.assertEqual(['p1', 'p2'], get_pipelines('standard'))
+        self.assertEqual(['s1'], get_pipelines('short'))
+
+
+class ClassifyUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (
+                mock.patch.object(lambda_common, 'SHORT_LANE_SECONDS', 300),
+                mock.patch.object(lambda_common, 'SHORT_LANE_BYTES', 1000)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_duration_before_size(self):
+        self.assertEqual('short', classify_upload({'Metadata': {'duration': '299.5'}, 'ContentLength': 5000}))
+        self.assertEqual('standard', classify_upload({'Metadata': {'duration': '301'}, 'ContentLength': 10}))
+        self.assertEqual('short', classify_upload({'Metadata': {}, 'ContentLength': 10}))
+
+    def test_bad_duration_falls_back_to_size(self):
+        for duration in ('', 'unknown', '1:30', ['300']):
+            self.assertEqual('short', classify_upload({'Metadata': {'duration': duration}, 'ContentLength': 10}))
+            self.assertEqual('standard', classify_upload({'Metadata': {'duration': duration}, 'ContentLength': 5000}))
+
+        with mock.patch.object(lambda_common, 'SHORT_LANE_BYTES', 0):
+            self.assertEqual('standard', classify_upload({'Metadata': {'duration': 'unknown'}, 'ContentLength': 10}))
+
+
+class FakeJobsPaginator:
+    """
+    Pages of each pipeline's jobs, newest first, counting the pages read.
+    """
+
+    def __init__(self, jobs, page_size=2):
+        self.jobs = jobs
+        self.page_size = page_size
+        self.pages_read = 0
+
+    def paginate(self, PipelineId, Ascending):
+        jobs = [{'Status': status} for status in self.jobs.get(PipelineId, [])]
+        for first in range(0, len(jobs), self.page_size):
+            self.pages_read += 1
+            yield {'Jobs': jobs[first:first + self.page_size]}
+
+
+class LeastOutstandingPolicyTest(unittest.TestCase):
+
+    def test_fewest_outstanding_jobs(self):
+        paginator = FakeJobsPaginator({
+            'a': ['Progressing', 'Submitted', 'Progressing', 'Complete', 'Complete', 'Complete', 'Progressing'],
+            'b': ['Submitted', 'Complete'],
+            'c': ['Complete', 'Error', 'Progressing'],
+            })
+        et_client = mock.Mock()
+        et_client.get_paginator.return_value = paginator
+
+        with mock.patch.object(lambda_transcoder_trigger, 'et_client', et_client):
+            policy = lambda_transcoder_trigger.LeastOutstandingPolicy()
+            chosen = [policy.choose(['a', 'b', 'c'], {}) for attempt in range(4)]
+
+        # Each pipeline's jobs are listed on their own, up to the first page without outstanding jobs.
+        et_client.get_paginator.assert_called_once_with('list_jobs_by_pipeline')
+        self.assertEqual(3 + 1 + 1, paginator.pages_read)
+        self.assertEqual(['c', 'b', 'c', 'b'], chosen)
+
+
+def make_record(key):
+    return {'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': 'input'}, 'object': {'key': key}}}
+
+
+class LambdaHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.failing = set()
+        self.processed = []
+
+        def process_records(records, deferred=False):
+            self.processed.extend(record['s3']['object']['key'] for record in records)
+            return [record for record in records if record['s3']['object']['key'] in self.failing]
+
+        self.lambda_client = mock.Mock()
+        for patcher in (
+                mock.patch.object(lambda_transcoder_trigger, 'process_records', process_records),
+                mock.patch.object(lambda_transcoder_trigger, 'lambda_client', self.lambda_client),
+                mock.patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_NAME': 'stack_transcoder_trigger'})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_only_failed_records_are_retried(self):
+        self.failing = {'b'}
+        lambda_transcoder_trigger.lambda_handler({'Records': [make_record('a'), make_record('b')]}, None)
+
+        self.lambda_client.invoke.assert_called_once_with(
+            FunctionName='stack_transcoder_trigger', InvocationType='Event', Payload=mock.ANY)
+        payload = json.loads(self.lambda_client.invoke.call_args[1]['Payload'])
+        self.assertEqual([make_record('b')], payload['Records'])
+
+        # The retry invocation succeeds on its own.
+        self.failing = set()
+        lambda_transcoder_trigger.lambda_handler(payload, None)
+        self.assertEqual(['a', 'b', 'b'], self.processed)
+        self.assertEqual(1, self.lambda_client.invoke.call_count)
+
+    def test_all_failed_fails_the_invocation(self):
+        self.failing = {'a', 'b'}
+        with self.assertRaises(RuntimeError):
+            lambda_transcoder_trigger.lambda_handler({'Records': [make_record('a'), make_record('b')]}, None)
+        self.lambda_client.invoke.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for reading the transcript text from a Transcribe result and segmenting it for Comprehend.
+
+@copyright   2019 Matt Porritt <mattp@catalyst-au.net>
+@license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+
+'''
+
+import json
+import random
+import unittest
+
+from lambda_transcribe_complete import TRANSCRIPT_TEXT_PATH, JsonValueExtractor, segment_transcript
+
+TEXT = 'Hello "world", a\\b / tab\there.\nCafé — \U0001F600 done.'
+
+# Keys named like the path elsewhere in the document, values of every type, and a second transcript.
+DOCUMENT = json.dumps({
+    'jobName': 'job',
+    'accountId': 123,
+    'transcript': 'not this one',
+    'status': 'COMPLETED',
+    'flags': [True, False, None, -1.5e3, {'transcript': 'nor this'}],
+    'results': {
+        'language_code': 'en-AU',
+        'transcripts': [{'transcript': TEXT}, {'transcript': 'second'}],
+        'items': [{'start_time': '0.0', 'alternatives': [{'confidence': '0.9', 'content': 'Hello'}]}],
+        },
+    })
+
+
+def extract(chunks, path=TRANSCRIPT_TEXT_PATH):
+    extractor = JsonValueExtractor(path)
+    for chunk in chunks:
+        extractor.feed(chunk)
+        if extractor.done:
+            break
+
+    return extractor
+
+
+class JsonValueExtractorTest(unittest.TestCase):
+
+    def test_whole_document(self):
+        extractor = extract([DOCUMENT])
+        self.assertTrue(extractor.done)
+        self.assertEqual(TEXT, extractor.value)
+
+    def test_ascii_escaped_document(self):
+        # Transcribe may escape every non ASCII character, including surrogate pairs.
+        document = json.dumps(json.loads(DOCUMENT), ensure_ascii=True)
+        self.assertEqual(TEXT, extract([document]).value)
+
+    def test_every_split_point(self):
+        for document in (DOCUMENT, json.dumps(json.loads(DOCUMENT), ensure_ascii=True, indent=2)):
+            for split in range(len(document) + 1):
+                extractor = extract([document[:split], document[split:]])
+                self.assertEqual(TEXT, extractor.value, 'Split at {}'.format(split))
+
+    def test_random_chunks(self):
+        generator = random.Random(42)
+        document = json.dumps(json.loads(DOCUMENT), ensure_ascii=True)
+        for attempt in range(200):
+            chunks = []
+            position = 0
+            while position < len(document):
+                size = generator.randint(1, 16)
+                chunks.append(document[position:position + size])
+                position += size
+            self.assertEqual(TEXT, extract(chunks).value, 'Chunks {}'.format(chunks))
+
+    def test_single_characters(self):
+        self.assertEqual(TEXT, extract(list(DOCUMENT)).value)
+
+    def test_other_paths(self):
+        self.assertEqual('second', extract([DOCUMENT], ('results', 'transcripts', 1, 'transcript')).value)
+        self.assertEqual('not this one', extract([DOCUMENT], ('transcript',)).value)
+        self.assertEqual('Hello', extract([DOCUMENT], ('results', 'items', 0, 'alternatives', 0, 'content')).value)
+
+    def test_missing_value(self):
+        extractor = extract([json.dumps({'results': {'transcripts': []}})])
+        self.assertFalse(extractor.done)
+        self.assertIsNone(extractor.value)
+
+
+class SegmentTranscriptTest(unittest.TestCase):
+
+    def assert_segments(self, text, segments, max_bytes):
+        """
+        Segments must cover the whole text in order, at their offsets, and each fit the size limit.
+        """
+        self.assertEqual(text, ''.join(document for offset, document in segments))
+        for offset, document in segments:
+            self.assertEqual(document, text[offset:offset + len(document)])
+            self.assertLessEqual(len(document.encode('utf-8')), max_bytes)
+
+    def test_short_text_is_one_segment(self):
+        text = 'One sentence. Two sentences!'
+        self.assertEqual([(0, text)], segment_transcript(text, 100))
+
+    def test_empty_text(self):
+        self.assertEqual([], segment_transcript('', 100))
+
+    def test_split_on_sentences(self):
+        sentences = ['Sentence number {}. '.format(number) for number in range(50)]
+        text = ''.join(sentences).strip()
+        segments = segment_transcript(text, 100)
+
+        self.assert_segments(text, segments, 100)
+        self.assertGreater(len(segments), 1)
+        for offset, document in segments[:-1]:
+            self.assertTrue(document.endswith('. '), document)
+
+        # Sentences are packed, so no two neighbouring segments would fit in one.
+        for (offset, document), (next_offset, next_document) in zip(segments, segments[1:]):
+            first_sentence = next_document.split('. ')[0] + '. '
+            self.assertGreater(len((document + first_sentence).encode('utf-8')), 100)
+
+    def test_long_sentence_splits_on_whitespace(self):
+        text = ' '.join(['word'] * 100)
+        segments = segment_transcript(text, 32)
+
+        self.assert_segments(text, segments, 32)
+        # Whole words only.
+        for offset, document in segments:
+            self.assertEqual(document.split(), ['word'] * len(document.split()))
+            self.assertTrue(document.startswith('word'), document)
+
+    def test_long_word_is_cut(self):
+        text = 'a' * 100
+        segments = segment_transcript(text, 30)
+
+        self.assert_segments(text, segments, 30)
+        self.assertEqual(4, len(segments))
+
+    def test_limit_is_in_bytes(self):
+        # Each of these characters is 3 bytes in UTF-8.
+        text = '\u65e5\u672c\u8a9e\u3002 ' * 20
+        segments = segment_transcript(text, 40)
+
+        self.assert_segments(text, segments, 40)
+        self.assertGreater(len(segments), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
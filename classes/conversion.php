@@ -719,7 +719,7 @@ class conversion {
      * @return array $settings The conversion record settings.
      */
     private function get_conversion_settings(\stdClass $conversionrecord) : array {
-        global $CFG;
+        global $CFG, $DB;
         $settings = array();
 
         // Metadata space per S3 object is limited so do some dirty encoding
@@ -742,6 +742,17 @@ class conversion {
         $settings['presets'] = $this->create_presets_metadata($presets);
         $settings['siteid'] = $CFG->siteidentifier;
 
+        // Source properties from the metadata extraction, so AWS can skip renditions
+        // that would be bigger than the source. S3 metadata values have to be strings.
+        $sourcedata = $DB->get_record('local_smartmedia_data', array('contenthash' => $conversionrecord->contenthash),
+            'duration, bitrate, width, height');
+        if ($sourcedata) {
+            $settings['duration'] = (string)$sourcedata->duration;
+            $settings['bitrate'] = (string)$sourcedata->bitrate;
+            $settings['width'] = (string)$sourcedata->width;
+            $settings['height'] = (string)$sourcedata->height;
+        }
+
         return $settings;
     }
 
@@ -901,6 +912,9 @@ class conversion {
             $services[] = 'EntitiesComplete';
         }
 
+        // Completion messages carry the outcome of every process of the object.
+        $services[] = 'completion';
+
         // Get all queue messages for this object.
         list($processinsql, $processinparams) = $DB->get_in_or_equal($services);
         list($statusinsql, $statusinparams) = $DB->get_in_or_equal(self::SQS_MESSAGE_STATES);
@@ -950,6 +964,32 @@ class conversion {
         return true;
     }
 
+    /**
+     * Get the manifest AWS keeps of everything made for a file.
+     * It lists the renditions, playlists, conversion files and metadata files with their details.
+     *
+     * @param \Aws\S3\S3Client $s3client The S3 client to use.
+     * @param string $contenthash The contenthash of the file.
+     * @return array|null $manifest The decoded manifest, or null if there isn't one.
+     */
+    private function get_manifest($s3client, string $contenthash) {
+        $downloadparams = array(
+                'Bucket' => $this->config->s3_output_bucket, // Required.
+                'Key' => $contenthash . '/manifest.json', // Required.
+        );
+
+        try {
+            $result = $s3client->getObject($downloadparams);
+        } catch (\Exception $e) {
+            // Manifests are optional, older stacks don't write them.
+            return null;
+        }
+
+        $manifest = json_decode((string)$result['Body'], true);
+
+        return is_array($manifest) ? $manifest : null;
+    }
+
     /**
      * Get the transcoded media files from AWS S3,
      *
@@ -964,18 +1004,27 @@ class conversion {
         $transcodedfiles = [];
 
         // Transcoding could have made many files, but the job only calls success when all files are generated.
-        // So first we get a list of the files.
-        $listparams = array(
-                'Bucket' => $this->config->s3_output_bucket,
-                'MaxKeys' => 1000,  // The maximum allowed before we need to page, we should NEVER have this many.
-                'Prefix' => $conversionrecord->contenthash . '/conversions/',  // Location in the S3 bucket where the files live.
-        );
-        $availableobjects = $s3client->listObjects($listparams);
+        // So first we get a list of the files, from the manifest if AWS keeps one.
+        $prefix = $conversionrecord->contenthash . '/conversions/';  // Location in the S3 bucket where the files live.
+        $manifest = $this->get_manifest($s3client, $conversionrecord->contenthash);
+        $availableobjects = array();
+        if (!empty($manifest['conversions'])) {
+            foreach (array_keys($manifest['conversions']) as $filename) {
+                $availableobjects[] = array('Key' => $prefix . $filename);
+            }
+        } else {
+            $listparams = array(
+                    'Bucket' => $this->config->s3_output_bucket,
+                    'MaxKeys' => 1000,  // The maximum allowed before we need to page, we should NEVER have this many.
+                    'Prefix' => $prefix,
+            );
+            $availableobjects = $s3client->listObjects($listparams)->get('Contents');
+        }
 
         // Then we iterate over that list and get all the files available.
         $fs = get_file_storage();
         $requestdir = make_request_directory();
-        foreach ($availableobjects->get('Contents') as $availableobject) {
+        foreach ($availableobjects as $availableobject) {
             $filename = basename($availableobject['Key']);
             $filerecord = array(
                 'contextid' => 1, // Put files in the site level context as they aren't associated with a specific context.
@@ -1018,6 +1067,13 @@ class conversion {
                 // Either way, there isn't anything we can do about it.
                 // Move on.
                 continue;
+            } catch (S3Exception $e) {
+                // The manifest may list a file that is no longer in the bucket, skip it.
+                debugging('local_smartmedia: Failed to get object with key: ' . $availableobject['Key'] . ' from output bucket.');
+                if (isset($filetarget) && file_exists($filetarget)) {
+                    unlink($filetarget);
+                }
+                continue;
             }
             $transcodedfiles[] = $transcodedfile;
         }
@@ -1116,6 +1172,30 @@ class conversion {
         return $keys;
     }
 
+    /**
+     * Decompress the body of a data file according to its content encoding.
+     * The HTTP client may already have decoded it, so it is only decoded if it is still compressed.
+     *
+     * @param string $body The data file body.
+     * @param string $contentencoding The content encoding of the data file object.
+     * @return string|false $body The decoded body, or false if it can't be decoded.
+     */
+    private function decode_data_file(string $body, string $contentencoding) {
+        if ($contentencoding == 'gzip' && substr($body, 0, 2) === "\x1f\x8b") {
+            return gzdecode($body);
+        }
+
+        if ($contentencoding == 'zstd' && substr($body, 0, 4) === "\x28\xb5\x2f\xfd") {
+            // Zstandard support needs the zstd PHP extension.
+            if (!function_exists('zstd_uncompress')) {
+                return false;
+            }
+            return zstd_uncompress($body);
+        }
+
+        return $body;
+    }
+
     /**
      * Get the file from AWS for a given conversion process.
      *
@@ -1152,8 +1232,15 @@ class conversion {
             return false;
         }
 
+        // Data files may be stored compressed.
+        $body = $this->decode_data_file((string)$getobject['Body'], (string)$getobject['ContentEncoding']);
+        if ($body === false) {
+            debugging("Failed decoding data file {$downloadparams['Key']} from output bucket.");
+            return false;
+        }
+
         $tmpfile = tmpfile();
-        fwrite($tmpfile, $getobject['Body']);
+        fwrite($tmpfile, $body);
         $tmppath = stream_get_meta_data($tmpfile)['uri'];
 
         try {
@@ -1186,40 +1273,54 @@ class conversion {
         }
 
         foreach ($queuemessages as $message) {
-            if ($message->status == 'ERROR' && $message->process == 'elastic_transcoder') {
-                // If Elastic Transcoder conversion has failed then all other conversions have also failed.
-                // It is also highly likely this will be the only message recevied.
-                $conversionrecord->status = self::CONVERSION_ERROR;
-                $conversionrecord->transcoder_status = self::CONVERSION_ERROR;
-                $conversionrecord->rekog_label_status = self::CONVERSION_ERROR;
-                $conversionrecord->rekog_moderation_status = self::CONVERSION_ERROR;
-                $conversionrecord->rekog_face_status = self::CONVERSION_ERROR;
-                $conversionrecord->rekog_person_status = self::CONVERSION_ERROR;
-                $conversionrecord->timecreated = time();
-                $conversionrecord->timecompleted = time();
-
-                break;
-
-            } else if ($message->status == 'COMPLETED' || $message->status == 'SUCCEEDED') {
-                // For each successful status get the file/s for the conversion.
-                if ($message->process == 'elastic_transcoder') {
-                    // Get Elastic Transcoder files.
-                    $this->get_transcode_files($conversionrecord, $handler);
-
-                    $conversionrecord->transcoder_status = self::CONVERSION_FINISHED;
+            if ($message->process == 'completion') {
+                // A completion message has the outcome of every process that was still pending.
+                $outcomes = (array)json_decode($message->message)->outcomes;
+            } else {
+                $outcomes = array($message->process => $message->status);
+            }
 
-                } else {
-                    // Get other process data files.
-                    $this->get_data_file($conversionrecord, $message->process, $handler);
+            foreach ($outcomes as $process => $status) {
+                if ($status == 'ERROR' && $process == 'elastic_transcoder') {
+                    // If Elastic Transcoder conversion has failed then all other conversions have also failed.
+                    // It is also highly likely this will be the only message recevied.
+                    $conversionrecord->status = self::CONVERSION_ERROR;
+                    $conversionrecord->transcoder_status = self::CONVERSION_ERROR;
+                    $conversionrecord->rekog_label_status = self::CONVERSION_ERROR;
+                    $conversionrecord->rekog_moderation_status = self::CONVERSION_ERROR;
+                    $conversionrecord->rekog_face_status = self::CONVERSION_ERROR;
+                    $conversionrecord->rekog_person_status = self::CONVERSION_ERROR;
+                    $conversionrecord->timecreated = time();
+                    $conversionrecord->timecompleted = time();
+
+                    break 2;
+
+                } else if ($status == 'COMPLETED' || $status == 'SUCCEEDED') {
+                    // For each successful status get the file/s for the conversion.
+                    if ($process == 'elastic_transcoder') {
+                        // Get Elastic Transcoder files.
+                        $this->get_transcode_files($conversionrecord, $handler);
+
+                        $conversionrecord->transcoder_status = self::CONVERSION_FINISHED;
+
+                    } else {
+                        // Get other process data files.
+                        $this->get_data_file($conversionrecord, $process, $handler);
+
+                        $statusfield = self::SERVICE_MAPPING[$process][0];
+                        $conversionrecord->{$statusfield} = self::CONVERSION_FINISHED;
+                    }
 
-                    $statusfield = self::SERVICE_MAPPING[$message->process][0];
-                    $conversionrecord->{$statusfield} = self::CONVERSION_FINISHED;
-                }
+                } else if ($status == 'SKIPPED') {
+                    // There was nothing for the process to work on, e.g. analysis of an empty transcript.
+                    $statusfield = self::SERVICE_MAPPING[$process][0];
+                    $conversionrecord->{$statusfield} = self::CONVERSION_NOT_FOUND;
 
-            } else if ($message->status == 'ERROR') {
-                // For each failed status mark it as failed in the record.
-                $statusfield = self::SERVICE_MAPPING[$message->process][0];
-                $conversionrecord->{$statusfield} = self::CONVERSION_ERROR;
+                } else if ($status == 'ERROR' || $status == 'FAILED' || $status == 'TIMEOUT') {
+                    // For each failed status mark it as failed in the record.
+                    $statusfield = self::SERVICE_MAPPING[$process][0];
+                    $conversionrecord->{$statusfield} = self::CONVERSION_ERROR;
+                }
             }
         }
 
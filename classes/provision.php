@@ -462,6 +462,7 @@ class provision {
 
     /**
      * Update the environment variables in a Lambda function.
+     * Variables already set on the function, such as those set by the stack template, are kept.
      *
      * @param string $function The ARN of the lambda function.
      * @param array $lambdaenvvars
@@ -476,6 +477,11 @@ class provision {
         $client = $this->create_lambda_client();
 
         try {
+            $configuration = $client->getFunctionConfiguration(['FunctionName' => $function]);
+            if (isset($configuration['Environment']['Variables'])) {
+                $lambdaenvvars = array_merge($configuration['Environment']['Variables'], $lambdaenvvars);
+            }
+
             $client->updateFunctionConfiguration([
                 'Environment' => [
                     'Variables' => $lambdaenvvars,
@@ -57,6 +57,14 @@ class queue_process {
      */
     private const MAX_MESSAGES = 100;
 
+    /**
+     * Newest status message schema version this plugin can read.
+     * Messages without a schemaversion attribute are version 1.
+     *
+     * @var integer
+     */
+    private const SUPPORTED_SCHEMA_VERSION = 2;
+
 
 
     /**
@@ -101,25 +109,64 @@ class queue_process {
 
 
     /**
-     * Get pending messages from the AWS SQS queue.
+     * Get the URLs of the AWS SQS queues to receive messages from, in the order to read them.
+     *
+     * The short lane queue has the status messages of short uploads. It is read first,
+     * so they aren't held up behind the messages of long media.
      *
-     * @return array $messages The messages retreived from the SQS Queue.
+     * @return array $queues Queue URL => Seconds to wait for messages.
+     */
+    private function get_queue_urls() : array {
+        $queues = array();
+        if (!empty($this->config->sqs_short_queue_url)) {
+            $queues[$this->config->sqs_short_queue_url] = 1; // Long poll, but don't hold up the main queue.
+        }
+        $queues[$this->config->sqs_queue_url] = 10; // To quick and we miss messages, to long and it's slow.
+
+        return $queues;
+    }
+
+    /**
+     * Get pending messages from the AWS SQS queues.
+     *
+     * @return array $messages The messages retreived from the SQS Queues.
      */
     private function get_queue_messages() : array {
+        $messages = array();
+
+        foreach ($this->get_queue_urls() as $queueurl => $waittime) {
+            if (count($messages) >= self::MAX_MESSAGES) {
+                break;
+            }
+            $messages = array_merge($messages, $this->get_messages_from_queue($queueurl, $waittime, $messages));
+        }
+
+        return $messages;
+    }
+
+    /**
+     * Get pending messages from one AWS SQS queue.
+     *
+     * @param string $queueurl URL of the queue.
+     * @param int $waittime Seconds to wait for messages.
+     * @param array $messages Messages already received from other queues.
+     * @return array $newmessages The messages retreived from the SQS Queue, with the queue URL they came from.
+     */
+    private function get_messages_from_queue(string $queueurl, int $waittime, array $messages) : array {
         global $CFG;
 
         // Get current messages from queue.
-        $messages = array();
+        $queuemessages = array();
         $messageparams = array(
             'AttributeNames' => array('All'),
             'MaxNumberOfMessages' => 10,  // 10 is AWS maximum per call.
             'MessageAttributeNames' => array('All'),
-            'QueueUrl' => $this->config->sqs_queue_url,
+            'QueueUrl' => $queueurl,
             'VisibilityTimeout' => 60,
-            'WaitTimeSeconds' => 10, // To quick and we miss messages, to long and it's slow.
+            'WaitTimeSeconds' => $waittime,
         );
 
-        while (count($messages) < self::MAX_MESSAGES) {
+        while (count($messages) + count($queuemessages) < self::MAX_MESSAGES) {
             $result = $this->client->receiveMessage($messageparams);
             $newmessages = $result->get('Messages'); // Number of received messages varies unpredictably.
 
@@ -134,16 +181,28 @@ class queue_process {
                 $messagebody = json_decode($newmessage['Body']);
                 $messagehash = md5(json_encode($messagebody->message));
                 $messagesiteid = $newmessage['MessageAttributes']['siteid']['StringValue'];
+                $schemaversion = (int)($newmessage['MessageAttributes']['schemaversion']['StringValue'] ?? 1);
 
                 // We could be using the same AWS queue for multiple Moodles,
                 // so we only store messages for our Moodle.
-                if ($messagesiteid === $CFG->siteidentifier) {
-                    $messages[$messagehash] = $newmessage;
+                if ($messagesiteid !== $CFG->siteidentifier) {
+                    continue;
                 }
+
+                // Messages from a newer AWS stack are left on the queue until this plugin is upgraded.
+                if ($schemaversion > self::SUPPORTED_SCHEMA_VERSION) {
+                    debugging('Skipping SQS message ' . $newmessage['MessageId'] . ' with unsupported schema version '
+                        . $schemaversion, DEBUG_DEVELOPER);
+                    continue;
+                }
+
+                // Messages are deleted from the queue they came from.
+                $newmessage['QueueUrl'] = $queueurl;
+                $queuemessages[$messagehash] = $newmessage;
             }
         }
 
-        return $messages;
+        return $queuemessages;
     }
 
     /**
@@ -203,7 +262,7 @@ class queue_process {
 
         foreach ($messages as $message) {
             $deleteparams = array(
-                'QueueUrl' => $this->config->sqs_queue_url,
+                'QueueUrl' => $message['QueueUrl'] ?? $this->config->sqs_queue_url,
                 'ReceiptHandle' => $message['ReceiptHandle']
             );
 
@@ -175,12 +175,12 @@ if ($createstackresponse->code != 0 ) {
 
 // We need to update the created Lambda functions environment variables
 // as trying to do it at stack build time causes a circular references in cloudformation.
+// The pipeline IDs are set by the pipeline resources themselves, so they follow stack updates.
 
 $envvararray = array(
     array(
         'function' => $createstackresponse->outputs['TranscodeLambdaArn'],
         'values' => array(
-            'PipelineId' => $createstackresponse->outputs['TranscodePipelineId'],
             'SmartmediaSqsQueue' => $createstackresponse->outputs['SmartmediaSqsQueue'])
     )
 );
@@ -210,5 +210,6 @@ echo get_string(
 echo get_string('provision:inputbucket', 'local_smartmedia', $createstackresponse->outputs['InputBucket']) . PHP_EOL;
 echo get_string('provision:outputbucket', 'local_smartmedia', $createstackresponse->outputs['OutputBucket']) . PHP_EOL;
 echo get_string('provision:sqsqueue', 'local_smartmedia', $createstackresponse->outputs['SmartmediaSqsQueue']) . PHP_EOL;
+echo get_string('provision:sqsshortqueue', 'local_smartmedia', $createstackresponse->outputs['ShortLaneSqsQueue']) . PHP_EOL;
 
 exit(0); // 0 means success.
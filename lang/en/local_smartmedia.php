@@ -47,6 +47,7 @@ $string['provision:stack'] = 'Provisioning the smart media stack resources';
 $string['provision:s3useraccesskey'] = 'Smart media S3 user access key: {$a}';
 $string['provision:s3usersecretkey'] = 'Smart media S3 user secret key: {$a}';
 $string['provision:sqsqueue'] = 'SQS queue URL: {$a}';
+$string['provision:sqsshortqueue'] = 'SQS short lane queue URL: {$a}';
 $string['provision:stackcreated'] = 'Cloudformation stack created. Stack ID is: {$a}';
 $string['provision:uploadlambdaarchives'] = 'Uploading Lambda function archives to resource S3 bucket';
 $string['dashboard:heading'] = 'Smart Media Dashboard';
@@ -105,6 +106,8 @@ $string['settings:aws:region'] = 'Region';
 $string['settings:aws:region_help'] = 'Amazon API gateway region.';
 $string['settings:aws:sqs_queue_url'] = 'SQS queue URL';
 $string['settings:aws:sqs_queue_url_help'] = 'URL of the AWS SQS queue to receive status messages from.';
+$string['settings:aws:sqs_short_queue_url'] = 'SQS short lane queue URL';
+$string['settings:aws:sqs_short_queue_url_help'] = 'URL of the AWS SQS queue to receive the status messages of short uploads from. It is read before the main queue. Set this before turning on the ShortLaneStatusQueue stack parameter.';
 $string['settings:aws:usesdkcreds'] = 'Use the default credential provider chain to find AWS credentials';
 $string['settings:aws:usesdkcreds_desc'] = 'If Moodle is hosted inside AWS, the default credential chain can be used for access to Smartmedia resources. If so, the AWS key and Secret key are not required to be provided.';
 $string['settings:connectionsuccess'] = 'Could establish connection to the external object storage.';
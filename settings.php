@@ -81,6 +81,12 @@ if ($hassiteconfig) {
         '',
         PARAM_URL));
 
+    $settings->add(new admin_setting_configtext('local_smartmedia/sqs_short_queue_url',
+        get_string('settings:aws:sqs_short_queue_url', 'local_smartmedia'),
+        get_string('settings:aws:sqs_short_queue_url_help', 'local_smartmedia'),
+        '',
+        PARAM_URL));
+
     $settings->add(new admin_setting_configcheckbox('local_smartmedia/lowlatency',
         get_string('settings:lowlatency', 'local_smartmedia'),
         get_string('settings:lowlatency_help', 'local_smartmedia'), 0));
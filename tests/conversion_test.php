@@ -821,6 +821,55 @@ class local_smartmedia_conversion_testcase extends advanced_testcase {
                 $this->assertNotContains($preset['Preset']['Id'], $result['presets']);
             }
         }
+        // Without extracted metadata no source properties are sent.
+        $this->assertArrayNotHasKey('width', $result);
+    }
+
+    /**
+     * Test source properties are added to the conversion settings when the file metadata is known.
+     */
+    public function test_get_conversion_settings_source_properties() {
+        global $DB;
+        $this->resetAfterTest(true);
+
+        $mockdata = array_values($this->fixture['readPreset']['quality_low']);
+        $mock = $this->create_mock_elastic_transcoder_client($mockdata);
+
+        $metadatarecord = new \stdClass();
+        $metadatarecord->contenthash = '8d6985bd0d2abb09a444eb7066efc43678465fc0';
+        $metadatarecord->pathnamehash = '4a1bba15ebb79e7813e642790a551bfaaf6c6066';
+        $metadatarecord->duration = 3.123;
+        $metadatarecord->bitrate = 1000;
+        $metadatarecord->size = 390;
+        $metadatarecord->videostreams = 1;
+        $metadatarecord->audiostreams = 1;
+        $metadatarecord->width = 854;
+        $metadatarecord->height = 480;
+        $metadatarecord->metadata = '{}';
+        $DB->insert_record('local_smartmedia_data', $metadatarecord);
+
+        $conversionrecord = new \stdClass();
+        $conversionrecord->id = 508000;
+        $conversionrecord->contenthash = '8d6985bd0d2abb09a444eb7066efc43678465fc0';
+        $conversionrecord->transcribe_status = 404;
+        $conversionrecord->rekog_label_status = 404;
+        $conversionrecord->rekog_moderation_status = 404;
+        $conversionrecord->rekog_face_status = 404;
+        $conversionrecord->rekog_person_status = 404;
+        $conversionrecord->detect_sentiment_status = 404;
+        $conversionrecord->detect_phrases_status = 404;
+        $conversionrecord->detect_entities_status = 404;
+
+        $transcoder = new aws_elastic_transcoder($mock);
+        $conversion = new \local_smartmedia\conversion($transcoder);
+        $method = new ReflectionMethod('\local_smartmedia\conversion', 'get_conversion_settings');
+        $method->setAccessible(true); // Allow accessing of private method.
+        $result = $method->invoke($conversion, $conversionrecord);
+
+        $this->assertSame('854', $result['width']);
+        $this->assertSame('480', $result['height']);
+        $this->assertSame('1000', $result['bitrate']);
+        $this->assertEquals(3.123, (float)$result['duration']);
     }
 
     /**
@@ -868,6 +917,35 @@ class local_smartmedia_conversion_testcase extends advanced_testcase {
         $this->assertEquals($conversion::CONVERSION_ERROR, $resultbad);
     }
 
+    /**
+     * Test getting compressed and uncompressed data files from aws.
+     */
+    public function test_get_data_file() {
+        $this->resetAfterTest(true);
+
+        $api = new aws_api();
+        $transcoder = new aws_elastic_transcoder($api->create_elastic_transcoder_client());
+        $conversion = new \local_smartmedia\conversion($transcoder);
+
+        $conversionrecord = new \stdClass();
+        $conversionrecord->contenthash = '8d6985bd0d2abb09a444eb7066efc43678465fc0';
+
+        $labels = '{"metadata": {}, "labels": []}';
+        $mockhandler = new MockHandler();
+        $mockhandler->append(new Result(array('Body' => gzencode($labels), 'ContentEncoding' => 'gzip')));
+        $mockhandler->append(new Result(array('Body' => $labels)));
+
+        $this->assertTrue($conversion->get_data_file($conversionrecord, 'StartLabelDetection', $mockhandler));
+        $this->assertTrue($conversion->get_data_file($conversionrecord, 'StartFaceDetection', $mockhandler));
+
+        $fs = get_file_storage();
+        foreach (array('Labels', 'Faces') as $filename) {
+            $file = $fs->get_file(1, 'local_smartmedia', 'metadata', 0,
+                '/' . $conversionrecord->contenthash . '/metadata/', $filename . '.json');
+            $this->assertEquals($labels, $file->get_content());
+        }
+    }
+
     /**
      * Test that initial conversion records are successfully created.
      */
@@ -1080,6 +1158,65 @@ class local_smartmedia_conversion_testcase extends advanced_testcase {
         $this->assertEquals($conversion::CONVERSION_ACCEPTED, $result->status);
     }
 
+    /**
+     * Test processing conversions for a record with a completion message for all its processes.
+     */
+    public function test_process_conversion_completion() {
+        $this->resetAfterTest(true);
+
+        // Set up the AWS mock for the label data file.
+        $mock = new MockHandler();
+        $mock->append(new Result(array('Body' => '{"metadata": {}, "labels": []}')));
+
+        $api = new aws_api();
+        $transcoder = new aws_elastic_transcoder($api->create_elastic_transcoder_client());
+        $conversion = new \local_smartmedia\conversion($transcoder);
+
+        $conversionrecord = new \stdClass();
+        $conversionrecord->id = 508000;
+        $conversionrecord->pathnamehash = '4a1bba15ebb79e7813e642790a551bfaaf6c6066';
+        $conversionrecord->contenthash = '8d6985bd0d2abb09a444eb7066efc43678465fc0';
+        $conversionrecord->status = $conversion::CONVERSION_ACCEPTED;
+        $conversionrecord->transcoder_status = $conversion::CONVERSION_FINISHED;
+        $conversionrecord->rekog_label_status = $conversion::CONVERSION_ACCEPTED;
+        $conversionrecord->rekog_moderation_status = $conversion::CONVERSION_ACCEPTED;
+        $conversionrecord->rekog_face_status = $conversion::CONVERSION_NOT_FOUND;
+        $conversionrecord->rekog_person_status = $conversion::CONVERSION_NOT_FOUND;
+        $conversionrecord->transcribe_status = $conversion::CONVERSION_NOT_FOUND;
+        $conversionrecord->detect_sentiment_status = $conversion::CONVERSION_ACCEPTED;
+        $conversionrecord->detect_entities_status = $conversion::CONVERSION_NOT_FOUND;
+        $conversionrecord->detect_phrases_status = $conversion::CONVERSION_NOT_FOUND;
+        $conversionrecord->timecreated = time();
+        $conversionrecord->timemodified = time();
+
+        $messagerecord1 = new \stdClass();
+        $messagerecord1->objectkey = '8d6985bd0d2abb09a444eb7066efc43678465fc0';
+        $messagerecord1->process = 'completion';
+        $messagerecord1->status = 'COMPLETED';
+        $messagerecord1->message = json_encode(array(
+            'objectkey' => '8d6985bd0d2abb09a444eb7066efc43678465fc0',
+            'started' => 1566091800,
+            'outcomes' => array(
+                'StartLabelDetection' => 'SUCCEEDED',
+                'StartContentModeration' => 'TIMEOUT',
+                'SentimentComplete' => 'SKIPPED',
+            )
+        ));
+        $messagerecord1->senttime = '1566091817';
+        $messagerecord1->timecreated = '1566197550';
+
+        $messages = array($messagerecord1);
+
+        $method = new ReflectionMethod('\local_smartmedia\conversion', 'process_conversion');
+        $method->setAccessible(true); // Allow accessing of private method.
+        $result = $method->invoke($conversion, $conversionrecord, $messages, $mock);
+
+        $this->assertEquals($conversion::CONVERSION_FINISHED, $result->rekog_label_status);
+        $this->assertEquals($conversion::CONVERSION_ERROR, $result->rekog_moderation_status);
+        $this->assertEquals($conversion::CONVERSION_NOT_FOUND, $result->detect_sentiment_status);
+        $this->assertEquals($conversion::CONVERSION_ACCEPTED, $result->status);
+    }
+
     /**
      * Test processing conversions for a record with a sucessful elastic transcode process.
      */
@@ -1088,6 +1225,10 @@ class local_smartmedia_conversion_testcase extends advanced_testcase {
 
         // Set up the AWS mock.
         $mock = new MockHandler();
+        // There is no manifest, so the conversion files are listed.
+        $mock->append(function (CommandInterface $cmd, RequestInterface $req) {
+            return new S3Exception('Mock exception', $cmd, array('code' => 'NoSuchKey'));
+        });
         $mock->append(new Result($this->fixture['listobjects']));
         foreach ($this->fixture['listobjects']['Contents'] as $object) {
             // The fixture contains mock body data for non-binary files only.
@@ -1137,6 +1278,92 @@ class local_smartmedia_conversion_testcase extends advanced_testcase {
         $this->assertEquals($conversion::CONVERSION_ACCEPTED, $result->status);
     }
 
+    /**
+     * Test getting the transcoded files named in the manifest, without listing them.
+     */
+    public function test_get_transcode_files_manifest() {
+        $this->resetAfterTest(true);
+
+        $conversions = array();
+        foreach ($this->fixture['listobjects']['Contents'] as $object) {
+            $conversions[basename($object['Key'])] = array('size' => $object['Size'], 'etag' => trim($object['ETag'], '"'));
+        }
+        $manifest = array('version' => 1, 'objectkey' => 'SampleVideo1mb', 'conversions' => $conversions);
+
+        // Set up the AWS mock, the manifest is followed by the files.
+        $mock = new MockHandler();
+        $mock->append(new Result(array('Body' => json_encode($manifest))));
+        foreach ($this->fixture['listobjects']['Contents'] as $object) {
+            // The fixture contains mock body data for non-binary files only.
+            if (array_key_exists('Body', $object)) {
+                $mock->append(new Result($object));
+            } else {
+                $mock->append(new Result(array()));
+            }
+        }
+
+        $api = new aws_api();
+        $transcoder = new aws_elastic_transcoder($api->create_elastic_transcoder_client());
+        $conversion = new \local_smartmedia\conversion($transcoder);
+
+        $conversionrecord = new \stdClass();
+        $conversionrecord->contenthash = 'SampleVideo1mb';
+
+        $files = $conversion->get_transcode_files($conversionrecord, $mock);
+
+        // Every file in the manifest was requested, only the mocked playlists have content to store.
+        $playlists = array_filter($this->fixture['listobjects']['Contents'], function($object) {
+            return array_key_exists('Body', $object);
+        });
+        $this->assertCount(count($playlists), $files);
+        $this->assertEquals(0, $mock->count());
+    }
+
+    /**
+     * Test a file in the manifest that is no longer in the output bucket is skipped.
+     */
+    public function test_get_transcode_files_manifest_stale() {
+        $this->resetAfterTest(true);
+
+        $conversions = array();
+        foreach ($this->fixture['listobjects']['Contents'] as $object) {
+            $conversions[basename($object['Key'])] = array('size' => $object['Size'], 'etag' => trim($object['ETag'], '"'));
+        }
+        $conversions['SampleVideo1mb_stale.mp4'] = array('size' => 1, 'etag' => 'stale');
+        $manifest = array('version' => 1, 'objectkey' => 'SampleVideo1mb', 'conversions' => $conversions);
+
+        // Set up the AWS mock, the manifest is followed by the files and then the missing stale file.
+        $mock = new MockHandler();
+        $mock->append(new Result(array('Body' => json_encode($manifest))));
+        foreach ($this->fixture['listobjects']['Contents'] as $object) {
+            // The fixture contains mock body data for non-binary files only.
+            if (array_key_exists('Body', $object)) {
+                $mock->append(new Result($object));
+            } else {
+                $mock->append(new Result(array()));
+            }
+        }
+        $mock->append(function (CommandInterface $cmd, RequestInterface $req) {
+            return new S3Exception('Mock exception', $cmd, array('code' => 'NoSuchKey'));
+        });
+
+        $api = new aws_api();
+        $transcoder = new aws_elastic_transcoder($api->create_elastic_transcoder_client());
+        $conversion = new \local_smartmedia\conversion($transcoder);
+
+        $conversionrecord = new \stdClass();
+        $conversionrecord->contenthash = 'SampleVideo1mb';
+
+        $files = $conversion->get_transcode_files($conversionrecord, $mock);
+
+        $playlists = array_filter($this->fixture['listobjects']['Contents'], function($object) {
+            return array_key_exists('Body', $object);
+        });
+        $this->assertDebuggingCalled();
+        $this->assertCount(count($playlists), $files);
+        $this->assertEquals(0, $mock->count());
+    }
+
     /**
      * Test processing conversions for a record with no current queue messages.
      */
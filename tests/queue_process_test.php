@@ -95,6 +95,126 @@ class local_smartmedia_queue_process_testcase extends advanced_testcase {
         $this->assertArrayHasKey('c0f0564c18ec9468eae999f5416c2b35', $result);
     }
 
+    /**
+     * Test messages with a newer schema version are left on the queue.
+     */
+    public function test_get_queue_messages_schema_version() {
+        $this->resetAfterTest(true);
+        global $CFG;
+
+        $CFG->siteidentifier = 'wck1bOkID2Nj6mCG3bsQqUwxPz54eQaxmoodle.local';
+
+        // The first message is compact, the second is from a stack newer than the plugin.
+        $sqsmessages = $this->fixture['sqsmessages'];
+        $sqsmessages['Messages'][0]['MessageAttributes']['schemaversion'] = array(
+            'StringValue' => '2',
+            'DataType' => 'Number',
+        );
+        $sqsmessages['Messages'][1]['MessageAttributes']['schemaversion'] = array(
+            'StringValue' => '3',
+            'DataType' => 'Number',
+        );
+
+        // Set up the AWS mock.
+        $mock = new MockHandler();
+        $mock->append(new Result($sqsmessages));
+        $mock->append(new Result(array()));
+
+        $queueprocess = new \local_smartmedia\queue_process();
+        $queueprocess->create_client($mock);
+
+        // We're testing a private method, so we need to setup reflector magic.
+        $method = new ReflectionMethod('\local_smartmedia\queue_process', 'get_queue_messages');
+        $method->setAccessible(true); // Allow accessing of private method.
+        $result = $method->invoke($queueprocess);
+
+        $this->assertDebuggingCalled();
+        $this->assertCount(1, $result);
+        $this->assertArrayHasKey('433e99fcfec5c3f50406f05705c209de', $result);
+    }
+
+    /**
+     * Test the short lane queue is read before the main queue, and messages are deleted from their queue.
+     */
+    public function test_get_queue_messages_short_lane() {
+        $this->resetAfterTest(true);
+        global $CFG;
+
+        $CFG->siteidentifier = 'wck1bOkID2Nj6mCG3bsQqUwxPz54eQaxmoodle.local';
+        set_config('sqs_short_queue_url', 'https://foo.bar/short', 'local_smartmedia');
+
+        // The first message is on the short lane queue and the second on the main queue.
+        $shortmessages = $this->fixture['sqsmessages'];
+        $mainmessages = $this->fixture['sqsmessages'];
+        unset($shortmessages['Messages'][1]);
+        unset($mainmessages['Messages'][0]);
+
+        // Set up the AWS mock.
+        $queueurls = array();
+        $mock = new MockHandler();
+        $mock->append(function (CommandInterface $cmd, RequestInterface $req) use ($shortmessages, &$queueurls) {
+            $queueurls[] = $cmd['QueueUrl'];
+            return new Result($shortmessages);
+        });
+        $mock->append(new Result(array()));
+        $mock->append(function (CommandInterface $cmd, RequestInterface $req) use ($mainmessages, &$queueurls) {
+            $queueurls[] = $cmd['QueueUrl'];
+            return new Result($mainmessages);
+        });
+        $mock->append(new Result(array()));
+
+        $queueprocess = new \local_smartmedia\queue_process();
+        $queueprocess->create_client($mock);
+
+        // We're testing a private method, so we need to setup reflector magic.
+        $method = new ReflectionMethod('\local_smartmedia\queue_process', 'get_queue_messages');
+        $method->setAccessible(true); // Allow accessing of private method.
+        $result = $method->invoke($queueprocess);
+
+        $this->assertEquals(array('https://foo.bar/short', 'https://foo.bar'), $queueurls);
+        $this->assertCount(2, $result);
+        $this->assertEquals('https://foo.bar/short', $result['433e99fcfec5c3f50406f05705c209de']['QueueUrl']);
+        $this->assertEquals('https://foo.bar', $result['c0f0564c18ec9468eae999f5416c2b35']['QueueUrl']);
+    }
+
+    /**
+     * Test only the main queue is read when the short lane queue isn't configured.
+     */
+    public function test_get_queue_messages_short_lane_unconfigured() {
+        $this->resetAfterTest(true);
+        global $CFG;
+
+        $CFG->siteidentifier = 'wck1bOkID2Nj6mCG3bsQqUwxPz54eQaxmoodle.local';
+
+        // Set up the AWS mock.
+        $queueurls = array();
+        $sqsmessages = $this->fixture['sqsmessages'];
+        $mock = new MockHandler();
+        $mock->append(function (CommandInterface $cmd, RequestInterface $req) use ($sqsmessages, &$queueurls) {
+            $queueurls[] = $cmd['QueueUrl'];
+            return new Result($sqsmessages);
+        });
+        $mock->append(function (CommandInterface $cmd, RequestInterface $req) use (&$queueurls) {
+            $queueurls[] = $cmd['QueueUrl'];
+            return new Result(array());
+        });
+
+        $queueprocess = new \local_smartmedia\queue_process();
+        $queueprocess->create_client($mock);
+
+        // We're testing a private method, so we need to setup reflector magic.
+        $method = new ReflectionMethod('\local_smartmedia\queue_process', 'get_queue_messages');
+        $method->setAccessible(true); // Allow accessing of private method.
+        $result = $method->invoke($queueprocess);
+
+        $this->assertEquals(array('https://foo.bar', 'https://foo.bar'), $queueurls);
+        $this->assertCount(2, $result);
+        foreach ($result as $message) {
+            $this->assertEquals('https://foo.bar', $message['QueueUrl']);
+        }
+        $this->assertEquals(0, $mock->count());
+    }
+
     /**
      * Test store messages in DB.
      */